@@ -0,0 +1,225 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import string
+import subprocess
+import sys
+import tempfile
+import time
+
+# Benchmark the order, upload and report paths of bot.py against synthetic
+# inventories. Needs the bot's requirements installed; DISCORD_TOKEN is not used.
+#
+#   python bench.py --sizes 1000,10000,100000 --output bench_results/run.json
+#   python bench.py --compare bench_results/old.json bench_results/new.json
+
+AMOUNTS = [60, 325, 660]
+GUILD_ID = 1
+DEFAULT_SIZES = [1000, 10000, 100000]
+DEFAULT_ITERATIONS = 200
+RESULTS_DIR = 'bench_results'
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+# Code in the real format: XXXX-X-S-NNNNNNNN NNNN-NNNN-NNNN-NNNN
+def make_code(rng, serial):
+    prefix = ''.join(rng.choice(string.ascii_uppercase) for _ in range(4))
+    letter = rng.choice(string.ascii_letters)
+    pin = '-'.join(f"{rng.randrange(10000):04d}" for _ in range(4))
+    return f"{prefix}-{letter}-S-{serial:08d} {pin}"
+
+def make_inventory(size, rng, serials):
+    data = {"codes": []}
+    for amount in AMOUNTS:
+        codes = [{"code": make_code(rng, next(serials)), "redeemed": False} for _ in range(size)]
+        data['codes'].append({"amount": amount, "codes": codes, "price": float(amount)})
+    return data
+
+
+# Bytes this process has written so far (Linux only)
+def bytes_written():
+    try:
+        with open('/proc/self/io') as file:
+            for line in file:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class FakeMessage:
+    attachments = []
+
+class FakeChannel:
+    id = 0
+
+class FakeAuthor:
+    id = 0
+
+class FakeCtx:
+    def __init__(self, shard):
+        self.shard = shard
+        self.message = FakeMessage()
+        self.channel = FakeChannel()
+        self.author = FakeAuthor()
+        self.guild = None
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+
+
+async def measure(name, iterations, operation):
+    latencies = []
+    written = []
+    for i in range(iterations):
+        before = bytes_written()
+        start = time.perf_counter()
+        await operation(i)
+        latencies.append((time.perf_counter() - start) * 1000)
+        after = bytes_written()
+        if before is not None:
+            written.append(after - before)
+    result = {
+        'iterations': iterations,
+        'p50_ms': percentile(latencies, 0.50),
+        'p90_ms': percentile(latencies, 0.90),
+        'p99_ms': percentile(latencies, 0.99),
+        'max_ms': max(latencies),
+        'bytes_written_per_op': sum(written) / len(written) if written else None,
+    }
+    print(f"  {name:<22} p50 {result['p50_ms']:8.3f} ms  p99 {result['p99_ms']:8.3f} ms  "
+          f"written {result['bytes_written_per_op'] or 0:10.0f} B/op")
+    return result
+
+
+async def bench_size(bot, size, iterations, rng, serials):
+    import engine
+    from shards import ShardManager
+    from storage import save_codes, migrate_json_to_sqlite, STORAGE
+
+    # The bench guild's shard lives in a fresh working directory for this size
+    workdir = tempfile.mkdtemp(prefix=f"bench-{size}-")
+    os.chdir(workdir)
+    save_codes(make_inventory(size, rng, serials))
+    if STORAGE == 'sqlite':
+        migrate_json_to_sqlite()
+    shards = ShardManager(home_guild=GUILD_ID)
+    start = time.perf_counter()
+    ctx = FakeCtx(shards.get(GUILD_ID))
+    inventory = ctx.shard.inventory
+    load_ms = (time.perf_counter() - start) * 1000
+    print(f"{size} codes per amount (loaded in {load_ms:.1f} ms, {workdir})")
+
+    amount = AMOUNTS[0]
+    results = {'load_ms': load_ms}
+
+    async def order(i):
+        await bot.baki(ctx, str(amount), '1')
+
+    async def sell_many(i):
+        inventory.sell_many([(amount, 1)], 0, 0)
+
+    async def basket(i):
+        inventory.sell_many([(amount, 1), (AMOUNTS[1], 1)], 0, 0)
+
+    async def add_codes(i):
+        await bot.add_codes(ctx, amount, [make_code(rng, next(serials)) for _ in range(10)])
+
+    async def check_removed_codes(i):
+        engine.check_removed_codes(inventory)
+
+    async def stock(i):
+        await bot.stock(ctx)
+
+    results['baki'] = await measure('baki', iterations, order)
+    results['sell_many'] = await measure('sell_many', iterations, sell_many)
+    results['sell_many (basket)'] = await measure('sell_many (basket)', iterations, basket)
+    results['add_codes (10 codes)'] = await measure('add_codes (10 codes)', iterations, add_codes)
+    results['check_removed_codes'] = await measure('check_removed_codes', iterations, check_removed_codes)
+    results['stock'] = await measure('stock', iterations, stock)
+    shards.stop()
+    return results
+
+
+async def run(sizes, iterations, seed):
+    # bot.py builds its inventory on import, so import it from an empty directory
+    os.chdir(tempfile.mkdtemp(prefix="bench-"))
+    # Measure our own latency, not the client-side Discord rate limit
+    os.environ.setdefault('CHANNEL_RATE', str(10 ** 9))
+    sys.path.insert(0, REPO_DIR)
+    import bot
+
+    rng = random.Random(seed)
+    serials = iter(range(10 ** 8))
+    results = {}
+    for size in sizes:
+        results[str(size)] = await bench_size(bot, size, iterations, rng, serials)
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Print the p50 change of every operation between two result files
+def compare(old_file, new_file):
+    with open(old_file) as file:
+        old = json.load(file)
+    with open(new_file) as file:
+        new = json.load(file)
+    for size, operations in new['results'].items():
+        print(f"{size} codes per amount")
+        for name, result in operations.items():
+            before = old['results'].get(size, {}).get(name)
+            if not isinstance(result, dict) or not isinstance(before, dict):
+                continue
+            change = (result['p50_ms'] - before['p50_ms']) / before['p50_ms'] * 100 if before['p50_ms'] else 0
+            flag = '  <-- slower' if change > 10 else ''
+            print(f"  {name:<22} p50 {before['p50_ms']:8.3f} -> {result['p50_ms']:8.3f} ms ({change:+.0f}%){flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bot's order, upload and report paths")
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help="codes per amount, comma separated")
+    parser.add_argument('--iterations', type=int, default=DEFAULT_ITERATIONS)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="where to save the JSON results")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="compare two result files")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    output = os.path.abspath(args.output or os.path.join(
+        REPO_DIR, RESULTS_DIR, time.strftime('%Y%m%d-%H%M%S') + '.json'))
+
+    results = asyncio.run(run(sizes, args.iterations, args.seed))
+
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump({
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'revision': git_revision(),
+            'storage': os.getenv('STORAGE', 'json'),
+            'iterations': args.iterations,
+            'results': results,
+        }, file, indent=4)
+    print(f"Saved results to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,24 @@
 import discord
 from discord.ext import commands
-import json
 import os
 import logging
-import re
+import asyncio
+import functools
+import contextlib
+import signal
+import time
+import codecs
+import json
+import tempfile
+import aiohttp
+from concurrent.futures import ThreadPoolExecutor
+from shards import ShardManager
+from outbox import Outbox, send_chunked, send_message
+from engine import CODE_PATTERN, parse_amount, parse_order
+from loop_watchdog import StallWatchdog, STALL_THRESHOLD
+import engine
+import export
+import metrics
 
 # Logging setup
 logging.basicConfig(level=logging.INFO)
@@ -11,193 +26,48 @@ logging.basicConfig(level=logging.INFO)
 # Bot Setup
 TOKEN = os.getenv('DISCORD_TOKEN')  # Replace with your actual bot token
 intents = discord.Intents.default()
-bot = commands.Bot(command_prefix=".", intents=intents)
 
-# Constants
-FILE_NAME = 'codes.json'
-REMOVED_FILE_NAME = 'used.json'
+# Queued orders only live in memory, so their buyers are told they were
+# dropped while the connection is still up
+class RedeemBot(commands.AutoShardedBot):
+    async def close(self):
+        if not self.is_closed():
+            await notify_dropped_orders()
+        await super().close()
 
-# Helper functions
-def load_codes(file_name=FILE_NAME):
-    if os.path.exists(file_name):
-        try:
-            with open(file_name, 'r') as file:
-                return json.load(file)
-        except json.JSONDecodeError:
-            logging.error("JSON file is corrupted. Resetting to empty data.")
-            return {"codes": []}
-    return {"codes": []}
-
-def save_codes(data, file_name=FILE_NAME):
-    try:
-        with open(file_name, 'w') as file:
-            json.dump(data, file, indent=4)
-    except IOError as e:
-        logging.error(f"Error saving file: {e}")
-
-def get_codes(amount, count=1):
-    data = load_codes(FILE_NAME)
-    group = next((item for item in data['codes'] if item['amount'] == amount), None)
-
-    if not group:
-        return None
-    
-    available_codes = [code for code in group['codes'] if not code['redeemed']]
-    
-    if len(available_codes) < count:
-        return None
-
-    selected_codes = available_codes[:count]
-    for code in selected_codes:
-        code['redeemed'] = True
-    
-    # Remove the redeemed codes from the original list
-    group['codes'] = [code for code in group['codes'] if not code['redeemed']]
-    save_codes(data, FILE_NAME)
-    
-    return amount, [code['code'] for code in selected_codes]
-
-# Set price for a specific amount in both files
-def set_price(amount, price, file_name=FILE_NAME):
-    data = load_codes(file_name)
-    group = next((item for item in data['codes'] if item['amount'] == amount), None)
-    
-    if not group:
-        logging.warning(f"No codes available for amount: {amount}")
-        return
-    
-    group['price'] = price
-    save_codes(data, file_name)
-    logging.info(f"Set price for {amount}uc codes to {price}")
-
-    # Also set price in used.json
-    if file_name != REMOVED_FILE_NAME:
-        data_used = load_codes(REMOVED_FILE_NAME)
-        group_used = next((item for item in data_used['codes'] if item['amount'] == amount), None)
-        
-        if group_used:
-            group_used['price'] = price
-            save_codes(data_used, REMOVED_FILE_NAME)
-            logging.info(f"Set price for {amount}uc codes to {price} in {REMOVED_FILE_NAME}")
-
-def move_used_codes(used_codes, amount, destination_file=REMOVED_FILE_NAME):
-    destination_data = load_codes(destination_file)
-
-    if 'codes' not in destination_data:
-        destination_data['codes'] = []
-
-    destination_group = next((item for item in destination_data['codes'] if item['amount'] == amount), None)
-    if not destination_group:
-        destination_group = {"amount": amount, "codes": [], "price": 0}  # Include price field
-        destination_data['codes'].append(destination_group)
-
-    # Include price from codes.json
-    source_data = load_codes(FILE_NAME)
-    source_group = next((item for item in source_data['codes'] if item['amount'] == amount), None)
-    if source_group:
-        destination_group['price'] = source_group.get('price', 0)
-
-    # Filter out only actual redeemed codes with a valid 'code' key
-    redeemed_codes = [code for code in used_codes if 'code' in code]
-
-    destination_group['codes'].extend(redeemed_codes)
-    save_codes(destination_data, destination_file)
-    logging.info(f"Moved {len(redeemed_codes)} used codes to {destination_file}")
-
-
-# New function to check used codes with pricing in used.json
-def check_removed_codes(file_name=REMOVED_FILE_NAME):
-    data = load_codes(file_name)
-    if not data['codes']:
-        return "No Dues available, All clear ✅✅✅."
-    
-    result = []
-    total_sum = 0
-    for group in data['codes']:
-        amount = group['amount']
-        count = len(group['codes'])
-        price = group.get('price', 0)  # Get price from the group or default to 0
-        total_value = price * count
-        total_sum += total_value
-        result.append(f"{amount} 🆄︎ 🅲︎ ➪ {count} pcs")
-    
-    result.append(f"\nTotal due: {total_sum} tk")
-    return "\n".join(result)
-
-
-
-
-
-
-    
-
-# New function to check stock with total sum
-def check_stock(file_name=FILE_NAME):
-    data = load_codes(file_name)
-    if not data['codes']:
-        print("No codes available.")
-        return
-    
-    total_sum = 0
-    result = []
-    for group in data['codes']:
-        amount = group['amount']
-        available_codes = len([code for code in group['codes'] if not code['redeemed']])
-        price = group.get('price', 0)
-        total_value = price * available_codes
-        total_sum += total_value
-        result.append(f"{amount} 🆄︎🅲︎ ➪ {available_codes} pcs")
+bot = RedeemBot(command_prefix=".", intents=intents)
 
-    result.append(f"\nWᴏʀᴛʜ Oғ : {total_sum} tk")
-    print("\n".join(result))
+# Each guild has its own inventory, loaded on first use and written back in
+# the background
+shards = ShardManager()
+metrics.start_exporter()
 
+# Opt-in: log what blocks the event loop for longer than STALL_THRESHOLD seconds
+stall_watchdog = StallWatchdog() if STALL_THRESHOLD > 0 else None
 
-#creating a total due file 
+# Storage work runs on worker threads so it never blocks the gateway loop
+STORAGE_WORKERS = int(os.getenv('STORAGE_WORKERS', 4))
+storage_executor = ThreadPoolExecutor(max_workers=STORAGE_WORKERS, thread_name_prefix="storage")
 
-TOTAL_DUE_FILE = 'total_due.json'
+async def run_storage(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(storage_executor, functools.partial(func, *args))
 
-def load_total_due():
-    if os.path.exists(TOTAL_DUE_FILE):
-        try:
-            with open(TOTAL_DUE_FILE, 'r') as file:
-                return json.load(file).get('total_due', 0)
-        except json.JSONDecodeError:
-            logging.error("JSON file is corrupted. Resetting to zero.")
-            return 0
-    return 0
-
-def save_total_due(amount):
-    try:
-        with open(TOTAL_DUE_FILE, 'w') as file:
-            json.dump({'total_due': amount}, file, indent=4)
-    except IOError as e:
-        logging.error(f"Error saving total due amount: {e}")
-
-total_due = load_total_due()
-
-
-# Function to process orders and generate the desired output format
-def process_order(amount, count):
-    global total_due
-    result = get_codes(amount, count)
-    if result:
-        amount, codes = result
-        codes_output = '```\n```'.join(codes)
-        
-        data = load_codes(FILE_NAME)
-        group = next((item for item in data['codes'] if item['amount'] == amount), None)
-        if group:
-            price = group.get('price', 0)
-            total_due += price * count  # Increment total_due
-            save_total_due(total_due)  # Save total_due to file
-        
-        order_output = f"Here are your codes:\n ```{codes_output}```\n✓ {amount} 🆄︎🅲︎  x  {count}  ✓\n\n"
-        order_output += f"Tᴏᴛᴀʟ Dᴜᴇ : {total_due - (price * count)}+({price}x{count}) = {total_due}"
-        return order_output
-    else:
-        logging.warning(f"Not enough available {amount}uc codes.")
-        return None
+# Channel id that low-stock alerts go to. Without it they are only logged.
+ALERT_CHANNEL = int(os.getenv('ALERT_CHANNEL', 0)) or None
 
+# Optional JSONL log of every command the bot runs. Replay it against a copy of
+# the data with: python redeem_code_bot.py --script commands.jsonl
+COMMAND_LOG = os.getenv('COMMAND_LOG')
+command_log = open(COMMAND_LOG, 'a') if COMMAND_LOG else None
+
+def log_command(ctx):
+    record = {"ts": time.time(), "guild": getattr(ctx.guild, 'id', None), "channel": ctx.channel.id,
+              "user": ctx.author.id, "command": ctx.message.content}
+    if ctx.message.attachments:
+        record["attachments"] = [attachment.filename for attachment in ctx.message.attachments]
+    command_log.write(json.dumps(record, ensure_ascii=False) + "\n")
+    command_log.flush()
 
 # Bot Commands
 
@@ -206,164 +76,325 @@ async def on_ready():
     print(f"✅ Logged in as {bot.user}")
     logging.info("Bot is ready!")
 
+# Unload guild inventories nobody has used for a while
+async def evict_idle_shards():
+    while True:
+        await asyncio.sleep(max(shards.idle / 4, 1))
+        await run_storage(shards.evict_idle)
+
+@bot.event
+async def setup_hook():
+    bot.shard_evictor = asyncio.create_task(evict_idle_shards())
+    # A restart (SIGTERM) shuts down like Ctrl+C: waiting buyers are told and
+    # pending writes are flushed
+    with contextlib.suppress(NotImplementedError):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.ensure_future(bot.close()))
+    if stall_watchdog:
+        stall_watchdog.start(asyncio.get_running_loop())
+
+# Time every command and hand it its guild's shard as ctx.shard. One lock per
+# amount within a shard: concurrent orders for the same amount run one at a
+# time, different amounts and different guilds run in parallel.
+@bot.before_invoke
+async def before_command(ctx):
+    ctx.command_started = time.perf_counter()
+    if command_log:
+        log_command(ctx)
+    if stall_watchdog:
+        stall_watchdog.command_started(f".{ctx.command.name} in {getattr(ctx.guild, 'id', 'DM')}")
+    ctx.shard = await run_storage(shards.get, getattr(ctx.guild, 'id', None))
+
+@bot.after_invoke
+async def after_command(ctx):
+    if stall_watchdog:
+        stall_watchdog.command_finished()
+    shard = getattr(ctx, 'shard', None)
+    if shard is not None:
+        shards.release(shard)
+    started = getattr(ctx, 'command_started', None)
+    if started is not None:
+        metrics.command_seconds.observe(time.perf_counter() - started, command=ctx.command.name)
+    if ctx.command_failed:
+        metrics.command_errors.inc(command=ctx.command.name)
+
+@bot.command(name='metrics')
+@commands.has_permissions(administrator=True)
+async def show_metrics(ctx):
+    """Show command latency and storage I/O statistics"""
+    await send_chunked(ctx, f"```\n{metrics.summary()}\n```")
+
 @bot.command()
-async def baki(ctx, amount: int, count: int = 1):
-    """Retrieve UC codes"""
-    result = process_order(amount, count)
-    if result:
-        codes_output = '\n'.join(result.split('\n')[:-2])  # Only take the valid codes part of the output
-        codes = [code.strip() for code in codes_output.split("\n") if "```" in code]  # Extract valid code strings
-
-        # Ensure only valid codes are moved
-        used_codes = [{"code": code.strip(), "redeemed": True} for code in codes]
-
-        # Send result to Discord
-        await ctx.send(result)
-        
-        # Move used codes to used.json
-        move_used_codes(used_codes, amount)
-    else:
-        await ctx.send(f"❌ Not enough available {amount} UC codes.")
+@commands.has_permissions(administrator=True)
+async def stalls(ctx):
+    """Show where the event loop was blocked (needs STALL_THRESHOLD)"""
+    if not stall_watchdog:
+        await send_chunked(ctx, "The stall watchdog is off. Set STALL_THRESHOLD (seconds) to turn it on.")
+        return
+    await send_chunked(ctx, f"```\n{stall_watchdog.summary()}\n```")
+
+@bot.command()
+async def baki(ctx, *args):
+    """Retrieve UC codes: .baki 60 3 or .baki 60x3 325x2"""
+    items = parse_order(args)
+    if not items or any(count < 1 for _, count in items):
+        await send_chunked(ctx, "Invalid order. Use: .baki <amount> <count> or .baki 60x3 325x2")
+        return
+
+    # Lock every amount in the basket, always in the same order
+    amounts = sorted({amount for amount, _ in items})
+    async with contextlib.AsyncExitStack() as stack:
+        for amount in amounts:
+            await stack.enter_async_context(ctx.shard.amount_locks[amount])
+        reply, filled = await run_storage(engine.place_order, ctx.shard.inventory, ctx.shard.orders, items,
+                                          ctx.author.id, ctx.channel.id, ctx.channel)
+
+    # No reply when the order was filled straight from the queue: its
+    # delivery below is the reply
+    if reply:
+        await send_chunked(ctx, reply)
+    await deliver_queued_orders(ctx, filled)
+    await post_stock_alerts(ctx)
+
+# Send orders filled from the queue to the channels they were placed in.
+# They are already sold, so one that cannot be sent there goes to the buyer
+# by DM, and failing that to ALERT_CHANNEL (or this channel) for staff to
+# hand over; the remaining orders are delivered either way.
+async def deliver_queued_orders(ctx, filled):
+    for order, result in filled:
+        message = engine.queued_order_message(order, result)
+        try:
+            await send_chunked(order.destination, message)
+            continue
+        except Exception as e:
+            logging.error(f"Could not deliver queued order ({order.amount}uc x {order.count}) "
+                          f"to {order.user} in channel {order.channel}: {e}")
+        try:
+            user = bot.get_user(order.user) or await bot.fetch_user(order.user)
+            await send_chunked(user, message)
+            continue
+        except Exception as e:
+            logging.error(f"Could not send queued order to {order.user} by DM: {e}")
+        channel = (bot.get_channel(ALERT_CHANNEL) if ALERT_CHANNEL else None) or ctx
+        try:
+            await send_chunked(channel, f"⚠️ Sold but undelivered: queued order of <@{order.user}> "
+                                        f"({order.amount} 🆄︎🅲︎ x {order.count}), please hand it over:\n{result}")
+        except Exception as e:
+            logging.error(f"Queued order of {order.user} was sold but not delivered anywhere: {e}\n{result}")
+
+# Fill waiting orders after codes for an amount were uploaded
+async def fill_queued_orders(ctx, amount):
+    async with ctx.shard.amount_locks[amount]:
+        filled = await run_storage(engine.fill_orders, ctx.shard.inventory, ctx.shard.orders, amount)
+    await deliver_queued_orders(ctx, filled)
+    await post_stock_alerts(ctx)
+
+@bot.command(name='queue')
+async def show_queue(ctx):
+    """Show your orders waiting for stock"""
+    await send_chunked(ctx, engine.show_queue(ctx.shard.orders, ctx.author.id))
+
+@bot.command()
+async def cancel(ctx):
+    """Leave the queue: cancel your orders waiting for stock"""
+    await send_chunked(ctx, engine.cancel_orders(ctx.shard.orders, ctx.author.id))
+
+# Tell buyers whose orders are still waiting that they were dropped, one
+# message per channel the orders were placed in
+async def notify_dropped_orders():
+    by_channel = {}
+    for order in shards.drain_orders():
+        by_channel.setdefault(order.channel, []).append(order)
+    for orders in by_channel.values():
+        try:
+            await send_chunked(orders[0].destination, engine.dropped_orders_message(orders))
+        except Exception as e:
+            logging.error(f"Could not tell {len(orders)} queued orders in channel {orders[0].channel} "
+                          f"that they were dropped: {e}")
+
+# Report stock thresholds crossed by this guild's orders to ALERT_CHANNEL
+async def post_stock_alerts(ctx):
+    messages = await run_storage(engine.stock_alerts, ctx.shard.inventory)
+    channel = bot.get_channel(ALERT_CHANNEL) if ALERT_CHANNEL else None
+    if not messages or channel is None:
+        return
+    if ctx.guild is not None:
+        messages.insert(0, f"**{ctx.guild.name}**")
+    await send_chunked(channel, "\n".join(messages))
 
 
 @bot.command()
 async def price(ctx, amount: int, price: float):
     """Set the price for a UC package"""
-    set_price(amount, price)
-    await ctx.send(f"✅ Price for {amount} UC set to {price}.")
+    async with ctx.shard.amount_locks[amount]:
+        await run_storage(ctx.shard.inventory.set_price, amount, price)
+    await send_chunked(ctx, f"✅ Price for {amount} UC set to {price}.")
 
 @bot.command()
 async def clear(ctx):
     """Clear used codes and reset total due"""
-    global total_due
-    total_due = 0
-    save_total_due(total_due)  # Reset total due amount to zero
-    save_codes({"codes": []}, REMOVED_FILE_NAME)  # Clear used.json
-    await ctx.send("Cleared all dues ✅ ✅.")
+    await run_storage(ctx.shard.inventory.clear)  # Clear used.json and reset total due amount to zero
+    await send_chunked(ctx, "Cleared all dues ✅ ✅.")
+
+@bot.command()
+async def report(ctx, *args):
+    """Sales per amount: .report 2026-10-01 2026-10-07, or .report for the current dues period"""
+    await send_chunked(ctx, await run_storage(engine.report, ctx.shard.inventory, args))
 
 
+@bot.command()
+async def lookup(ctx, *, code=''):
+    """Find who got a sold code and when: .lookup <code>"""
+    await send_chunked(ctx, await run_storage(engine.lookup, ctx.shard.inventory, code))
+
+@bot.command(name='export')
+@commands.has_permissions(administrator=True)
+async def export_data(ctx, kind='', *args):
+    """Export stock or sales as a compressed file: .export stock or .export sold <from> <to> [csv|jsonl]"""
+    args = list(args)
+    fmt = args.pop() if args and args[-1] in export.FORMATS else 'csv'
+    with tempfile.TemporaryDirectory(prefix='export-') as directory:
+        file_name = os.path.join(directory, f"{kind}-{time.strftime('%Y%m%d-%H%M%S')}.{fmt}.gz")
+        count, error = await run_storage(export.export_file, ctx.shard.inventory, kind, args, file_name, fmt)
+        if error:
+            await send_chunked(ctx, error)
+            return
+        limit = ctx.guild.filesize_limit if ctx.guild else 8 * 1024 * 1024
+        if os.path.getsize(file_name) > limit:
+            await send_chunked(ctx, f"The export ({count} rows) is too large to attach. "
+                                    f"Narrow the dates, or run redeem_code_bot.py --export on the server.")
+            return
+        await send_message(ctx, f"{count} rows", file=discord.File(file_name))
+
 @bot.command()
 async def rate(ctx):
     """Show UC prices"""
-    data = load_codes()
-    if not data['codes']:
-        await ctx.send("No UC codes available.")
-        return
-    
-    result = []
-    for group in data['codes']:
-        amount = group['amount']
-        price = group.get('price', None)
-        if price is not None and price > 0:
-            result.append(f"☞ {amount} 🆄︎🅲︎ ➪ {price} BDT")
-    
-    if not result:
-        await ctx.send("No prices set for UC codes.")
-    else:
-        await ctx.send("\n".join(result))
-        
-    
+    await send_chunked(ctx, await run_storage(engine.show_prices, ctx.shard.inventory))
+
+
 @bot.command()
 async def hi(ctx):
-    await ctx.send("Hi Darling! 😘")
+    await send_chunked(ctx, "Hi Darling! 😘")
 
 @bot.command()
 async def stock(ctx):
     """Check stock with total sum"""
-    data = load_codes()
-    if not data['codes']:
-        await ctx.send("No codes available.")
-        return
-    
-    total_sum = 0
-    result = []
-    for group in data['codes']:
-        amount = group['amount']
-        available_codes = len([code for code in group['codes'] if not code['redeemed']])
-        price = group.get('price', 0)
-        total_value = price * available_codes
-        total_sum += total_value
-        result.append(f"{amount} 🆄︎🅲︎ ➪ {available_codes} pcs")
-
-    result.append(f"\nWᴏʀᴛʜ Oғ : {total_sum} tk")
-    await ctx.send("\n".join(result))
+    await send_chunked(ctx, await run_storage(engine.check_stock, ctx.shard.inventory))
 
 @bot.command()
 async def check(ctx):
     """Check removed codes with total sum"""
-    result = check_removed_codes()
-    await ctx.send(result)
+    result = await run_storage(engine.check_removed_codes, ctx.shard.inventory)
+    await send_chunked(ctx, result)
 
-    # Load codes from JSON file
-def load_codes(file_name=FILE_NAME):
-    if os.path.exists(file_name):
-        try:
-            with open(file_name, 'r') as file:
-                return json.load(file)
-        except json.JSONDecodeError:
-            logging.error("JSON file is corrupted. Resetting to empty data.")
-            return {"codes": []}
-    return {"codes": []}
-
-# Save codes to JSON file
-def save_codes(data, file_name=FILE_NAME):
-    try:
-        with open(file_name, 'w') as file:
-            json.dump(data, file, indent=4)
-    except IOError as e:
-        logging.error(f"Error saving file: {e}")
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def verify(ctx):
+    """Rebuild stock and due counters from raw data and report mismatches"""
+    problems = await run_storage(ctx.shard.inventory.verify)
+    if problems:
+        await send_chunked(ctx, "⚠️ Counter mismatches:\n" + "\n".join(problems))
+    else:
+        await send_chunked(ctx, "✅ Counters match the stored codes.")
 
 # Add codes grouped by amount
-async def add_codes(ctx, amount, codes, file_name=FILE_NAME):
-    data = load_codes(file_name)
-    group = next((item for item in data['codes'] if item['amount'] == amount), None)
-    
-    if not group:
-        group = {"amount": amount, "codes": [], "price": 0}
-        data['codes'].append(group)
-    
-    existing_codes = {code['code'] for code in group['codes']}
-    new_codes = []
-
-    for code in codes:
-        if code.strip() not in existing_codes:
-            new_codes.append({"code": code.strip(), "redeemed": False})
-            existing_codes.add(code.strip())
-        else:
-            warning_message = f"Duplicate code detected: ```{code.strip()}```"
-            logging.warning(warning_message)
-            await ctx.send(warning_message)
-
-    group['codes'].extend(new_codes)
-    
-    save_codes(data, file_name)
-    log_message = f"Added {len(new_codes)} codes for amount: {amount}"
-    logging.info(log_message)
-    await ctx.send(log_message)
+async def add_codes(ctx, amount, codes):
+    async with ctx.shard.amount_locks[amount]:
+        messages = await run_storage(engine.add_codes, ctx.shard.inventory, amount, codes)
+
+    # Duplicate warnings and the summary go out together in as few messages as possible
+    async with Outbox(ctx) as outbox:
+        for message in messages:
+            outbox.add(message)
+    await fill_queued_orders(ctx, amount)
+
+# Attachment uploads
+UPLOAD_EXTENSIONS = ('.txt', '.csv')
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Stream an attachment and yield its lines one chunk at a time
+async def iter_attachment_lines(session, attachment):
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    tail = ''
+    async with session.get(attachment.url) as response:
+        response.raise_for_status()
+        async for chunk in response.content.iter_chunked(UPLOAD_CHUNK_SIZE):
+            lines = (tail + decoder.decode(chunk)).split('\n')
+            tail = lines.pop()
+            yield lines
+    tail += decoder.decode(b'', final=True)
+    if tail:
+        yield [tail]
+
+# Read codes from .txt/.csv attachments and add them with one storage write
+async def upload_attachments(ctx, amount, attachments, text=''):
+    codes = []
+    seen = set()
+    duplicates = 0
+    malformed = 0
+    skipped = []
+
+    def parse(lines):
+        nonlocal duplicates, malformed
+        for line in lines:
+            found = CODE_PATTERN.findall(line)
+            # Anything left on the line besides codes and separators is malformed
+            if CODE_PATTERN.sub('', line).strip(' \t\r,;"\''):
+                malformed += 1
+            for code in found:
+                if code in seen:
+                    duplicates += 1
+                else:
+                    seen.add(code)
+                    codes.append(code)
+
+    parse(text.split('\n'))
+    async with aiohttp.ClientSession() as session:
+        for attachment in attachments:
+            if not attachment.filename.lower().endswith(UPLOAD_EXTENSIONS):
+                skipped.append(attachment.filename)
+                continue
+            async for lines in iter_attachment_lines(session, attachment):
+                parse(lines)
+
+    added = []
+    if codes:
+        async with ctx.shard.amount_locks[amount]:
+            added, existing = await run_storage(ctx.shard.inventory.add_codes, amount, codes)
+        duplicates += len(existing)
+
+    summary = f"Added {len(added)} codes for amount: {amount} (duplicates: {duplicates}, malformed: {malformed})"
+    if skipped:
+        summary += f"\nSkipped files (only .txt/.csv): {', '.join(skipped)}"
+    logging.info(summary)
+    await send_chunked(ctx, summary)
+    if added:
+        await fill_queued_orders(ctx, amount)
 
 # Function to process the upload command
 async def process_upload_command(ctx, command):
+    attachments = ctx.message.attachments
     parts = command.split(' ', 2)
-    if len(parts) < 3:
+    if len(parts) < 3 and not (attachments and len(parts) == 2):
         logging.error("Invalid command format. Use: .up <amount>uc <codes>")
-        await ctx.send("Invalid command format. Use: .up <amount>uc <codes>")
+        await send_chunked(ctx, "Invalid command format. Use: .up <amount>uc <codes> or attach .txt/.csv files")
         return
 
-    amount_code, codes = parts[1], parts[2]
-    try:
-        amount = int(amount_code[:-2])
-    except ValueError:
+    amount = parse_amount(parts[1])
+    if amount is None:
         logging.error("Invalid amount format. Please provide a valid number before 'uc'.")
-        await ctx.send("Invalid amount format. Please provide a valid number before 'uc'.")
+        await send_chunked(ctx, "Invalid amount format. Please provide a valid number before 'uc'.")
+        return
+
+    if attachments:
+        await upload_attachments(ctx, amount, attachments, parts[2] if len(parts) == 3 else '')
         return
 
     # Extract each code using a flexible pattern
-    pattern = r'[a-zA-Z]{4}-[a-zA-Z]-S-\d{8} \d{4}-\d{4}-\d{4}-\d{4}'
-    clean_codes = re.findall(pattern, codes)
+    clean_codes = CODE_PATTERN.findall(parts[2])
 
     if not clean_codes:
         logging.error("No valid codes found.")
-        await ctx.send("No valid codes found.")
+        await send_chunked(ctx, "No valid codes found.")
         return
 
     await add_codes(ctx, amount, clean_codes)
@@ -373,7 +404,16 @@ async def process_upload_command(ctx, command):
 async def up(ctx, *, command):
     await process_upload_command(ctx, f"up {command}")
 
-    
+
 
 # Run the bot
-bot.run(TOKEN)
+if __name__ == "__main__":
+    error = shards.check_home_guild()
+    if error:
+        logging.error(error)
+        raise SystemExit(1)
+    try:
+        bot.run(TOKEN)
+    finally:
+        storage_executor.shutdown()
+        shards.stop()  # Write anything still pending before exit
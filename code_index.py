@@ -0,0 +1,215 @@
+import os
+import logging
+import math
+import hashlib
+import threading
+import struct
+from storage import atomic_write
+
+# Every code ever uploaded, in stock or sold, one per line
+SEEN_FILE = 'seen_codes.txt'
+
+# Bloom filter sized for SEEN_EXPECTED codes at SEEN_ERROR_RATE false positives
+SEEN_EXPECTED = int(os.getenv('SEEN_EXPECTED', 1000000))
+SEEN_ERROR_RATE = float(os.getenv('SEEN_ERROR_RATE', 0.001))
+
+# With SEEN_EXACT=0 only the Bloom filter is kept in memory and its positives
+# are confirmed by reading SEEN_FILE, so memory stays fixed as history grows
+SEEN_EXACT = os.getenv('SEEN_EXACT', '1') != '0'
+
+
+class BloomFilter:
+    def __init__(self, expected=SEEN_EXPECTED, error_rate=SEEN_ERROR_RATE):
+        self.size = max(8, int(-expected * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / expected * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, code):
+        digest = hashlib.blake2b(code.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, code):
+        for position in self._positions(code):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, code):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(code))
+
+
+# The Bloom filter is saved next to the index file on close, with how much of
+# the file it covers, so a restart only reads codes added since:
+#   magic, filter size in bits, hash count, bytes of SEEN_FILE covered
+BLOOM_HEADER = struct.Struct('<4sQIQ')
+BLOOM_MAGIC = b'SCB1'
+
+
+# Global duplicate index over every code ever seen, across all amounts and
+# sold history. Kept on disk as an append-only file and updated incrementally.
+# With SEEN_EXACT the set of codes is read by a background thread; until it is
+# ready, Bloom filter hits are confirmed from the file.
+class CodeIndex:
+    def __init__(self, file_name=SEEN_FILE, exact=SEEN_EXACT):
+        self.file_name = file_name
+        self.bloom_file = os.path.splitext(file_name)[0] + '.bloom'
+        self.exact = exact
+        self.lock = threading.Lock()
+        self.codes = None
+        self.pending = set()
+        self.closed = False
+
+        self.bloom, self.offset = self._load_bloom()
+        for self.offset, code in self._lines(self.offset):
+            self._remember(code)
+        self._file = open(file_name, 'ab', buffering=0)
+
+        self._loader = None
+        if exact:
+            self._loader = threading.Thread(target=self._load_exact, name="seen-index", daemon=True)
+            self._loader.start()
+
+    def _load_bloom(self):
+        bloom = BloomFilter()
+        if os.path.exists(self.bloom_file) and os.path.exists(self.file_name):
+            with open(self.bloom_file, 'rb') as file:
+                data = file.read()
+            try:
+                magic, size, hashes, offset = BLOOM_HEADER.unpack_from(data)
+            except struct.error:
+                magic = None
+            if (magic == BLOOM_MAGIC and (size, hashes) == (bloom.size, bloom.hashes)
+                    and len(data) == BLOOM_HEADER.size + len(bloom.bits) and offset <= os.path.getsize(self.file_name)):
+                bloom.bits[:] = data[BLOOM_HEADER.size:]
+                return bloom, offset
+            logging.info(f"{self.bloom_file} does not match the index settings, rebuilding it")
+        return bloom, 0
+
+    def _save_bloom(self):
+        data = BLOOM_HEADER.pack(BLOOM_MAGIC, self.bloom.size, self.bloom.hashes, self.offset)
+        try:
+            atomic_write(self.bloom_file, data + self.bloom.bits)
+        except OSError as e:
+            logging.error(f"Error writing {self.bloom_file}: {e}")
+
+    # (end offset, code) for each whole line from byte `offset` on
+    def _lines(self, offset):
+        if not os.path.exists(self.file_name):
+            return
+        with open(self.file_name, 'rb') as file:
+            file.seek(offset)
+            for line in file:
+                if not line.endswith(b'\n'):
+                    break  # Still being written
+                offset += len(line)
+                code = line.decode('utf-8', 'replace').rstrip('\n')
+                if code:
+                    yield offset, code
+
+    def _read(self):
+        for _, code in self._lines(0):
+            yield code
+
+    # Background thread: build the exact set, then let seen() use it
+    def _load_exact(self):
+        codes = set()
+        position = 0
+        if os.path.exists(self.file_name):
+            with open(self.file_name, 'rb') as file:
+                for line in file:
+                    if self.closed:
+                        return
+                    if not line.endswith(b'\n'):
+                        break
+                    position += len(line)
+                    codes.add(line.decode('utf-8', 'replace').rstrip('\n'))
+        with self.lock:
+            # Whatever was added while we read is in the file or in pending
+            with open(self.file_name, 'rb') as file:
+                file.seek(position)
+                codes.update(line.decode('utf-8', 'replace').rstrip('\n') for line in file)
+            codes.discard('')
+            self.codes = codes | self.pending
+            self.pending = set()
+        logging.info(f"Loaded {len(self.codes)} codes into the duplicate index")
+
+    # Whether no code has ever been recorded
+    def empty(self):
+        return not os.path.exists(self.file_name) or os.path.getsize(self.file_name) == 0
+
+    def _remember(self, code):
+        self.bloom.add(code)
+        if self.codes is not None:
+            self.codes.add(code)
+        elif self.exact:
+            self.pending.add(code)
+
+    # Return the subset of `codes` that has been seen before
+    def seen(self, codes):
+        with self.lock:
+            candidates = {code for code in codes if code in self.bloom}
+            if not candidates:
+                return set()
+            if self.codes is not None:
+                return candidates & self.codes
+            # Confirm Bloom positives with one pass over the file
+            return {code for code in self._read() if code in candidates} | (candidates & self.pending)
+
+    def __contains__(self, code):
+        return bool(self.seen([code]))
+
+    # Record new codes; callers check them with seen() first and hold the
+    # store's lock. If the write fails the file is cut back to where it was
+    # and the error raised, so a code is never recorded only in memory.
+    # Returns where the file ended before, for discard().
+    def add_many(self, codes):
+        with self.lock:
+            end = os.fstat(self._file.fileno()).st_size
+            if not codes:
+                return end
+            data = "".join(code + "\n" for code in codes).encode()
+            try:
+                view = memoryview(data)
+                while view:
+                    view = view[self._file.write(view):]
+            except OSError as e:
+                logging.error(f"Error writing {self.file_name}: {e}")
+                os.ftruncate(self._file.fileno(), end)
+                raise
+            for code in codes:
+                self._remember(code)
+            return end
+
+    # Take back codes recorded by add_many() when the change that brought them
+    # was not stored. Their Bloom filter bits stay set; a hit is confirmed
+    # from the exact set or the file, which no longer have them.
+    def discard(self, end, codes):
+        with self.lock:
+            os.ftruncate(self._file.fileno(), end)
+            for code in codes:
+                if self.codes is not None:
+                    self.codes.discard(code)
+                self.pending.discard(code)
+
+    # Remember codes other processes added to the file since we last read it
+    def refresh(self):
+        with self.lock:
+            for self.offset, code in self._lines(self.offset):
+                self._remember(code)
+
+    # Remember codes another process has already written to the file
+    def remember_many(self, codes):
+        with self.lock:
+            for code in codes:
+                self._remember(code)
+
+    def close(self):
+        self.closed = True
+        if self._loader is not None:
+            self._loader.join()
+        with self.lock:
+            self._file.close()
+            # Cover everything in the file, including other instances' codes
+            for self.offset, code in self._lines(self.offset):
+                self.bloom.add(code)
+            self._save_bloom()
@@ -0,0 +1,100 @@
+import re
+import struct
+
+# Codes look like BDMB-I-S-01709317 2336-2453-3452-7276: a 4-letter prefix, one
+# letter, an 8-digit serial and 16 digits. That packs into a fixed 18-byte record:
+#   flag (1) | prefix + letter (5) | serial uint32 (4) | digits uint64 (8)
+# Anything else is kept as text in a side table and the record holds its index.
+RECORD = struct.Struct('<B5sIQ')
+RECORD_SIZE = RECORD.size
+
+PACKED = 0
+TEXT = 1
+
+# ASCII digits only: int() would turn other Unicode digits into ASCII ones
+CODE_FORMAT = re.compile(r'([A-Za-z]{4})-([A-Za-z])-S-(\d{8}) (\d{4})-(\d{4})-(\d{4})-(\d{4})', re.ASCII)
+
+
+def pack_code(code):
+    match = CODE_FORMAT.fullmatch(code)
+    if not match:
+        return None
+    prefix, letter, serial, *digits = match.groups()
+    return RECORD.pack(PACKED, (prefix + letter).encode('ascii'), int(serial), int(''.join(digits)))
+
+def unpack_code(record, offset=0):
+    _, letters, serial, digits = RECORD.unpack_from(record, offset)
+    letters = letters.decode('ascii')
+    digits = f"{digits:016d}"
+    return f"{letters[:4]}-{letters[4]}-S-{serial:08d} {digits[:4]}-{digits[4:8]}-{digits[8:12]}-{digits[12:]}"
+
+
+# FIFO queue of codes stored as packed records in one bytearray. Codes outside
+# the standard format are kept losslessly as text. Supports the deque
+# operations the inventory uses: append, extend, popleft, len and iteration.
+# A queue loaded from a snapshot can sit on a read-only buffer (a memory-mapped
+# file); it is copied into a bytearray the first time codes are added.
+class CodeQueue:
+    def __init__(self, codes=()):
+        self.buffer = bytearray()
+        self.head = 0
+        self.texts = {}
+        self.next_text = 0
+        self.extend(codes)
+
+    def __len__(self):
+        return (len(self.buffer) - self.head) // RECORD_SIZE
+
+    def append(self, code):
+        record = pack_code(code)
+        if record is None:
+            record = RECORD.pack(TEXT, b'', self.next_text, 0)
+            self.texts[self.next_text] = code
+            self.next_text += 1
+        self._writable()
+        self.buffer += record
+
+    def _writable(self):
+        if not isinstance(self.buffer, bytearray):
+            self.buffer = bytearray(self.buffer[self.head:])
+            self.head = 0
+
+    def extend(self, codes):
+        for code in codes:
+            self.append(code)
+
+    def _decode(self, offset):
+        if self.buffer[offset] == TEXT:
+            return self.texts[RECORD.unpack_from(self.buffer, offset)[2]]
+        return unpack_code(self.buffer, offset)
+
+    def popleft(self):
+        if self.head >= len(self.buffer):
+            raise IndexError("pop from an empty CodeQueue")
+        offset = self.head
+        code = self._decode(offset)
+        if self.buffer[offset] == TEXT:
+            del self.texts[RECORD.unpack_from(self.buffer, offset)[2]]
+        self.head += RECORD_SIZE
+        # Drop the consumed front once it is most of the buffer
+        if self.head > 65536 and self.head * 2 > len(self.buffer) and isinstance(self.buffer, bytearray):
+            del self.buffer[:self.head]
+            self.head = 0
+        return code
+
+    def __iter__(self):
+        for offset in range(self.head, len(self.buffer), RECORD_SIZE):
+            yield self._decode(offset)
+
+    # Packed records and text codes, for writing binary snapshots
+    def to_bytes(self):
+        return bytes(self.buffer[self.head:]), dict(self.texts)
+
+    # Records may be any bytes-like object; read-only ones are not copied
+    @classmethod
+    def from_bytes(cls, records, texts):
+        queue = cls()
+        queue.buffer = records
+        queue.texts = dict(texts)
+        queue.next_text = max(texts, default=-1) + 1
+        return queue
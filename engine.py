@@ -0,0 +1,251 @@
+import logging
+import re
+import time
+from datetime import datetime, timedelta
+from inventory import STOCK_CRITICAL
+
+# Command logic shared by the Discord bot (bot.py) and the command line tool
+# (redeem_code_bot.py). Every function works on an Inventory and returns the
+# text to show, so both front ends answer the same way.
+
+# Codes look like: BDMB-I-S-01709317 2336-2453-3452-7276
+CODE_PATTERN = re.compile(r'[a-zA-Z]{4}-[a-zA-Z]-S-\d{8} \d{4}-\d{4}-\d{4}-\d{4}', re.ASCII)
+
+
+# "60uc" -> 60, or None
+def parse_amount(amount_code):
+    try:
+        return int(amount_code[:-2])
+    except ValueError:
+        return None
+
+# Parse "60 3" or a basket like "60x3 325x2 660x1" into (amount, count) items
+def parse_order(args):
+    if len(args) in (1, 2) and all(arg.isdigit() for arg in args):
+        return [(int(args[0]), int(args[1]) if len(args) == 2 else 1)]
+
+    items = []
+    for arg in args:
+        amount, _, count = arg.lower().partition('x')
+        if not amount.isdigit() or not (count or '1').isdigit():
+            return None
+        items.append((int(amount), int(count or 1)))
+    return items or None
+
+
+# Add codes grouped by amount. Returns the messages to show: one warning per
+# duplicate, then the summary.
+def add_codes(inventory, amount, codes):
+    new_codes, duplicates = inventory.add_codes(amount, codes)
+    messages = []
+    for code in duplicates:
+        logging.warning(f"Duplicate code detected: {code}")
+        messages.append(f"Duplicate code detected: ```{code}```")
+
+    log_message = f"Added {len(new_codes)} codes for amount: {amount}"
+    logging.info(log_message)
+    messages.append(log_message)
+    return messages
+
+
+# Sell every line item of an order in one write, all or nothing.
+# Returns (order text, []) or (None, [amounts that are short]).
+def process_basket(inventory, items, user=None, channel=None):
+    lines, total_due = inventory.sell_many(items, user, channel)
+    if lines is None:
+        for amount in total_due:
+            logging.warning(f"Not enough available {amount}uc codes.")
+        return None, total_due
+
+    order_output = "Here are your codes:\n"
+    added = []
+    for amount, codes, price in lines:
+        count = len(codes)
+        codes_output = '```\n```'.join(codes)
+        order_output += f" ```{codes_output}```\n✓ {amount} 🆄︎🅲︎  x  {count}  ✓\n\n"
+        added.append((price, count))
+
+    previous_due = total_due - sum(price * count for price, count in added)
+    order_output += f"Tᴏᴛᴀʟ Dᴜᴇ : {previous_due}+" + "+".join(f"({price}x{count})" for price, count in added)
+    order_output += f" = {total_due}"
+    return order_output, []
+
+def short_message(short):
+    return "\n".join(f"❌ Not enough available {amount} UC codes." for amount in short)
+
+# Sell a basket, or queue it if it is for one amount there are not enough
+# codes for (see orders.py). Orders already waiting for that amount go first.
+# Callers hold the lock of every amount in the basket. Returns (reply,
+# filled): the text for the buyer, None if their order was filled straight
+# from the queue, and the queued orders filled on the way as
+# [(order, order text)].
+def place_order(inventory, orders, items, user=None, channel=None, destination=None):
+    amounts = {amount for amount, _ in items}
+    queueable = orders is not None and orders.enabled() and len(amounts) == 1
+    amount = min(amounts)
+    if queueable and orders.waiting(amount):
+        result, short = None, [amount]
+    else:
+        result, short = process_basket(inventory, items, user, channel)
+    if result or not queueable:
+        return result or short_message(short), []
+
+    order, reason = orders.add(amount, sum(count for _, count in items), user, channel, destination)
+    if order is None:
+        return f"{short_message(short)}\n{reason}", []
+    filled = orders.fill(inventory, amount)
+    position = orders.position(order)
+    if position is None:
+        return None, filled
+    return (f"⏳ Not enough {amount} UC codes right now. Your order is #{position} in the queue "
+            f"and will be filled when codes are uploaded. .cancel leaves the queue."), filled
+
+# Fill orders waiting for an amount after codes were uploaded. Callers hold
+# the amount's lock. Returns [(order, order text)].
+def fill_orders(inventory, orders, amount):
+    if orders is None:
+        return []
+    return orders.fill(inventory, amount)
+
+# Message delivering a queued order to its buyer
+def queued_order_message(order, result):
+    return f"<@{order.user}> your queued order is ready:\n{result}"
+
+# Message to buyers of queued orders dropped when the bot shuts down
+def dropped_orders_message(orders):
+    lines = [f"<@{order.user}> {order.amount} 🆄︎🅲︎ x {order.count}" for order in orders]
+    return ("⚠️ The bot is restarting and these queued orders were dropped, nothing was sold. "
+            "Please order again once it is back:\n" + "\n".join(lines))
+
+# A user's orders waiting for stock
+def show_queue(orders, user):
+    waiting = orders.positions(user) if orders is not None else []
+    if not waiting:
+        return "You have no orders waiting."
+    return "\n".join(f"⏳ {amount} 🆄︎🅲︎ x {count}: #{position} in the queue" for amount, count, position in waiting)
+
+# Take a user's waiting orders out of the queue
+def cancel_orders(orders, user):
+    cancelled = orders.cancel(user) if orders is not None else 0
+    if cancelled:
+        return f"Cancelled {cancelled} waiting orders."
+    if orders is not None and orders.positions(user):
+        return "Your order is being filled right now and can no longer be cancelled."
+    return "You have no orders waiting."
+
+# One line per low-stock threshold crossed since the last call
+def stock_alerts(inventory):
+    messages = []
+    for amount, level, in_stock in inventory.pop_alerts():
+        if level == STOCK_CRITICAL:
+            messages.append(f"🚨 Critical stock: {amount} 🆄︎🅲︎ ➪ {in_stock} pcs left")
+        else:
+            messages.append(f"⚠️ Low stock: {amount} 🆄︎🅲︎ ➪ {in_stock} pcs left")
+    return messages
+
+
+# Stock with total sum
+def check_stock(inventory):
+    groups = inventory.stock()
+    if not groups:
+        return "No codes available."
+
+    total_sum = 0
+    result = []
+    for amount, available_codes, price, total_value in groups:
+        total_sum += total_value
+        result.append(f"{amount} 🆄︎🅲︎ ➪ {available_codes} pcs")
+
+    result.append(f"\nWᴏʀᴛʜ Oғ : {total_sum} tk")
+    return "\n".join(result)
+
+# Used codes with pricing and total due
+def check_removed_codes(inventory):
+    groups = inventory.removed()
+    if not groups:
+        return "No Dues available, All clear ✅✅✅."
+
+    result = []
+    total_sum = 0
+    for amount, count, price, total_value in groups:
+        total_sum += total_value
+        result.append(f"{amount} 🆄︎ 🅲︎ ➪ {count} pcs")
+
+    result.append(f"\nTotal due: {total_sum} tk")
+    return "\n".join(result)
+
+# Prices for every amount in stock
+def show_prices(inventory):
+    groups = inventory.stock()
+    if not groups:
+        return "No UC codes available."
+
+    result = []
+    for amount, _, price, _ in groups:
+        if price is not None and price > 0:
+            result.append(f"☞ {amount} 🆄︎🅲︎ ➪ {price} BDT")
+        else:
+            logging.warning(f"No price set for {amount}uc")
+
+    if not result:
+        return "No prices set for UC codes."
+    return "\n".join(result)
+
+
+# Parse "2026-10-01 2026-10-07" into a (start, end) timestamp range that
+# includes the whole end day. One date means that day until now; no dates
+# means since the last settlement (start None). Returns None if invalid.
+def parse_range(args):
+    try:
+        days = [datetime.strptime(arg, '%Y-%m-%d') for arg in args]
+    except ValueError:
+        return None
+    if len(days) > 2:
+        return None
+    start = days[0].timestamp() if days else None
+    end = (days[1] + timedelta(days=1)).timestamp() if len(days) == 2 else time.time() + 1
+    return start, end
+
+# Sales per amount from the ledger over a date range
+def report(inventory, args):
+    span = parse_range(args)
+    if span is None:
+        return "Invalid dates. Use: report <from> <to> with dates like 2026-10-01"
+    start, end = span
+    after_seq = 0
+    if start is None:
+        start, after_seq = inventory.ledger.last_settlement()
+
+    totals = inventory.ledger.report(start, end, after_seq)
+    since = time.strftime('%Y-%m-%d %H:%M', time.localtime(start)) if start else "the beginning"
+    until = time.strftime('%Y-%m-%d %H:%M', time.localtime(end))
+    if not totals:
+        return f"No sales from {since} to {until}."
+
+    result = [f"Sales from {since} to {until}:"]
+    for amount, (count, value) in sorted(totals.items()):
+        result.append(f"{amount} 🆄︎🅲︎ ➪ {count} pcs = {value} tk")
+    result.append(f"\nTotal: {sum(count for count, _ in totals.values())} pcs, "
+                  f"{sum(value for _, value in totals.values())} tk")
+    return "\n".join(result)
+
+# Who got a sold code and when, from the ledger's sold code index
+def lookup(inventory, code):
+    match = CODE_PATTERN.search(code)
+    code = match.group(0) if match else code.strip()
+    if not code:
+        return "Use: lookup <code>"
+    sales = inventory.ledger.lookup(code)
+    if not sales:
+        if code in inventory.seen:
+            return f"```{code}``` is not in the sales ledger: it is in stock, or was sold before the ledger started."
+        return f"```{code}``` was never uploaded."
+
+    _, settled_seq = inventory.ledger.last_settlement()
+    result = [f"```{code}```"]
+    for sale in sales:
+        sold_at = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(sale['ts']))
+        status = "settled" if sale['seq'] <= settled_seq else "still due"
+        result.append(f"✓ {sale['amount']} 🆄︎🅲︎ sold {sold_at} for {sale['price']} tk "
+                      f"to user {sale.get('user')} in channel {sale.get('channel')} ({status})")
+    return "\n".join(result)
@@ -0,0 +1,162 @@
+import os
+import io
+import csv
+import json
+import gzip
+import time
+import logging
+from engine import parse_range
+
+# Stock and sales as CSV or JSONL, one row per code, for reconciling with the
+# supplier and for restoring or merging inventories. Rows are streamed from
+# the in-memory stock and the sales ledger and written in chunks, so an export
+# holds about EXPORT_CHUNK characters of text at a time however long the
+# history is.
+# A file name ending in .gz is compressed on the fly, on export and on import.
+#   stock: amount,code,price
+#   sold:  seq,ts,time,amount,code,price,user,channel
+STOCK_FIELDS = ['amount', 'code', 'price']
+SOLD_FIELDS = ['seq', 'ts', 'time', 'amount', 'code', 'price', 'user', 'channel']
+FORMATS = ('csv', 'jsonl')
+EXPORT_CHUNK = 65536
+
+# Imported codes are added this many at a time per amount
+IMPORT_BATCH = int(os.getenv('IMPORT_BATCH', 10000))
+
+
+def stock_rows(inventory):
+    for amount, price, queue in sorted(inventory.stock_copy(), key=lambda group: group[0]):
+        for code in queue:
+            yield {"amount": amount, "code": code, "price": price}
+
+# Sales from the ledger with start <= ts < end; start None means since the
+# last settlement, like .report
+def sold_rows(inventory, start, end):
+    after_seq = 0
+    if start is None:
+        start, after_seq = inventory.ledger.last_settlement()
+    for sale in inventory.ledger.sales(start, end, after_seq):
+        sale['time'] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(sale['ts']))
+        yield sale
+
+# Rows for `.export stock|sold [from] [to]`: (rows, fields), or (None, error)
+def export_rows(inventory, kind, args):
+    if kind == 'stock':
+        return stock_rows(inventory), STOCK_FIELDS
+    if kind == 'sold':
+        span = parse_range(args)
+        if span is None:
+            return None, "Invalid dates. Use: export sold <from> <to> with dates like 2026-10-01"
+        return sold_rows(inventory, *span), SOLD_FIELDS
+    return None, "Use: export stock|sold [from] [to] [csv|jsonl]"
+
+# Rows as text chunks of about EXPORT_CHUNK characters
+def format_rows(rows, fields, fmt='csv'):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fields, extrasaction='ignore', lineterminator='\n')
+    if fmt == 'csv':
+        writer.writeheader()
+    for row in rows:
+        if fmt == 'csv':
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps({field: row.get(field) for field in fields}) + "\n")
+        if buffer.tell() >= EXPORT_CHUNK:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+# Format of an export file from its name: .jsonl or .jsonl.gz, else CSV
+def format_of(file_name):
+    return 'jsonl' if file_name.endswith(('.jsonl', '.jsonl.gz')) else 'csv'
+
+def open_text(file_name, mode):
+    if file_name.endswith('.gz'):
+        return gzip.open(file_name, mode + 't', encoding='utf-8', newline='')
+    return open(file_name, mode, encoding='utf-8', newline='')
+
+# Write an export to an open text file. Returns the number of rows.
+def write_export(file, rows, fields, fmt='csv'):
+    count = 0
+
+    def counted():
+        nonlocal count
+        for row in rows:
+            count += 1
+            yield row
+
+    for chunk in format_rows(counted(), fields, fmt):
+        file.write(chunk)
+    return count
+
+# Export to a file. Returns (rows written, None) or (None, error).
+def export_file(inventory, kind, args, file_name, fmt='csv'):
+    rows, fields = export_rows(inventory, kind, args)
+    if rows is None:
+        return None, fields
+    with open_text(file_name, 'w') as file:
+        count = write_export(file, rows, fields, fmt)
+    logging.info(f"Exported {count} {kind} rows to {file_name}")
+    return count, None
+
+
+# Rows of a CSV or JSONL export, read one at a time
+def read_rows(file_name):
+    with open_text(file_name, 'r') as file:
+        if format_of(file_name) == 'jsonl':
+            for number, line in enumerate(file, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    logging.warning(f"{file_name}:{number}: not JSON, skipped")
+        else:
+            yield from csv.DictReader(file)
+
+# Add the codes of a stock export to the inventory. Codes already in stock or
+# sold are duplicates, so importing into a live inventory merges it. Amounts
+# without a price take the one in the file. Rows of a sales export are
+# skipped: restoring them as stock would sell those codes twice.
+# Returns the summary text.
+def import_rows(inventory, rows, batch=IMPORT_BATCH):
+    pending = {}
+    prices = {}
+    added = duplicates = skipped = 0
+
+    def flush(amount):
+        nonlocal added, duplicates
+        new_codes, existing = inventory.add_codes(amount, pending.pop(amount))
+        added += len(new_codes)
+        duplicates += len(existing)
+
+    for row in rows:
+        try:
+            amount = int(row['amount'])
+            code = str(row['code']).strip()
+        except (KeyError, TypeError, ValueError):
+            skipped += 1
+            continue
+        if not code or row.get('ts') not in (None, ''):
+            skipped += 1
+            continue
+        if amount not in prices:
+            try:
+                prices[amount] = float(row.get('price') or 0)
+            except (TypeError, ValueError):
+                prices[amount] = 0
+        pending.setdefault(amount, []).append(code)
+        if len(pending[amount]) >= batch:
+            flush(amount)
+    for amount in list(pending):
+        flush(amount)
+
+    for amount, price in prices.items():
+        if price and not inventory.price_of(amount):
+            inventory.set_price(amount, price)
+
+    summary = f"Imported {added} codes (duplicates: {duplicates}, skipped: {skipped})"
+    logging.info(summary)
+    return summary
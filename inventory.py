@@ -0,0 +1,579 @@
+import os
+import logging
+import threading
+import time
+import itertools
+import bisect
+import contextlib
+from storage import open_storage
+from code_index import CodeIndex
+from codec import CodeQueue
+from ledger import Ledger
+
+# The background thread checks every FLUSH_INTERVAL seconds whether the
+# storage backend wants to compact what has been appended since startup.
+FLUSH_INTERVAL = float(os.getenv('FLUSH_INTERVAL', 5))
+
+# How many times a change is tried optimistically when other instances keep
+# writing to the same store first, before holding the store's lock for a
+# final attempt that cannot conflict
+COMMIT_RETRIES = int(os.getenv('COMMIT_RETRIES', 3))
+
+
+# Stock alerts: once a sale leaves an amount with LOW_STOCK codes or fewer it
+# is reported as low, at CRITICAL_STOCK or fewer as critical. STOCK_ALERTS
+# sets both per amount, e.g. "60:20:5,325:10:3". With a threshold of 0 that
+# level is only reported when the amount has run out.
+LOW_STOCK = int(os.getenv('LOW_STOCK', 10))
+CRITICAL_STOCK = int(os.getenv('CRITICAL_STOCK', 3))
+
+def parse_thresholds(text):
+    thresholds = {}
+    for item in filter(None, (item.strip() for item in text.split(','))):
+        try:
+            amount, low, critical = (int(part) for part in item.split(':'))
+        except ValueError:
+            logging.error(f"Ignoring stock alert setting {item!r}, use <amount>:<low>:<critical>")
+            continue
+        thresholds[amount] = (low, critical)
+    return thresholds
+
+STOCK_ALERTS = parse_thresholds(os.getenv('STOCK_ALERTS', ''))
+
+# Stock levels, worst last
+STOCK_OK = 0
+STOCK_LOW = 1
+STOCK_CRITICAL = 2
+
+
+class ConflictError(Exception):
+    pass
+
+
+# In-memory inventory. The storage backend is read once at startup, every
+# command is served from memory and each change is appended to storage as a
+# journal record, made durable with storage.sync() after the state lock is
+# released so concurrent changes share an fsync. Other processes may share
+# the store: before every change the inventory catches up with what they
+# stored, and a change is only appended if nobody wrote in between.
+class Inventory:
+    def __init__(self, storage=None, seen=None, ledger=None, flush_interval=FLUSH_INTERVAL,
+                 thresholds=None):
+        self.storage = storage or open_storage()
+        self.seen = seen or CodeIndex()
+        self.ledger = ledger or Ledger()
+        self.flush_interval = flush_interval
+        self.thresholds = STOCK_ALERTS if thresholds is None else thresholds
+        self.alerts = []
+        self.lock = threading.RLock()
+        self._load()
+
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _load(self):
+        stock, price_table, sold, self.seq, replay = self.storage.load()
+
+        # Stock index: amount -> current price and amount -> FIFO queue of
+        # unredeemed codes, packed into fixed-width records
+        self.prices = {}
+        self.queues = {}
+        for amount, price, queue in stock:
+            self.prices[amount] = price
+            self.queues[amount] = queue
+
+        # Price table: amount -> [(effective from, price), ...] in time order.
+        # Stores without one start from the current prices.
+        if price_table is None:
+            price_table = {amount: [(0, price)] for amount, price in self.prices.items()}
+        self.price_table = price_table
+
+        # Sold codes themselves (used.json) are only loaded when something
+        # needs them, see load_history(). Until then the counters come from
+        # the stored summary and sold records wait in history_pending.
+        self.used = None
+        self.used_groups = {}
+        self.history_pending = []
+        self.history_seq = sold['seq']
+        if sold['history'] is not None:
+            self._set_history(sold['history'])
+        summary = sold['summary'] if sold['summary'] is not None else self._history_summary()
+        # Amounts sold since the last clear, with the price of their latest sale
+        self.sold_prices = {amount: price for amount, _, _, price in summary}
+
+        # Per-amount counters, kept up to date by _apply
+        self.totals, self.total_due = self._count_totals(summary)
+        if abs(self.total_due - sold['total_due']) > 1e-6:
+            logging.warning(f"Stored total due {sold['total_due']} does not match sold codes, using {self.total_due}")
+
+        replayed = []
+        for record, skip in replay:
+            self._apply(record, skip)
+            replayed.append(record)
+
+        with self.storage.file_lock:
+            # Sales journaled just before a crash, or while the ledger could
+            # not be written, may not have reached it. SQLite replays nothing
+            # but keeps recent records in its journal table.
+            last_seq = self.ledger.last_seq()
+            if replayed:
+                missing = [record for record in replayed if record['seq'] > last_seq]
+            else:
+                missing = self.storage.journal_since(last_seq) if last_seq < self.seq else []
+            if missing:
+                self.ledger.append(missing)
+            self.ledger.update_index()
+
+            # Make sure the duplicate index covers everything we hold. Uploads
+            # are written to the index file before the store, so it has every
+            # code we just loaded unless it was lost or is new, and then it
+            # gets all of it. Replayed uploads are checked anyway, as that is
+            # cheap.
+            self.seen.refresh()
+            if self.seen.empty():
+                self.load_history()
+                held = [code for queue in self.queues.values() for code in queue]
+                held += [code['code'] for group in self.used['codes'] for code in group['codes']]
+            else:
+                held = [code for record in replayed if record['op'] == 'upload' for code in record['codes']]
+            known = self.seen.seen(held)
+            missing = list(dict.fromkeys(code for code in held if code not in known))
+            if missing:
+                self.seen.add_many(missing)
+                logging.info(f"Added {len(missing)} codes to the duplicate index")
+
+    def _set_history(self, used_data):
+        self.used = used_data
+        self.used_groups = {group['amount']: group for group in used_data['codes']}
+
+    def history_loaded(self):
+        return self.used is not None
+
+    # Load the sold codes if they are not in memory yet. `preloaded` is a
+    # (used_data, seq) pair read from storage without any lock; it is used if
+    # it is still consistent with our state, otherwise the codes are read
+    # again under the store's lock.
+    def load_history(self, preloaded=None):
+        with self.lock:
+            if self.used is not None:
+                return
+            if preloaded is None or not self.history_seq <= preloaded[1] <= self.seq:
+                with self.storage.file_lock:
+                    self._catch_up()
+                    if self.used is not None:
+                        return
+                    preloaded = self.storage.load_sold()
+            used_data, seq = preloaded
+            self._set_history(used_data)
+            pending, self.history_pending = self.history_pending, []
+            for record in pending:
+                if record['seq'] > seq:
+                    self._apply_history(record)
+            logging.info(f"Loaded {sum(len(group['codes']) for group in self.used['codes'])} sold codes")
+
+    # Background compaction
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._flush_loop, name="inventory-flush", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._compact()
+        # Other instances write the index file and may cut it back under the
+        # store's lock, so its last lines are only read under it
+        with self.storage.file_lock:
+            self.seen.close()
+        self.storage.close()
+        self.ledger.close()
+
+    def _flush_loop(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            if self.storage.needs_compaction():
+                self._compact()
+
+    # Ledger lines must be on disk before the journal records behind them go,
+    # so sales the ledger could not take yet are written first, and the
+    # journal is kept while that still fails
+    def _compact(self):
+        with self.lock, self.storage.file_lock:
+            if not self.ledger.append([]):
+                logging.warning("Sales ledger is behind the journal, not compacting")
+                return
+        self.ledger.sync()
+        self.storage.compact(self)
+
+    # Apply what other instances have stored since we last looked
+    def _catch_up(self):
+        records = self.storage.changes(self.seq)
+        if records is None:
+            logging.info("Store was rewritten by another instance, loading it again")
+            self._load()
+            return
+        for record in records:
+            self._apply(record)
+            self.seq = record['seq']
+            if record['op'] == 'upload':
+                self.seen.remember_many(record['codes'])
+
+    # Run plan() on up-to-date state and commit the changes it returns.
+    # plan() -> (changes, result). If another instance writes between our
+    # catch-up and our append, the append is refused and we plan again.
+    def _transact(self, plan):
+        with self.lock:
+            for attempt in range(COMMIT_RETRIES + 1):
+                exclusive = self.storage.file_lock if attempt == COMMIT_RETRIES else contextlib.nullcontext()
+                with exclusive:
+                    self._catch_up()
+                    changes, result = plan()
+                    if not changes or self._commit(*changes):
+                        return result
+            raise ConflictError(f"Gave up after {COMMIT_RETRIES + 1} conflicting writes")
+
+    # Persist records as one unit if the store is still at our version, then
+    # apply them to memory. Returns False on conflict.
+    def _commit(self, *changes):
+        # Stamped and written under the store's lock, so records reach the
+        # sales ledger in seq and time order across instances
+        with self.storage.file_lock:
+            records = []
+            for i, (op, fields) in enumerate(changes, 1):
+                records.append({"seq": self.seq + i, "ts": int(time.time()), "op": op, **fields})
+            # In the duplicate index before the store, so a stored upload is
+            # always in it; taken back if the store refuses or fails the write
+            uploaded = [code for record in records if record['op'] == 'upload' for code in record['codes']]
+            end = self.seen.add_many(uploaded)
+            try:
+                stored = self.storage.append(records, self.seq)
+            except BaseException:
+                self.seen.discard(end, uploaded)
+                raise
+            if not stored:
+                self.seen.discard(end, uploaded)
+                return False
+            self.ledger.append(records)
+        # Levels straight from the counters, before and after our own sales.
+        # Another instance's sale that crossed a threshold was already
+        # reported by that instance, so it never shows up here as a crossing.
+        taken = {record['amount'] for record in records if record['op'] == 'take'}
+        levels = {amount: self.stock_level(amount) for amount in taken}
+        for record in records:
+            self._apply(record)
+        self.seq = records[-1]['seq']
+        for amount in taken:
+            level = self.stock_level(amount)
+            if level > levels[amount]:
+                in_stock = self.totals[amount]['in_stock']
+                self.alerts.append((amount, level, in_stock))
+                logging.warning(f"{'Critical' if level == STOCK_CRITICAL else 'Low'} stock: {in_stock} {amount}uc codes left")
+        if self.storage.needs_compaction():
+            self._wakeup.set()
+        return True
+
+    def _apply(self, record, skip=()):
+        op = record['op']
+        amount = record.get('amount')
+
+        if op == 'upload' and 'stock' not in skip:
+            if amount not in self.queues:
+                self.queues[amount] = CodeQueue()
+                self.prices[amount] = 0
+            self.queues[amount].extend(record['codes'])
+            self._count_stock(amount, len(record['codes']))
+
+        elif op == 'take' and 'stock' not in skip:
+            queue = self.queues.get(amount, CodeQueue())
+            taken = record['codes']
+            before = len(queue)
+            if list(itertools.islice(queue, len(taken))) == taken:
+                for _ in taken:
+                    queue.popleft()
+            else:
+                taken = set(taken)
+                self.queues[amount] = queue = CodeQueue(code for code in queue if code not in taken)
+            self._count_stock(amount, len(queue) - before)
+
+        elif op == 'sold':
+            # Codes are due at the price of the moment they were sold; a later
+            # price change does not touch them
+            if 'due' not in skip:
+                price = self._sale_price(record)
+                self.sold_prices[amount] = price
+                self._count_sold(amount, len(record['codes']), price)
+            if 'sold' not in skip:
+                self._apply_history(record)
+
+        elif op == 'price':
+            if 'stock' not in skip:
+                self.prices[amount] = record['price']
+                totals = self._totals(amount)
+                totals['stock_value'] = totals['in_stock'] * record['price']
+            # Records come in seq order, so appending keeps changes made in
+            # the same second in the order they were made
+            if 'prices' not in skip:
+                self.price_table.setdefault(amount, []).append((record.get('ts', 0), record['price']))
+
+        elif op == 'due':
+            pass  # Older journals; the total due is now counted from sold codes
+
+        elif op == 'clear':
+            if 'due' not in skip:
+                self.sold_prices = {}
+                for totals in self.totals.values():
+                    totals['sold'] = 0
+                    totals['due'] = 0
+                self.total_due = 0
+            if 'sold' not in skip:
+                self._apply_history(record)
+
+    # Price of a sale record: the one it was made at, or for records without
+    # one, the price in effect at its time
+    def _sale_price(self, record):
+        if record.get('price') is not None:
+            return record['price']
+        return self.price_at(record['amount'], record.get('ts'))
+
+    # The sold codes of a 'sold' or 'clear' record. Kept for
+    # load_history() while the codes are not in memory; a clear empties them
+    # without reading them at all.
+    def _apply_history(self, record):
+        op = record['op']
+        amount = record.get('amount')
+        if op == 'clear':
+            self._set_history({"codes": []})
+            self.history_pending = []
+            return
+        if self.used is None:
+            self.history_pending.append(record)
+            return
+
+        destination_group = self.used_groups.get(amount)
+        if not destination_group:
+            destination_group = {"amount": amount, "codes": [], "price": 0}
+            self.used['codes'].append(destination_group)
+            self.used_groups[amount] = destination_group
+        price = self._sale_price(record)
+        destination_group['codes'].extend({"code": code, "redeemed": True, "price": price} for code in record['codes'])
+        destination_group['price'] = price
+
+    # Counters: in stock, stock value, sold and amount due for each amount
+    def _totals(self, amount):
+        totals = self.totals.get(amount)
+        if totals is None:
+            totals = self.totals[amount] = {'in_stock': 0, 'stock_value': 0, 'sold': 0, 'due': 0}
+        return totals
+
+    def _count_stock(self, amount, change):
+        totals = self._totals(amount)
+        totals['in_stock'] += change
+        totals['stock_value'] += change * self.prices.get(amount, 0)
+
+    def _count_sold(self, amount, change, price):
+        totals = self._totals(amount)
+        value = change * price
+        totals['sold'] += change
+        totals['due'] += value
+        self.total_due += value
+
+    # Count everything from scratch: stock by walking every code, sold codes
+    # from a list of (amount, count, due, latest price)
+    def _count_totals(self, sold):
+        totals = {}
+        for amount, queue in self.queues.items():
+            price = self.prices[amount]
+            totals[amount] = {'in_stock': len(queue), 'stock_value': len(queue) * price, 'sold': 0, 'due': 0}
+        for amount, count, due, _ in sold:
+            counted = totals.setdefault(amount, {'in_stock': 0, 'stock_value': 0, 'sold': 0, 'due': 0})
+            counted['sold'] = count
+            counted['due'] = due
+        return totals, sum(counted['due'] for counted in totals.values())
+
+    # (amount, count, due, latest price) of the sold codes in memory. Codes
+    # sold before prices were kept per code are due at their group's price.
+    def _history_summary(self):
+        return [(group['amount'], len(group['codes']),
+                 sum(code.get('price', group.get('price', 0)) for code in group['codes']), group.get('price', 0))
+                for group in self.used['codes']]
+
+    # (amount, count, due, latest price) from the counters, stored with the total due
+    def sold_summary(self):
+        with self.lock:
+            return [(amount, self.totals[amount]['sold'], self.totals[amount]['due'], price)
+                    for amount, price in self.sold_prices.items()]
+
+    # Rebuild the counters from raw data and list every mismatch
+    def verify(self):
+        with self.lock:
+            self.load_history()
+            counted, total_due = self._count_totals(self._history_summary())
+            problems = []
+            for amount in sorted(set(counted) | set(self.totals)):
+                expected = counted.get(amount, {})
+                actual = self.totals.get(amount, {})
+                for key in ('in_stock', 'stock_value', 'sold', 'due'):
+                    if abs(expected.get(key, 0) - actual.get(key, 0)) > 1e-6:
+                        problems.append(f"{amount} {key}: counter {actual.get(key, 0)}, actual {expected.get(key, 0)}")
+            if abs(total_due - self.total_due) > 1e-6:
+                problems.append(f"total due: counter {self.total_due}, actual {total_due}")
+            return problems
+
+    # Stock as a list of (amount, price, queue)
+    def stock_groups(self):
+        with self.lock:
+            return [(amount, self.prices[amount], queue) for amount, queue in self.queues.items()]
+
+    # Stock as a list of (amount, price, queue) with copies of the queues, so
+    # they can be read without the lock while orders carry on
+    def stock_copy(self):
+        with self.lock:
+            self._catch_up()
+            return [(amount, self.prices[amount], CodeQueue.from_bytes(*queue.to_bytes()))
+                    for amount, queue in self.queues.items()]
+
+    # Stock in the codes.json layout
+    def stock_data(self):
+        with self.lock:
+            return {"codes": [{"amount": amount,
+                               "codes": [{"code": code, "redeemed": False} for code in queue],
+                               "price": self.prices[amount]}
+                              for amount, queue in self.queues.items()]}
+
+    # Add new codes. A code already in stock or sold under any amount is a
+    # duplicate. Returns (new_codes, duplicates).
+    def add_codes(self, amount, codes):
+        def plan():
+            candidates = []
+            duplicates = []
+            uploaded = set()
+            for code in codes:
+                code = code.strip()
+                if code in uploaded:
+                    duplicates.append(code)
+                else:
+                    uploaded.add(code)
+                    candidates.append(code)
+
+            known = self.seen.seen(candidates)
+            new_codes = [code for code in candidates if code not in known]
+            duplicates += [code for code in candidates if code in known]
+            changes = [('upload', {"amount": amount, "codes": new_codes})] if new_codes else []
+            return changes, (new_codes, duplicates)
+
+        new_codes, duplicates = self._transact(plan)
+        self.storage.sync()
+        return new_codes, duplicates
+
+    # Sell a basket of (amount, count) items, all or nothing, in one storage
+    # write. Returns ([(amount, codes, price), ...], total_due), or
+    # (None, [amounts that are short]) if any amount does not have enough codes.
+    # The buyer's user and channel ids go into the sales ledger.
+    def sell_many(self, items, user=None, channel=None):
+        wanted = {}
+        for amount, count in items:
+            wanted[amount] = wanted.get(amount, 0) + count
+
+        def plan():
+            short = [amount for amount, count in wanted.items() if len(self.queues.get(amount, ())) < count]
+            if short:
+                return [], (None, short)
+
+            lines = []
+            changes = []
+            for amount, count in wanted.items():
+                selected_codes = list(itertools.islice(self.queues[amount], count))
+                price = self.prices.get(amount, 0)
+                lines.append((amount, selected_codes, price))
+                changes.append(('take', {"amount": amount, "codes": selected_codes}))
+                sold = {"amount": amount, "codes": selected_codes, "price": price}
+                if user is not None:
+                    sold.update(user=user, channel=channel)
+                changes.append(('sold', sold))
+            return changes, (lines, None)
+
+        with self.lock:
+            lines, short = self._transact(plan)
+            total_due = self.total_due
+        if lines is None:
+            return None, short
+        # Durable before the codes are handed out
+        self.storage.sync()
+        return lines, total_due
+
+    def stock_level(self, amount):
+        with self.lock:
+            low, critical = self.thresholds.get(amount, (LOW_STOCK, CRITICAL_STOCK))
+            in_stock = self.totals.get(amount, {}).get('in_stock', 0)
+            if in_stock <= critical:
+                return STOCK_CRITICAL
+            if in_stock <= low:
+                return STOCK_LOW
+            return STOCK_OK
+
+    # Threshold crossings since the last call: [(amount, level, codes left)]
+    def pop_alerts(self):
+        with self.lock:
+            alerts, self.alerts = self.alerts, []
+            return alerts
+
+    def price_of(self, amount):
+        with self.lock:
+            return self.prices.get(amount)
+
+    # Price in effect for an amount at time `ts` (default now), from the price table
+    def price_at(self, amount, ts=None):
+        with self.lock:
+            table = self.price_table.get(amount)
+            if not table:
+                return self.prices.get(amount, 0)
+            if ts is None:
+                return table[-1][1]
+            position = bisect.bisect_right(table, (ts, float('inf'))) - 1
+            return table[max(position, 0)][1]
+
+    # Price table in the prices.json layout: {"60": [[from, price], ...]}
+    def price_table_data(self):
+        with self.lock:
+            return {str(amount): [list(entry) for entry in table] for amount, table in self.price_table.items()}
+
+    # Set the price for an amount from now on. Codes already sold stay due at
+    # the price they were sold for.
+    def set_price(self, amount, price):
+        def plan():
+            if amount not in self.prices:
+                return [], False
+            return [('price', {"amount": amount, "price": price})], True
+
+        if not self._transact(plan):
+            logging.warning(f"No codes available for amount: {amount}")
+            return False
+        self.storage.sync()
+        logging.info(f"Set price for {amount}uc codes to {price}")
+        return True
+
+    # Settle: clear used codes and reset total due. Sales stay in the ledger,
+    # which records the settlement as a checkpoint.
+    def clear(self):
+        self._transact(lambda: ([('clear', {})], None))
+        self.storage.sync()
+
+    # Reports, straight from the counters
+    # stock(): list of (amount, in stock, price, stock value)
+    def stock(self):
+        with self.lock:
+            self._catch_up()
+            return [(amount, self.totals[amount]['in_stock'], self.prices[amount], self.totals[amount]['stock_value'])
+                    for amount in self.queues]
+
+    # removed(): list of (amount, sold, price, due)
+    def removed(self):
+        with self.lock:
+            self._catch_up()
+            return [(amount, self.totals[amount]['sold'], price, self.totals[amount]['due'])
+                    for amount, price in self.sold_prices.items()]
@@ -0,0 +1,238 @@
+import os
+import json
+import logging
+import struct
+import bisect
+import time
+import threading
+import metrics
+from metrics import timed_storage
+from sold_index import SoldIndex, SOLD_INDEX_FILE, number_to_segment
+
+# Permanent record of every sale, kept apart from used.json (which only holds
+# what is still due). One segment per month, ledger/YYYY-MM.jsonl, one line
+# per code sold:
+#   {"seq": 12, "ts": 1760000000, "amount": 60, "code": "...", "price": 80.0, "user": 1, "channel": 2}
+# Settlements (.clear) are checkpoints in ledger/settlements.jsonl.
+LEDGER_DIR = 'ledger'
+SETTLEMENTS_FILE = 'settlements.jsonl'
+
+# Each segment has a time index, YYYY-MM.idx: the timestamp and byte offset of
+# the first sale of every hour, so a report seeks straight to its start
+INDEX_ENTRY = struct.Struct('<qQ')
+INDEX_SPAN = 3600
+
+
+def segment_name(ts):
+    return time.strftime('%Y-%m', time.localtime(ts))
+
+# Complete lines in the last 4 KB of a file, without reading all of it
+def _tail_lines(file_name):
+    if not os.path.exists(file_name):
+        return []
+    with open(file_name, 'rb') as file:
+        size = file.seek(0, os.SEEK_END)
+        file.seek(max(0, size - 4096))
+        data = file.read()
+    lines = []
+    for line in data.split(b'\n')[1 if size > 4096 else 0:-1]:
+        try:
+            lines.append(json.loads(line))
+        except json.JSONDecodeError:
+            continue
+    return lines
+
+def _last_line(file_name):
+    lines = _tail_lines(file_name)
+    return lines[-1] if lines else None
+
+
+class Ledger:
+    def __init__(self, directory=LEDGER_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.settlements_file = os.path.join(directory, SETTLEMENTS_FILE)
+        self.lock = threading.Lock()
+        self.unsynced = set()
+        self.pending = []
+        self.index = SoldIndex(os.path.join(directory, SOLD_INDEX_FILE))
+
+    def _path(self, name, extension):
+        return os.path.join(self.directory, f"{name}.{extension}")
+
+    def segment_path(self, name):
+        return self._path(name, 'jsonl')
+
+    def segments(self):
+        return sorted(name[:-6] for name in os.listdir(self.directory)
+                      if name.endswith('.jsonl') and name != SETTLEMENTS_FILE)
+
+    # Sequence number of the newest journal record already in the ledger. A
+    # retried write can land after newer lines, so the tail is searched.
+    def last_seq(self):
+        seq = 0
+        segments = self.segments()
+        for file_name in ([self._path(segments[-1], 'jsonl')] if segments else []) + [self.settlements_file]:
+            seq = max([seq] + [line['seq'] for line in _tail_lines(file_name)])
+        return seq
+
+    # Whether every record given to append() is in the ledger
+    def caught_up(self):
+        return not self.pending
+
+    # Add the sales and settlements among journal records. Callers hold the
+    # store's lock, so lines are in seq and time order across instances.
+    # If a write fails, the files are cut back and the records wait in
+    # `pending` to be written first by the next append, which can be empty.
+    # Returns whether everything up to these records is in the ledger.
+    @timed_storage('ledger_append')
+    def append(self, records):
+        records = self.pending + [record for record in records if record['op'] in ('sold', 'clear')]
+        if not records:
+            return True
+        sales = {}
+        settlements = []
+        for record in records:
+            if record['op'] == 'sold':
+                lines = sales.setdefault(segment_name(record['ts']), [])
+                for code in record['codes']:
+                    lines.append({"seq": record['seq'], "ts": record['ts'], "amount": record['amount'], "code": code,
+                                  "price": record.get('price') or 0, "user": record.get('user'),
+                                  "channel": record.get('channel')})
+            elif record['op'] == 'clear':
+                settlements.append({"seq": record['seq'], "ts": record['ts']})
+
+        written = []
+        try:
+            for name, lines in sales.items():
+                self._write_segment(name, lines, written)
+            if settlements:
+                self._write(self.settlements_file, "".join(json.dumps(line) + "\n" for line in settlements).encode(),
+                            written)
+        except OSError as e:
+            logging.error(f"Error writing sales ledger, {len(records)} records will be retried: {e}")
+            for file_name, size in written:
+                try:
+                    os.truncate(file_name, size)
+                except OSError as e:
+                    logging.error(f"Error cutting back {file_name}: {e}")
+            self.pending = records
+            return False
+        self.pending = []
+        with self.lock:
+            self.unsynced.update(file_name for file_name, _ in written)
+        if sales:
+            self.update_index()
+        return True
+
+    # Append data to a file, noting its size before in `written`
+    @staticmethod
+    def _write(file_name, data, written):
+        with open(file_name, 'ab') as file:
+            written.append((file_name, file.seek(0, os.SEEK_END)))
+            file.write(data)
+
+    def _write_segment(self, name, lines, written):
+        index_name = self._path(name, 'idx')
+        last_indexed = None
+        if os.path.exists(index_name) and os.path.getsize(index_name) >= INDEX_ENTRY.size:
+            with open(index_name, 'rb') as file:
+                file.seek(-INDEX_ENTRY.size, os.SEEK_END)
+                last_indexed = INDEX_ENTRY.unpack(file.read())[0] // INDEX_SPAN
+
+        segment = self._path(name, 'jsonl')
+        offset = os.path.getsize(segment) if os.path.exists(segment) else 0
+        entries = []
+        data = bytearray()
+        for line in lines:
+            if line['ts'] // INDEX_SPAN != last_indexed:
+                last_indexed = line['ts'] // INDEX_SPAN
+                entries.append(INDEX_ENTRY.pack(line['ts'], offset + len(data)))
+            data += (json.dumps(line) + "\n").encode()
+        self._write(segment, data, written)
+        metrics.storage_bytes_written.observe(len(data), op='ledger_append')
+        if entries:
+            self._write(index_name, b''.join(entries), written)
+
+    # Bring the sold code index up to date with the ledger, e.g. after an
+    # upgrade or a crash. Callers hold the store's lock.
+    def update_index(self):
+        try:
+            self.index.update(self)
+        except (IOError, ValueError) as e:
+            logging.error(f"Error updating the sold code index: {e}")
+
+    # Sales of one code, found through the sold code index
+    @timed_storage('ledger_lookup')
+    def lookup(self, code):
+        sales = []
+        for segment, offset in self.index.find(code):
+            try:
+                with open(self.segment_path(number_to_segment(segment)), 'rb') as file:
+                    file.seek(offset)
+                    sale = json.loads(file.readline())
+            except (FileNotFoundError, json.JSONDecodeError):
+                continue
+            if sale.get('code') == code:
+                sales.append(sale)
+        return sales
+
+    def close(self):
+        self.index.close()
+
+    # fsync what has been written since the last sync. The journal is enough
+    # to rebuild recent lines, so this only has to happen before the journal
+    # is compacted.
+    @timed_storage('ledger_sync')
+    def sync(self):
+        with self.lock:
+            files, self.unsynced = self.unsynced, set()
+        for file_name in files:
+            if not os.path.exists(file_name):
+                continue
+            with open(file_name, 'rb') as file:
+                os.fsync(file.fileno())
+
+    # Byte offset in a segment to start reading sales at `start`
+    def _seek_offset(self, name, start):
+        index_name = self._path(name, 'idx')
+        if not os.path.exists(index_name):
+            return 0
+        with open(index_name, 'rb') as file:
+            entries = [INDEX_ENTRY.unpack_from(data) for data in iter(lambda: file.read(INDEX_ENTRY.size), b'')
+                       if len(data) == INDEX_ENTRY.size]
+        position = bisect.bisect_right([ts for ts, _ in entries], start) - 1
+        return entries[position][1] if position >= 0 else 0
+
+    # Sales with start <= ts < end, streamed from disk. after_seq skips sales
+    # journaled before a settlement in the same second.
+    def sales(self, start, end, after_seq=0):
+        first, last = segment_name(start), segment_name(end - 1)
+        for name in self.segments():
+            if not first <= name <= last:
+                continue
+            with open(self._path(name, 'jsonl'), 'rb') as file:
+                file.seek(self._seek_offset(name, start))
+                for line in file:
+                    try:
+                        sale = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if sale['ts'] >= end:
+                        return
+                    if sale['ts'] >= start and sale['seq'] > after_seq:
+                        yield sale
+
+    # Totals per amount for sales in [start, end): {amount: (count, value)}
+    @timed_storage('ledger_report')
+    def report(self, start, end, after_seq=0):
+        totals = {}
+        for sale in self.sales(start, end, after_seq):
+            count, value = totals.get(sale['amount'], (0, 0))
+            totals[sale['amount']] = (count + 1, value + sale['price'])
+        return totals
+
+    # (ts, seq) of the last settlement, or (0, 0)
+    def last_settlement(self):
+        line = _last_line(self.settlements_file)
+        return (line['ts'], line['seq']) if line else (0, 0)
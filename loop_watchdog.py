@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import logging.handlers
+import os
+import sys
+import threading
+import time
+import traceback
+import metrics
+
+# Opt-in event loop watchdog. A heartbeat task on the loop wakes every
+# STALL_THRESHOLD / 4 seconds; the lag between when it should and when it
+# did wake is how long something blocked the loop. A thread watches the
+# heartbeat, and when it is more than STALL_THRESHOLD seconds late it takes
+# the loop thread's stack, so the log shows what was blocking, not just that
+# something was. Unset STALL_THRESHOLD to turn it off.
+STALL_THRESHOLD = float(os.getenv('STALL_THRESHOLD', 0))
+
+# Stalls go to a rotating log, STALL_LOG_BYTES per file, STALL_LOG_BACKUPS old files kept
+STALL_LOG = os.getenv('STALL_LOG', 'stalls.log')
+STALL_LOG_BYTES = int(os.getenv('STALL_LOG_BYTES', 1024 * 1024))
+STALL_LOG_BACKUPS = int(os.getenv('STALL_LOG_BACKUPS', 3))
+
+# Stack frames kept per stall
+STACK_DEPTH = 30
+
+
+def _stall_logger(file_name):
+    logger = logging.getLogger('stalls')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    if not logger.handlers:
+        handler = logging.handlers.RotatingFileHandler(file_name, maxBytes=STALL_LOG_BYTES,
+                                                       backupCount=STALL_LOG_BACKUPS, encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        logger.addHandler(handler)
+    return logger
+
+# "file:line in function" of the innermost frame from our own code, which is
+# usually the line to fix even when the time is spent inside a library
+def _blocking_site(stack):
+    here = os.path.dirname(os.path.abspath(__file__))
+    for frame in reversed(stack):
+        if os.path.abspath(frame.filename).startswith(here):
+            return f"{os.path.basename(frame.filename)}:{frame.lineno} in {frame.name}"
+    if stack:
+        frame = stack[-1]
+        return f"{os.path.basename(frame.filename)}:{frame.lineno} in {frame.name}"
+    return "unknown"
+
+
+class StallWatchdog:
+    def __init__(self, threshold=STALL_THRESHOLD, log_file=STALL_LOG):
+        self.threshold = threshold
+        self.interval = threshold / 4
+        self.log = _stall_logger(log_file)
+        self.lock = threading.Lock()
+        self.loop = None
+        self.loop_thread = None
+        self.last_beat = time.monotonic()
+        self.captured = None
+        self.commands = {}
+        # (command, blocking site) -> [count, total seconds, longest]
+        self.sites = {}
+        self.stalls = 0
+        self.longest = 0
+
+    def start(self, loop):
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.last_beat = time.monotonic()
+        loop.create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name="stall-watchdog", daemon=True).start()
+        logging.info(f"Event loop watchdog on, reporting stalls over {self.threshold * 1000:.0f} ms to {self.log.handlers[0].baseFilename}")
+
+    # Commands in flight, by task, so a stall can be blamed on one
+    def command_started(self, description):
+        task = asyncio.current_task()
+        with self.lock:
+            self.commands[task] = description
+
+    def command_finished(self):
+        task = asyncio.current_task()
+        with self.lock:
+            self.commands.pop(task, None)
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            metrics.loop_lag_seconds.observe(lag)
+            with self.lock:
+                self.last_beat = now
+                captured, self.captured = self.captured, None
+            if lag >= self.threshold:
+                self._record(lag, captured)
+
+    # Watcher thread: take the loop's stack while it is still blocked
+    def _watch(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                late = time.monotonic() - self.last_beat - self.interval
+                if late < self.threshold or self.captured is not None:
+                    continue
+                frame = sys._current_frames().get(self.loop_thread)
+                stack = traceback.extract_stack(frame, limit=STACK_DEPTH) if frame is not None else []
+                self.captured = (stack, self._running_command())
+
+    # The command whose task is running on the loop, or every command in
+    # flight if that cannot be told. Call with self.lock held.
+    def _running_command(self):
+        current = getattr(asyncio.tasks, '_current_tasks', {}).get(self.loop)
+        if current in self.commands:
+            return self.commands[current]
+        return ", ".join(self.commands.values()) or None
+
+    def _record(self, lag, captured):
+        stack, command = captured if captured else ([], None)
+        site = _blocking_site(stack) if stack else "not captured (stall ended before the watchdog looked)"
+        with self.lock:
+            self.stalls += 1
+            self.longest = max(self.longest, lag)
+            entry = self.sites.setdefault((command or "no command", site), [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += lag
+            entry[2] = max(entry[2], lag)
+
+        message = f"Event loop blocked for {lag * 1000:.0f} ms during {command or 'no command'} at {site}"
+        logging.warning(message)
+        self.log.warning(message + ("\n" + "".join(traceback.format_list(stack)) if stack else ""))
+
+    # Short report for the .stalls command
+    def summary(self, top=5):
+        with self.lock:
+            if not self.stalls:
+                return f"No event loop stalls over {self.threshold * 1000:.0f} ms."
+            result = [f"{self.stalls} stalls over {self.threshold * 1000:.0f} ms, longest {self.longest * 1000:.0f} ms",
+                      "Worst (command, where, count, total, longest):"]
+            worst = sorted(self.sites.items(), key=lambda item: item[1][1], reverse=True)[:top]
+            for (command, site), (count, total, longest) in worst:
+                result.append(f"  {command} @ {site}: {count}, {total * 1000:.0f} ms, {longest * 1000:.0f} ms")
+        for labels, count, total, p50, p95 in metrics.loop_lag_seconds.stats():
+            result.append(f"Loop lag: ≤{p50 * 1000:g} ms p50, ≤{p95 * 1000:g} ms p95 over {count} beats")
+        result.append(f"Stacks: {self.log.handlers[0].baseFilename}")
+        return "\n".join(result)
@@ -0,0 +1,187 @@
+import os
+import logging
+import threading
+import time
+import functools
+
+# Prometheus text-format file, rewritten every METRICS_INTERVAL seconds.
+# Point node_exporter's textfile collector at it, or just read it.
+METRICS_FILE = os.getenv('METRICS_FILE', 'metrics.prom')
+METRICS_INTERVAL = float(os.getenv('METRICS_INTERVAL', 15))
+
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+
+
+def _label_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_label_text(key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.series = {}  # labels -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            else:
+                series[len(self.buckets)] += 1
+            series[-1] += value
+
+    # Time a block: with histogram.time(command="baki"): ...
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    # Upper bucket bound below which `fraction` of observations fall
+    def quantile(self, fraction, key):
+        series = self.series[key]
+        total = sum(series[:-1])
+        seen = 0
+        for i, bound in enumerate(self.buckets):
+            seen += series[i]
+            if seen >= fraction * total:
+                return bound
+        return float('inf')
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, series in sorted(self.series.items()):
+                cumulative = 0
+                for i, bound in enumerate(self.buckets):
+                    cumulative += series[i]
+                    lines.append(f"{self.name}_bucket{_label_text(key + (('le', bound),))} {cumulative}")
+                cumulative += series[len(self.buckets)]
+                lines.append(f"{self.name}_bucket{_label_text(key + (('le', '+Inf'),))} {cumulative}")
+                lines.append(f"{self.name}_sum{_label_text(key)} {series[-1]}")
+                lines.append(f"{self.name}_count{_label_text(key)} {cumulative}")
+        return lines
+
+    # (labels, count, sum, p50, p95) for every series
+    def stats(self):
+        with self.lock:
+            return [(dict(key), sum(series[:-1]), series[-1], self.quantile(0.5, key), self.quantile(0.95, key))
+                    for key, series in sorted(self.series.items())]
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+command_seconds = Histogram('bot_command_seconds', "Time spent handling each bot command")
+command_errors = Counter('bot_command_errors_total', "Bot commands that raised an error")
+storage_seconds = Histogram('bot_storage_seconds', "Time spent in storage calls, including file I/O")
+storage_bytes_read = Histogram('bot_storage_bytes_read', "Bytes read per storage call", BYTES_BUCKETS)
+storage_bytes_written = Histogram('bot_storage_bytes_written', "Bytes written per storage call", BYTES_BUCKETS)
+discord_send_seconds = Histogram('bot_discord_send_seconds', "Latency of sending a message to Discord")
+loop_lag_seconds = Histogram('bot_event_loop_lag_seconds', "How late the event loop ran the watchdog heartbeat")
+
+ALL_METRICS = [command_seconds, command_errors, storage_seconds, storage_bytes_read,
+               storage_bytes_written, discord_send_seconds, loop_lag_seconds]
+
+
+# Decorator: time every call of a storage function
+def timed_storage(op):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with storage_seconds.time(op=op):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def render():
+    lines = []
+    for metric in ALL_METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+def _format_bytes(value):
+    for unit in ('B', 'KiB', 'MiB'):
+        if value < 1024:
+            return f"{value:.0f} {unit}"
+        value /= 1024
+    return f"{value:.1f} GiB"
+
+# Short human-readable report for the .metrics command
+def summary():
+    result = ["Commands (count, avg, p50, p95):"]
+    for labels, count, total, p50, p95 in command_seconds.stats():
+        result.append(f"  {labels.get('command')}: {count}, {total / count * 1000:.1f} ms, "
+                      f"≤{p50 * 1000:g} ms, ≤{p95 * 1000:g} ms")
+    result.append("Storage (count, avg, p95):")
+    for labels, count, total, _, p95 in storage_seconds.stats():
+        result.append(f"  {labels.get('op')}: {count}, {total / count * 1000:.2f} ms, ≤{p95 * 1000:g} ms")
+    for name, histogram in (('read', storage_bytes_read), ('written', storage_bytes_written)):
+        total = sum(stat[2] for stat in histogram.stats())
+        result.append(f"Bytes {name}: {_format_bytes(total)}")
+    for labels, count, total, _, p95 in discord_send_seconds.stats():
+        result.append(f"Discord send: {count}, {total / count * 1000:.1f} ms avg, ≤{p95 * 1000:g} ms p95")
+    errors = sum(command_errors.values.values())
+    if errors:
+        result.append(f"Command errors: {errors}")
+    return "\n".join(result)
+
+
+def write_file(file_name=METRICS_FILE):
+    temp_name = file_name + '.tmp'
+    try:
+        with open(temp_name, 'w') as file:
+            file.write(render())
+        os.replace(temp_name, file_name)
+    except OSError as e:
+        logging.error(f"Error writing metrics file: {e}")
+
+# Rewrite the Prometheus file in the background
+def start_exporter(file_name=METRICS_FILE, interval=METRICS_INTERVAL):
+    def loop():
+        while True:
+            time.sleep(interval)
+            write_file(file_name)
+
+    thread = threading.Thread(target=loop, name="metrics-exporter", daemon=True)
+    thread.start()
+    return thread
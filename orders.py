@@ -0,0 +1,127 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+import engine
+
+# Orders that cannot be filled from stock wait in a queue per amount, up to
+# ORDER_QUEUE_SIZE orders (0 turns queueing off), at most ORDER_QUEUE_PER_USER
+# of them from one user. They are served first come, first served when codes
+# for that amount are uploaded.
+ORDER_QUEUE_SIZE = int(os.getenv('ORDER_QUEUE_SIZE', 50))
+ORDER_QUEUE_PER_USER = int(os.getenv('ORDER_QUEUE_PER_USER', 2))
+
+
+class QueuedOrder:
+    def __init__(self, amount, count, user, channel, destination):
+        self.amount = amount
+        self.count = count
+        self.user = user
+        self.channel = channel
+        self.destination = destination
+        self.queued_at = time.time()
+        # Being sold by fill() right now, so it can no longer be cancelled
+        self.in_flight = False
+
+
+# Waiting orders of one shard, one FIFO per amount. Callers hold the shard's
+# lock for the amount around add() and fill(), so orders for one amount are
+# queued and filled one at a time.
+class OrderQueue:
+    def __init__(self, size=ORDER_QUEUE_SIZE, per_user=ORDER_QUEUE_PER_USER):
+        self.size = size
+        self.per_user = per_user
+        self.lock = threading.Lock()
+        self.queues = {}
+
+    def enabled(self):
+        return self.size > 0
+
+    def waiting(self, amount=None):
+        with self.lock:
+            if amount is None:
+                return sum(len(queue) for queue in self.queues.values())
+            return len(self.queues.get(amount, ()))
+
+    # Queue an order. Returns (order, None), or (None, reason) if the queue
+    # is full or the user already has their share of it.
+    def add(self, amount, count, user, channel, destination):
+        with self.lock:
+            queue = self.queues.setdefault(amount, deque())
+            if len(queue) >= self.size:
+                return None, f"The {amount} UC queue is full ({self.size} orders), try again later."
+            if sum(1 for order in queue if order.user == user) >= self.per_user:
+                return None, f"You already have {self.per_user} orders waiting for {amount} UC."
+            order = QueuedOrder(amount, count, user, channel, destination)
+            queue.append(order)
+            position = len(queue)
+        logging.info(f"Queued order for {count} x {amount}uc from {user} at position {position}")
+        return order, None
+
+    # 1-based place of an order in its queue, or None once it left it
+    def position(self, order):
+        with self.lock:
+            queue = self.queues.get(order.amount, ())
+            return queue.index(order) + 1 if order in queue else None
+
+    # Fill waiting orders for an amount from stock, oldest first, stopping at
+    # the first one there are not enough codes for so nobody is overtaken.
+    # Returns [(order, order text)].
+    def fill(self, inventory, amount):
+        filled = []
+        while True:
+            with self.lock:
+                queue = self.queues.get(amount)
+                if not queue:
+                    break
+                order = queue[0]
+                order.in_flight = True
+            try:
+                result, short = engine.process_basket(inventory, [(amount, order.count)], order.user, order.channel)
+            except BaseException:
+                order.in_flight = False
+                raise
+            with self.lock:
+                if short:
+                    order.in_flight = False
+                    break
+                self._remove(amount, order)
+            filled.append((order, result))
+        if filled:
+            logging.info(f"Filled {len(filled)} queued orders for {amount}uc")
+        return filled
+
+    # Call with self.lock held
+    def _remove(self, amount, order):
+        queue = self.queues.get(amount)
+        if queue and order in queue:
+            queue.remove(order)
+            if not queue:
+                del self.queues[amount]
+
+    # Remove a user's waiting orders, except one being filled right now.
+    # Returns how many were removed.
+    def cancel(self, user):
+        with self.lock:
+            mine = [(amount, order) for amount, queue in self.queues.items() for order in queue
+                    if order.user == user and not order.in_flight]
+            for amount, order in mine:
+                self._remove(amount, order)
+        return len(mine)
+
+    # Take every waiting order out of the queue, except one being filled
+    # right now. Returns them, oldest first per amount.
+    def drain(self):
+        with self.lock:
+            drained = [order for queue in self.queues.values() for order in queue if not order.in_flight]
+            for order in drained:
+                self._remove(order.amount, order)
+        return drained
+
+    # A user's waiting orders as (amount, count, position)
+    def positions(self, user):
+        with self.lock:
+            return [(amount, order.count, position)
+                    for amount, queue in self.queues.items()
+                    for position, order in enumerate(queue, 1) if order.user == user]
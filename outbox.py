@@ -0,0 +1,124 @@
+import asyncio
+import os
+import re
+import time
+import metrics
+from collections import defaultdict, deque
+
+# Discord rejects messages longer than this
+MESSAGE_LIMIT = 2000
+
+# Client-side limit per channel, matching Discord's bucket of 5 messages per 5 seconds
+CHANNEL_RATE = int(os.getenv('CHANNEL_RATE', 5))
+CHANNEL_PER = float(os.getenv('CHANNEL_PER', 5))
+
+CODE_BLOCK = re.compile(r'```.*?```', re.S)
+
+
+# Sliding-window limiter: wait until `key` has sent fewer than `rate` messages
+# in the last `per` seconds
+class RateLimiter:
+    def __init__(self, rate=CHANNEL_RATE, per=CHANNEL_PER):
+        self.rate = rate
+        self.per = per
+        self.sent = defaultdict(deque)
+        self.locks = defaultdict(asyncio.Lock)
+
+    async def wait(self, key):
+        async with self.locks[key]:
+            sent = self.sent[key]
+            now = time.monotonic()
+            while sent and now - sent[0] >= self.per:
+                sent.popleft()
+            if len(sent) >= self.rate:
+                await asyncio.sleep(self.per - (now - sent[0]))
+                sent.popleft()
+            sent.append(time.monotonic())
+
+limiter = RateLimiter()
+
+
+# Split text into pieces that never cut through a code block
+def _pieces(text):
+    position = 0
+    for match in CODE_BLOCK.finditer(text):
+        if match.start() > position:
+            yield text[position:match.start()]
+        yield match.group()
+        position = match.end()
+    if position < len(text):
+        yield text[position:]
+
+# Break one piece that is too long on its own, at line ends where possible
+def _split_long(piece, limit):
+    fence = '```' if piece.startswith('```') and piece.endswith('```') else ''
+    body = piece[len(fence):len(piece) - len(fence)] if fence else piece
+    room = limit - 2 * len(fence)
+    chunk = ''
+    for line in body.splitlines(keepends=True):
+        while len(line) > room:
+            if chunk:
+                yield fence + chunk + fence
+                chunk = ''
+            yield fence + line[:room] + fence
+            line = line[room:]
+        if len(chunk) + len(line) > room:
+            yield fence + chunk + fence
+            chunk = ''
+        chunk += line
+    if chunk:
+        yield fence + chunk + fence
+
+# Pack text into as few messages as possible, splitting only between code blocks
+def chunk_message(text, limit=MESSAGE_LIMIT):
+    chunks = []
+    current = ''
+    for piece in _pieces(text):
+        for part in ([piece] if len(piece) <= limit else _split_long(piece, limit)):
+            if len(current) + len(part) > limit:
+                chunks.append(current)
+                current = part if part.startswith('```') else part.lstrip('\n')
+            else:
+                current += part
+    if current.strip():
+        chunks.append(current)
+    return [chunk for chunk in chunks if chunk.strip()]
+
+
+# Collects everything a command wants to say and sends it as few messages
+# as possible when flushed (or when the `async with` block ends)
+class Outbox:
+    def __init__(self, destination):
+        self.destination = destination
+        self.parts = []
+
+    def add(self, text):
+        self.parts.append(text)
+
+    async def flush(self):
+        text = "\n".join(self.parts)
+        self.parts = []
+        for chunk in chunk_message(text):
+            await send_message(self.destination, chunk)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.flush()
+
+
+# Send one message (with an attachment, say) within the channel's rate limit.
+# Every message the bot sends goes through here, so all of them are timed.
+async def send_message(destination, content=None, **kwargs):
+    channel = getattr(destination, 'channel', destination)
+    await limiter.wait(getattr(channel, 'id', id(channel)))
+    start = time.perf_counter()
+    await destination.send(content, **kwargs)
+    metrics.discord_send_seconds.observe(time.perf_counter() - start)
+
+# Send text of any length to a channel or context
+async def send_chunked(destination, text):
+    outbox = Outbox(destination)
+    outbox.add(text)
+    await outbox.flush()
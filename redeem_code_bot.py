@@ -1,224 +1,44 @@
-
-
+import argparse
 import json
 import os
+import sys
 import logging
-import re
+import shutil
+import tempfile
+import time
+from inventory import Inventory
+from storage import FILE_NAME, REMOVED_FILE_NAME, TOTAL_DUE_FILE, JOURNAL_FILE, STOCK_BIN_FILE, DB_FILE, PRICE_FILE
+from code_index import SEEN_FILE
+from ledger import LEDGER_DIR
+from orders import OrderQueue
+from engine import CODE_PATTERN, parse_amount, parse_order
+import engine
+import export
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 
-# Constants
-FILE_NAME = 'codes.json'
-REMOVED_FILE_NAME = 'used.json'
+# Everything --script copies into its scratch directory
+DATA_FILES = [FILE_NAME, REMOVED_FILE_NAME, TOTAL_DUE_FILE, JOURNAL_FILE, STOCK_BIN_FILE, DB_FILE, SEEN_FILE, PRICE_FILE]
 
-# Load codes from JSON file
-def load_codes(file_name=FILE_NAME):
-    if os.path.exists(file_name):
-        try:
-            with open(file_name, 'r') as file:
-                return json.load(file)
-        except json.JSONDecodeError:
-            logging.error("JSON file is corrupted. Resetting to empty data.")
-            return {"codes": []}
-    return {"codes": []}
-
-# Save codes to JSON file
-def save_codes(data, file_name=FILE_NAME):
-    try:
-        with open(file_name, 'w') as file:
-            json.dump(data, file, indent=4)
-    except IOError as e:
-        logging.error(f"Error saving file: {e}")
-
-# Add codes grouped by amount
-def add_codes(amount, codes, file_name=FILE_NAME):
-    data = load_codes(file_name)
-    group = next((item for item in data['codes'] if item['amount'] == amount), None)
-    
-    if not group:
-        group = {"amount": amount, "codes": [], "price": 0}
-        data['codes'].append(group)
-    
-    existing_codes = {code['code'] for code in group['codes']}
-    new_codes = []
-
-    for code in codes:
-        if code.strip() not in existing_codes:
-            new_codes.append({"code": code.strip(), "redeemed": False})
-            existing_codes.add(code.strip())
-        else:
-            logging.warning(f"Duplicate code detected: {code.strip()}")
-
-    group['codes'].extend(new_codes)
-    
-    save_codes(data, file_name)
-    logging.info(f"Added {len(new_codes)} codes for amount: {amount}")
-
-# Set price for a specific amount in both files
-def set_price(amount, price, file_name=FILE_NAME):
-    data = load_codes(file_name)
-    group = next((item for item in data['codes'] if item['amount'] == amount), None)
-    
-    if not group:
-        logging.warning(f"No codes available for amount: {amount}")
-        return
-    
-    group['price'] = price
-    save_codes(data, file_name)
-    logging.info(f"Set price for {amount}uc codes to {price}")
-
-    # Also set price in used.json
-    if file_name != REMOVED_FILE_NAME:
-        data_used = load_codes(REMOVED_FILE_NAME)
-        group_used = next((item for item in data_used['codes'] if item['amount'] == amount), None)
-        
-        if group_used:
-            group_used['price'] = price
-            save_codes(data_used, REMOVED_FILE_NAME)
-            logging.info(f"Set price for {amount}uc codes to {price} in {REMOVED_FILE_NAME}")
-
-# Move used codes to used.json
-def move_used_codes(used_codes, amount, destination_file=REMOVED_FILE_NAME):
-    destination_data = load_codes(destination_file)
-
-    if 'codes' not in destination_data:
-        destination_data['codes'] = []
-
-    destination_group = next((item for item in destination_data['codes'] if item['amount'] == amount), None)
-    if not destination_group:
-        destination_group = {"amount": amount, "codes": [], "price": 0}  # Include price field
-        destination_data['codes'].append(destination_group)
-    
-    # Include price from codes.json
-    source_data = load_codes(FILE_NAME)
-    source_group = next((item for item in source_data['codes'] if item['amount'] == amount), None)
-    if source_group:
-        destination_group['price'] = source_group.get('price', 0)
-        
-    destination_group['codes'].extend(used_codes)
-    save_codes(destination_data, destination_file)
-    print(f"Moved {len(used_codes)} used codes to {destination_file}")
-
-# Get and mark codes as redeemed
-def get_codes(amount, count=1, source_file=FILE_NAME):
-    data = load_codes(source_file)
-    group = next((item for item in data['codes'] if item['amount'] == amount), None)
-    
-    if not group:
-        logging.warning(f"No codes available for amount: {amount}")
-        return None
-    
-    available_codes = [code for code in group['codes'] if not code['redeemed']]
-    if len(available_codes) < count:
-        logging.warning(f"Not enough available {amount}uc codes.")
-        return None
-
-    selected_codes = available_codes[:count]
-    for code in selected_codes:
-        code['redeemed'] = True
-    
-    used_codes = [code for code in selected_codes if code['redeemed']]
-    move_used_codes(used_codes, amount)
-    
-    group['codes'] = [code for code in group['codes'] if not code['redeemed']]
-    save_codes(data, source_file)
-    
-    return [code['code'] for code in selected_codes]
-
-# Check stock of codes with total sum
-def check_stock(file_name=FILE_NAME):
-    data = load_codes(file_name)
-    if not data['codes']:
-        print("No codes available.")
-        return
-    
-    total_sum = 0
-    result = []
-    for group in data['codes']:
-        amount = group['amount']
-        available_codes = len([code for code in group['codes'] if not code['redeemed']])
-        price = group.get('price', 0)
-        total_value = price * available_codes
-        total_sum += total_value
-        result.append(f"{amount} 🆄︎ 🅲︎ ➪  {available_codes} pcs")
-
-    result.append(f"\nWᴏʀᴛʜ Oғ : {total_sum} tk")
-    print("\n".join(result))
-
-# Remove used codes and transfer to used.json
-def remove_used_codes(source_file=FILE_NAME, destination_file=REMOVED_FILE_NAME):
-    source_data = load_codes(source_file)
-    destination_data = load_codes(destination_file)
-
-    if 'codes' not in destination_data:
-        destination_data['codes'] = []
-
-    for group in source_data['codes']:
-        used_codes = [code for code in group['codes'] if code['redeemed']]
-        if used_codes:
-            destination_group = next((item for item in destination_data['codes'] if item['amount'] == group['amount']), None)
-            if not destination_group:
-                destination_group = {"amount": group['amount'], "codes": [], "price": 0}  # Include price field
-                destination_data['codes'].append(destination_group)
-            
-            # Include price from codes.json
-            destination_group['price'] = group.get('price', 0)
-            
-            destination_group['codes'].extend(used_codes)
-            group['codes'] = [code for code in group['codes'] if not code['redeemed']]
-
-    save_codes(source_data, source_file)
-    save_codes(destination_data, destination_file)
-    print("Removed all used codes and saved them to used.json")
-
-# Clear all codes from used.json
-def clear_removed_codes(file_name=REMOVED_FILE_NAME):
-    empty_data = {"codes": []}
-    save_codes(empty_data, file_name)
-    print(f"Cleared all codes from {file_name}")
-
-# Check number of codes in used.json grouped by amount with pricing
-def check_removed_codes(file_name=REMOVED_FILE_NAME):
-    data = load_codes(file_name)
-    if not data['codes']:
-        print("No codes available in used.json.")
-        return
 
-    result = []
-    total_sum = 0
-    for group in data['codes']:
-        amount = group['amount']
-        count = len(group['codes'])
-        price = group.get('price', 0)  # Get price from the group or default to 0
-        total_value = price * count
-        total_sum += total_value
-        result.append(f"{amount} 🆄︎ 🅲︎ ➪ {count} pcs")
-    
-    result.append(f"\nTotal due: {total_sum} tk")
-    print("\n".join(result))
-
-# Show prices for all existing UC amounts in codes.json
-def show_prices():
-    data = load_codes(FILE_NAME)
-    
-    if not data['codes']:
-        logging.warning("No UC codes available in the database.")
-        return
-    
-    for group in data['codes']:
-        amount = group['amount']
-        price = group.get('price', 0)
-        
-        if price > 0:
-            print(f"☞︎︎︎ {amount} 🆄︎ 🅲︎ ➪ {price} Bᴀɴᴋ")
-        else:
-            logging.warning(f"No price set for {amount}uc")
+# Short orders wait in `orders` like in the bot; orders filled from the queue
+# are shown after the reply
+def order(inventory, items, orders=None, user=None, channel=None):
+    reply, filled = engine.place_order(inventory, orders, items, user, channel)
+    return "\n".join(([reply] if reply else []) + delivered(filled) + engine.stock_alerts(inventory))
+
+def delivered(filled):
+    return [engine.queued_order_message(order, result) for order, result in filled]
+
+# Main function to process commands. Returns the text to show, if any.
+# `orders` is the order queue, `user` and `channel` who sent the command.
+def process_command(inventory, command, orders=None, user=None, channel=None):
+    if command.startswith("."):
+        return process_bot_command(inventory, command[1:], orders, user, channel)
 
-# Main function to process commands
-def process_command(command):
     if command == "rate":
-        show_prices()
+        return engine.show_prices(inventory)
 
     elif command.startswith("up"):
         parts = command.split(' ', 2)
@@ -226,100 +46,261 @@ def process_command(command):
             logging.error("Invalid command format. Use: up <amount>uc <codes>")
             return
 
-        amount_code, codes = parts[1], parts[2]
-        try:
-            amount = int(amount_code[:-2])
-        except ValueError:
+        amount = parse_amount(parts[1])
+        if amount is None:
             logging.error("Invalid amount format. Please provide a valid number before 'uc'.")
             return
 
         # Extract each code using a flexible pattern
-        pattern = r'[a-zA-Z]{4}-[a-zA-Z]-S-\d{8} \d{4}-\d{4}-\d{4}-\d{4}'
-        clean_codes = re.findall(pattern, codes)
+        clean_codes = CODE_PATTERN.findall(parts[2])
 
         if not clean_codes:
             logging.error("No valid codes found.")
             return
 
-        add_codes(amount, clean_codes)
+        messages = engine.add_codes(inventory, amount, clean_codes)
+        filled = engine.fill_orders(inventory, orders, amount)
+        if filled:
+            messages += delivered(filled) + engine.stock_alerts(inventory)
+        return "\n".join(messages)
 
     elif command == "stock":
-        check_stock()  # Updated to include total sum
+        return engine.check_stock(inventory)  # Updated to include total sum
 
     elif command == "remove codes":
-        remove_used_codes()
+        # Codes leave stock as they are sold, so there is nothing left to move
+        return "Used codes are moved to used.json as they are sold."
 
     elif command == "remove":
-        clear_removed_codes()
+        inventory.clear()
+        return "Cleared all dues ✅ ✅."
 
     elif command == "check":
-        check_removed_codes()  # Updated to include pricing info and total sum
+        return engine.check_removed_codes(inventory)  # Updated to include pricing info and total sum
+
+    elif command == "report" or command.startswith("report "):
+        return engine.report(inventory, command.split()[1:])
+
+    elif command == "lookup" or command.startswith("lookup "):
+        return engine.lookup(inventory, command[len("lookup"):])
 
     elif command.startswith("set price"):
         parts = command.split()
         if len(parts) != 4:
             logging.error("Invalid command format. Use: set price <amount>uc <price>")
+            return
+        amount = parse_amount(parts[2])
         try:
-            amount = int(parts[2][:-2])
             price = float(parts[3])
         except ValueError:
+            price = None
+        if amount is None or price is None:
             logging.error("Invalid amount or price format. Please provide valid numbers.")
             return
 
-        set_price(amount, price)
+        if inventory.set_price(amount, price):
+            return f"✅ Price for {amount} UC set to {price}."
 
     elif command.endswith("uc"):
-        try:
-            amount = int(command[:-2])
-            count = 1
-        except ValueError:
+        amount = parse_amount(command)
+        if amount is None:
             logging.error("Invalid amount format. Please provide a valid number before 'uc'.")
             return
-        
-        process_order(amount, count)
+
+        return order(inventory, [(amount, 1)], orders, user, channel)
 
     elif "uc" in command:
         parts = command.split()
-        try:
-            amount = int(parts[0][:-2])
-            count = int(parts[1])
-        except (ValueError, IndexError):
+        amount = parse_amount(parts[0])
+        if amount is None or len(parts) < 2 or not parts[1].isdigit():
             logging.error("Invalid command format. Use: <amount>uc <count>")
             return
 
-        process_order(amount, count)
-    
+        return order(inventory, [(amount, int(parts[1]))], orders, user, channel)
+
     else:
         logging.error("Unknown command. Please try again.")
 
-# Function to process orders and generate the desired output format
-def process_order(amount, count):
-    codes = get_codes(amount, count)
-    if codes:
-        codes_output = '\n'.join(codes)
-        total_due = 0
-        price = None
-        
-        data = load_codes(FILE_NAME)
-        group = next((item for item in data['codes'] if item['amount'] == amount), None)
-        if group:
-            price = group.get('price', 0)
-            total_due = price * count
-        
-        print(f"{codes_output}\n\n✓ {amount} 🆄︎🅲︎  x  {count}  ✓")
-        print(f"Tᴏᴛᴀʟ Dᴜᴇ : {price} + ({price}x{count}) = {total_due} tk")
+# Commands in the Discord bot's syntax, e.g. ".baki 60x3 325x2" from a COMMAND_LOG
+def process_bot_command(inventory, command, orders=None, user=None, channel=None):
+    name, _, rest = command.partition(' ')
+    args = rest.split()
+
+    if name == "baki":
+        items = parse_order(args)
+        if not items or any(count < 1 for _, count in items):
+            return "Invalid order. Use: .baki <amount> <count> or .baki 60x3 325x2"
+        return order(inventory, items, orders, user, channel)
+
+    elif name == "up":
+        return process_command(inventory, f"up {rest}", orders, user, channel)
+
+    elif name == "queue":
+        return engine.show_queue(orders, user)
+
+    elif name == "cancel":
+        return engine.cancel_orders(orders, user)
+
+    elif name == "price":
+        if len(args) != 2:
+            logging.error("Invalid command format. Use: .price <amount> <price>")
+            return
+        return process_command(inventory, f"set price {args[0]}uc {args[1]}")
+
+    elif name == "clear":
+        return process_command(inventory, "remove")
+
+    elif name in ("rate", "stock", "check"):
+        return process_command(inventory, name)
+
+    elif name == "report":
+        return engine.report(inventory, args)
+
+    elif name == "lookup":
+        return engine.lookup(inventory, rest)
+
+    elif name == "hi":
+        return "Hi Darling! 😘"
+
     else:
-        logging.warning(f"Not enough available {amount}uc codes.")
+        logging.error(f"Unknown bot command: .{name}")
+
+
+# Commands from a script file: one command per line, or JSONL records with a
+# "command" (or "content") field, such as the COMMAND_LOG written by bot.py.
+# With `guild`, only that guild's records are read. Yields (command, user,
+# channel); plain lines have no user or channel.
+def read_script(file_name, guild=None):
+    with open(file_name, 'r', encoding='utf-8') as file:
+        for number, line in enumerate(file, 1):
+            line = line.strip()
+            if not line:
+                continue
+            if not line.startswith('{'):
+                yield line, None, None
+                continue
+
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                yield line, None, None
+                continue
+            command = record.get('command') or record.get('content')
+            if not isinstance(command, str):
+                logging.warning(f"{file_name}:{number}: no command field, skipped")
+                continue
+            if guild is not None and str(record.get('guild')) != guild:
+                continue
+            if record.get('attachments'):
+                logging.warning(f"{file_name}:{number}: attachments are not replayed")
+            yield command.strip(), record.get('user'), record.get('channel')
+
+# Copy the data files into a fresh directory so a replay never touches them
+def scratch_copy(data_dir):
+    scratch = tempfile.mkdtemp(prefix="replay-")
+    for file_name in DATA_FILES:
+        path = os.path.join(data_dir, file_name)
+        if os.path.exists(path):
+            shutil.copy2(path, scratch)
+    if os.path.isdir(os.path.join(data_dir, LEDGER_DIR)):
+        shutil.copytree(os.path.join(data_dir, LEDGER_DIR), os.path.join(scratch, LEDGER_DIR))
+    return scratch
+
+# Run every command of a script at full speed against a scratch copy of the data
+def run_script(script, data_dir='.', quiet=False, guild=None):
+    script = os.path.abspath(script)
+    scratch = scratch_copy(data_dir)
+    os.chdir(scratch)
+
+    inventory = Inventory()
+    orders = OrderQueue()
+    count = 0
+    start = time.perf_counter()
+    try:
+        for command, user, channel in read_script(script, guild):
+            output = process_command(inventory, command, orders, user, channel)
+            count += 1
+            if output and not quiet:
+                print(output)
+    finally:
+        inventory.stop()
+    elapsed = time.perf_counter() - start
+
+    print(f"Ran {count} commands in {elapsed:.2f} s ({count / elapsed if elapsed else 0:.0f}/s) against {scratch}")
+
+# Stream an export to a file, or to stdout with "-"
+def run_export(kind, dates, output='-', fmt='csv'):
+    inventory = Inventory()
+    try:
+        if output == '-':
+            rows, fields = export.export_rows(inventory, kind, dates)
+            if rows is None:
+                return fields
+            count = export.write_export(sys.stdout, rows, fields, fmt)
+            return f"Exported {count} {kind} rows"
+        count, error = export.export_file(inventory, kind, dates, output, fmt)
+        return error or f"Exported {count} {kind} rows to {output}"
+    finally:
+        inventory.stop()
+
+def run_import(file_name):
+    inventory = Inventory()
+    try:
+        return export.import_rows(inventory, export.read_rows(file_name))
+    finally:
+        inventory.stop()
 
 # Main command system for the bot
 def main():
+    parser = argparse.ArgumentParser(description="Redeem Code Management System")
+    parser.add_argument('--script', help="run the commands in this file (text or JSONL) and exit")
+    parser.add_argument('--data', default='.', help="directory with the data files, e.g. data/<guild id> (--script copies them)")
+    parser.add_argument('--guild', help="only replay JSONL records from this guild id")
+    parser.add_argument('--quiet', action='store_true', help="only print the --script summary")
+    parser.add_argument('--export', choices=['stock', 'sold'], help="write stock or sales as CSV/JSONL and exit")
+    parser.add_argument('--from', dest='start', help="first day of a sold export, YYYY-MM-DD")
+    parser.add_argument('--to', dest='end', help="last day of a sold export, YYYY-MM-DD")
+    parser.add_argument('--format', choices=export.FORMATS, help="export format (default: from the --output name, else csv)")
+    parser.add_argument('--output', default='-', help="export file, compressed if it ends in .gz (default stdout)")
+    parser.add_argument('--import', dest='import_file', help="add the codes of a stock export (.csv, .jsonl, .gz) and exit")
+    args = parser.parse_args()
+
+    if args.export or args.import_file:
+        if args.end and not args.start:
+            parser.error("--to needs --from")
+        output = args.output if args.output == '-' else os.path.abspath(args.output)
+        import_file = args.import_file and os.path.abspath(args.import_file)
+        os.chdir(args.data)
+        if args.export:
+            fmt = args.format or export.format_of(output)
+            summary = run_export(args.export, [day for day in (args.start, args.end) if day], output, fmt)
+        else:
+            summary = run_import(import_file)
+        print(summary, file=sys.stderr if args.output == '-' and args.export else sys.stdout)
+        return
+
+    if args.script:
+        if args.quiet:
+            logging.getLogger().setLevel(logging.WARNING)
+        run_script(args.script, args.data, args.quiet, args.guild)
+        return
+
+    os.chdir(args.data)
+    inventory = Inventory()
+    inventory.start()
     print("Welcome to the Redeem Code Management System!")
-    while True:
-        command = input("Enter command (or type 'exit' to quit): ").strip()
-        if command == "exit":
-            print("Exiting the system. Goodbye!")
-            break
-        process_command(command)
+    try:
+        while True:
+            command = input("Enter command (or type 'exit' to quit): ").strip()
+            if command == "exit":
+                print("Exiting the system. Goodbye!")
+                break
+            # No order queue: nothing would fill a queued order before exit
+            output = process_command(inventory, command)
+            if output:
+                print(output)
+    finally:
+        inventory.stop()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,154 @@
+import os
+import logging
+import threading
+import time
+import asyncio
+from collections import defaultdict
+from inventory import Inventory
+from storage import open_storage, FILE_NAME, REMOVED_FILE_NAME, TOTAL_DUE_FILE, JOURNAL_FILE, STOCK_BIN_FILE, DB_FILE, PRICE_FILE
+from code_index import CodeIndex, SEEN_FILE
+from ledger import Ledger, LEDGER_DIR
+from orders import OrderQueue
+
+# Every guild gets its own inventory, prices and dues under DATA_DIR/<guild id>/,
+# with the same files the single-server bot keeps in its working directory.
+DATA_DIR = os.getenv('DATA_DIR', 'data')
+
+# Shards nobody has used for SHARD_IDLE seconds are written back and unloaded
+SHARD_IDLE = float(os.getenv('SHARD_IDLE', 3600))
+
+# The guild that keeps using the data files in the working directory, so an
+# existing single-server setup carries on without moving anything
+HOME_GUILD = os.getenv('HOME_GUILD')
+
+# Files of a single-server setup. If the working directory has any of them and
+# HOME_GUILD is unset, no guild would see that data, so the bot refuses to start.
+HOME_DATA_FILES = [FILE_NAME, REMOVED_FILE_NAME, TOTAL_DUE_FILE, JOURNAL_FILE, STOCK_BIN_FILE, DB_FILE, PRICE_FILE,
+                   SEEN_FILE, LEDGER_DIR]
+
+# Commands sent outside a guild (direct messages) share this shard
+DIRECT_SHARD = 'direct'
+
+
+# One guild's inventory with its own per-amount order locks and queue of
+# orders waiting for stock. The inventory is loaded by the first command that
+# needs it; `loading` is held while it is loaded or stopped.
+class Shard:
+    def __init__(self, key):
+        self.key = key
+        self.inventory = None
+        self.loading = threading.Lock()
+        self.unloaded = False
+        self.amount_locks = defaultdict(asyncio.Lock)
+        self.orders = OrderQueue()
+        self.active = 0
+        self.last_used = time.monotonic()
+
+
+# Loads shards on first use and unloads idle ones. get() and release() bracket
+# every command so a shard is never unloaded while a command is using it.
+# The manager's lock only guards the table of shards; loading and stopping
+# happen under each shard's own lock, so one guild's slow load or write-back
+# never holds up commands for the others.
+class ShardManager:
+    def __init__(self, data_dir=DATA_DIR, idle=SHARD_IDLE, home_guild=HOME_GUILD):
+        self.data_dir = data_dir
+        self.idle = idle
+        self.home_guild = str(home_guild) if home_guild else None
+        self.lock = threading.Lock()
+        self.shards = {}
+
+    def directory(self, key):
+        if key == self.home_guild:
+            return '.'
+        return os.path.join(self.data_dir, key)
+
+    # Why the shards cannot start, or None: data in the working directory that
+    # no guild is set to use would look like an empty inventory with no dues
+    def check_home_guild(self):
+        if self.home_guild:
+            return None
+        found = [name for name in HOME_DATA_FILES if os.path.exists(name)]
+        if not found:
+            return None
+        return (f"Found data in the working directory ({', '.join(found)}) but HOME_GUILD is not set. "
+                f"Set HOME_GUILD to the id of the guild that uses this data, or move it to "
+                f"{os.path.join(self.data_dir, '<guild id>')}/.")
+
+    def _load(self, key):
+        directory = self.directory(key)
+        os.makedirs(directory, exist_ok=True)
+        inventory = Inventory(open_storage(data_dir=directory), CodeIndex(os.path.join(directory, SEEN_FILE)),
+                              Ledger(os.path.join(directory, LEDGER_DIR)))
+        inventory.start()
+        logging.info(f"Loaded shard {key} from {directory}")
+        return inventory
+
+    # Shard for a guild id (None for direct messages), loading it if needed
+    def get(self, guild_id):
+        key = DIRECT_SHARD if guild_id is None else str(guild_id)
+        while True:
+            with self.lock:
+                shard = self.shards.get(key)
+                if shard is None:
+                    shard = self.shards[key] = Shard(key)
+                shard.active += 1
+                shard.last_used = time.monotonic()
+            try:
+                with shard.loading:
+                    # Unloaded while we waited: start over with a new entry
+                    if not shard.unloaded:
+                        if shard.inventory is None:
+                            shard.inventory = self._load(key)
+                        return shard
+            except BaseException:
+                self.release(shard)
+                raise
+            self.release(shard)
+
+    def release(self, shard):
+        with self.lock:
+            shard.active -= 1
+            shard.last_used = time.monotonic()
+
+    # Write back and unload shards that have been idle for `idle` seconds
+    def evict_idle(self):
+        now = time.monotonic()
+        idle = []
+        with self.lock:
+            for key, shard in list(self.shards.items()):
+                if shard.active or now - shard.last_used < self.idle or shard.orders.waiting():
+                    continue
+                # Claimed before the table is unlocked, so a command that
+                # arrives meanwhile waits for the write-back and loads again
+                if shard.loading.acquire(blocking=False):
+                    shard.unloaded = True
+                    idle.append(shard)
+        for shard in idle:
+            try:
+                if shard.inventory is not None:
+                    shard.inventory.stop()
+                    logging.info(f"Unloaded idle shard {shard.key}")
+            finally:
+                # Out of the table only once its files are written
+                with self.lock:
+                    del self.shards[shard.key]
+                shard.loading.release()
+        return [shard.key for shard in idle]
+
+    # Waiting orders of every loaded shard, taken out of their queues. They
+    # only live in memory, so their buyers are told before shutting down.
+    def drain_orders(self):
+        with self.lock:
+            shards = list(self.shards.values())
+        return [order for shard in shards for order in shard.orders.drain()]
+
+    def stop(self):
+        with self.lock:
+            shards = list(self.shards.values())
+            self.shards.clear()
+        for shard in shards:
+            with shard.loading:
+                shard.unloaded = True
+                if shard.inventory is not None:
+                    shard.inventory.stop()
@@ -0,0 +1,196 @@
+import os
+import json
+import mmap
+import struct
+import hashlib
+import logging
+import threading
+
+# On-disk hash index over every code in the sales ledger, so a sold code is
+# found with one or two probes instead of a scan. It is an open-addressing
+# table in one memory-mapped file, ledger/sold_codes.idx:
+#   header: magic, slot count, used slots, segment (YYYYMM), offset and seq
+#           of the last ledger line indexed
+#   slots:  code hash, segment (YYYYMM), byte offset of the sale's line
+# A slot only points into the ledger, which is never cleared, and lookups
+# check the code on the line they land on. The table doubles once it is half
+# full. If the ledger does not match the header (lost after a power cut and
+# rebuilt from the journal), the index is rebuilt from the ledger.
+SOLD_INDEX_FILE = 'sold_codes.idx'
+INDEX_HEADER = struct.Struct('<4sQQIQQ')
+INDEX_MAGIC = b'SCI1'
+SLOT = struct.Struct('<QIQ')
+INITIAL_SLOTS = 1 << 16
+EMPTY = bytes(8)
+
+
+def code_hash(code):
+    return int.from_bytes(hashlib.blake2b(code.encode(), digest_size=8).digest(), 'little') or 1
+
+def segment_to_number(name):
+    return int(name.replace('-', ''))
+
+def number_to_segment(number):
+    return f"{number // 100:04d}-{number % 100:02d}"
+
+
+class SoldIndex:
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.lock = threading.Lock()
+        self.map = None
+        self.inode = None
+
+    # Map the current file, again if another instance replaced it.
+    # Returns False if there is no usable index.
+    def _open(self):
+        try:
+            stat = os.stat(self.file_name)
+        except FileNotFoundError:
+            stat = None
+        if self.map is not None and stat is not None and stat.st_ino == self.inode:
+            return True
+        self._close()
+        if stat is None or stat.st_size < INDEX_HEADER.size:
+            return False
+        with open(self.file_name, 'r+b') as file:
+            self.map = mmap.mmap(file.fileno(), 0)
+        self.inode = stat.st_ino
+        magic, slots = INDEX_HEADER.unpack_from(self.map)[:2]
+        if magic != INDEX_MAGIC or len(self.map) != INDEX_HEADER.size + slots * SLOT.size:
+            logging.warning(f"{self.file_name} is not a sold code index, it will be rebuilt")
+            self._close()
+            return False
+        return True
+
+    def _close(self):
+        if self.map is not None:
+            self.map.close()
+        self.map = None
+        self.inode = None
+
+    # Write a fresh table with `slots` slots holding `entries` and the given
+    # ledger position, and map it in place of the current one
+    def _create(self, slots, entries, position=(0, 0, 0)):
+        temp_name = self.file_name + '.tmp'
+        with open(temp_name, 'w+b') as file:
+            file.truncate(INDEX_HEADER.size + slots * SLOT.size)
+            table = mmap.mmap(file.fileno(), 0)
+            count = 0
+            for entry in entries:
+                self._place(table, slots, *entry)
+                count += 1
+            INDEX_HEADER.pack_into(table, 0, INDEX_MAGIC, slots, count, *position)
+            table.flush()
+            table.close()
+        self._close()
+        os.replace(temp_name, self.file_name)
+        self._open()
+
+    @staticmethod
+    def _place(table, slots, digest, segment, offset):
+        position = digest % slots
+        while True:
+            at = INDEX_HEADER.size + position * SLOT.size
+            if table[at:at + 8] == EMPTY:
+                SLOT.pack_into(table, at, digest, segment, offset)
+                return
+            position = (position + 1) % slots
+
+    def _entries(self):
+        _, slots, *_ = INDEX_HEADER.unpack_from(self.map)
+        for position in range(slots):
+            at = INDEX_HEADER.size + position * SLOT.size
+            if self.map[at:at + 8] != EMPTY:
+                yield SLOT.unpack_from(self.map, at)
+
+    def _insert(self, code, segment, offset):
+        magic, slots, count, *position = INDEX_HEADER.unpack_from(self.map)
+        if (count + 1) * 2 > slots:
+            logging.info(f"Growing the sold code index to {slots * 2} slots")
+            self._create(slots * 2, self._entries(), position)
+            slots = slots * 2
+        self._place(self.map, slots, code_hash(code), segment, offset)
+        INDEX_HEADER.pack_into(self.map, 0, magic, slots, count + 1, *position)
+
+    # Where indexing resumes: (segment, byte offset), or None if the ledger
+    # no longer has the last line indexed where the header says
+    def _resume_at(self, ledger):
+        _, _, _, segment, offset, seq = INDEX_HEADER.unpack_from(self.map)
+        if segment == 0:
+            return 0, 0
+        path = ledger.segment_path(number_to_segment(segment))
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as file:
+            file.seek(offset)
+            line = file.readline()
+        try:
+            if line.endswith(b'\n') and json.loads(line)['seq'] == seq:
+                return segment, offset + len(line)
+        except (json.JSONDecodeError, KeyError, TypeError):
+            pass
+        return None
+
+    # Index ledger lines written since the last update. Callers hold the
+    # store's lock, like for Ledger.append, so one instance writes at a time.
+    def update(self, ledger):
+        with self.lock:
+            resume = self._resume_at(ledger) if self._open() else None
+            if resume is None:
+                if os.path.exists(self.file_name):
+                    logging.warning("Sold code index does not match the ledger, rebuilding it")
+                self._create(INITIAL_SLOTS, ())
+                resume = 0, 0
+
+            first_segment, first_offset = resume
+            added = 0
+            last = None
+            for name in ledger.segments():
+                segment = segment_to_number(name)
+                if segment < first_segment:
+                    continue
+                offset = first_offset if segment == first_segment else 0
+                with open(ledger.segment_path(name), 'rb') as file:
+                    file.seek(offset)
+                    for line in file:
+                        if not line.endswith(b'\n'):
+                            break
+                        try:
+                            sale = json.loads(line)
+                            self._insert(sale['code'], segment, offset)
+                            last = segment, offset, sale['seq']
+                            added += 1
+                        except (json.JSONDecodeError, KeyError, TypeError):
+                            pass
+                        offset += len(line)
+            if last is None:
+                return
+            # Slots reach the disk before the header that covers them
+            self.map.flush()
+            magic, slots, count, *_ = INDEX_HEADER.unpack_from(self.map)
+            INDEX_HEADER.pack_into(self.map, 0, magic, slots, count, *last)
+            if added > 1000:
+                logging.info(f"Indexed {added} sold codes")
+
+    # Ledger positions (segment, offset) whose code may be `code`
+    def find(self, code):
+        digest = code_hash(code)
+        with self.lock:
+            if not self._open():
+                return []
+            _, slots, *_ = INDEX_HEADER.unpack_from(self.map)
+            found = []
+            position = digest % slots
+            while True:
+                at = INDEX_HEADER.size + position * SLOT.size
+                slot_digest, segment, offset = SLOT.unpack_from(self.map, at)
+                if not slot_digest:
+                    return found
+                if slot_digest == digest and (segment, offset) not in found:
+                    found.append((segment, offset))
+                position = (position + 1) % slots
+
+    def close(self):
+        with self.lock:
+            self._close()
@@ -0,0 +1,872 @@
+import json
+import contextlib
+import os
+import re
+import logging
+import sqlite3
+import threading
+import sys
+import struct
+import time
+import mmap
+import metrics
+from metrics import timed_storage
+from codec import CodeQueue, RECORD_SIZE
+
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locks, run a single instance
+    fcntl = None
+
+# Constants
+FILE_NAME = 'codes.json'
+REMOVED_FILE_NAME = 'used.json'
+TOTAL_DUE_FILE = 'total_due.json'
+JOURNAL_FILE = 'journal.jsonl'
+STOCK_BIN_FILE = 'codes.bin'
+PRICE_FILE = 'prices.json'
+DB_FILE = os.getenv('DB_FILE', 'codes.db')
+
+# Storage backend: "json" (snapshot files + journal) or "sqlite"
+STORAGE = os.getenv('STORAGE', 'json')
+
+# Stock snapshot format for the JSON backend: "json" (codes.json) or "binary"
+# (codes.bin, packed 18-byte records that load without parsing each code)
+SNAPSHOT_FORMAT = os.getenv('SNAPSHOT_FORMAT', 'binary')
+
+# JSON backend compacts the journal into new snapshots once it holds this many records
+COMPACT_EVERY = int(os.getenv('COMPACT_EVERY', 1000))
+
+# Advisory lock file that serializes journal access between processes
+LOCK_FILE = 'codes.lock'
+
+# Journal durability. "group" (default): a change is fsynced before the
+# command replies, and every change written while one fsync runs shares the
+# next one, so a burst of orders costs a few fsyncs rather than one each.
+# "off": leave flushing to the operating system.
+JOURNAL_SYNC = os.getenv('JOURNAL_SYNC', 'group')
+
+# Extra seconds the first writer of a group waits for others to join it
+GROUP_COMMIT_WINDOW = float(os.getenv('GROUP_COMMIT_WINDOW', 0))
+
+# Which part of the state each journal operation changes
+OP_PARTS = {
+    'upload': ('stock',),
+    'take': ('stock',),
+    'sold': ('sold', 'due'),
+    'price': ('stock', 'prices'),
+    'due': ('due',),
+    'clear': ('sold', 'due'),
+}
+
+
+# "seq" as the first or last key of a snapshot file
+SEQ_HEAD = re.compile(rb'\{\s*"seq":\s*(\d+)\s*,')
+SEQ_TAIL = re.compile(rb',\s*"seq":\s*(\d+)\s*\}\s*$')
+
+
+# A data file exists but cannot be read. Raised instead of starting from
+# empty data, which would wipe the inventory on the next write.
+class CorruptFileError(Exception):
+    pass
+
+
+# Write data to a temporary file next to file_name and fsync it; commit_temp()
+# then renames it into place, so readers see the old or the new file, never a mix
+def write_temp(file_name, data):
+    temp_name = f"{file_name}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_name, 'wb') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+    except OSError:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
+    return temp_name
+
+def commit_temp(temp_name, file_name):
+    os.replace(temp_name, file_name)
+    sync_directory(file_name)
+
+# fsync the directory holding file_name so a rename in it survives a crash
+def sync_directory(file_name):
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(file_name)), os.O_RDONLY)
+    except OSError:
+        return  # Not supported on Windows
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def atomic_write(file_name, data):
+    commit_temp(write_temp(file_name, data), file_name)
+
+
+# Load codes from JSON file
+@timed_storage('load_codes')
+def load_codes(file_name=FILE_NAME):
+    if os.path.exists(file_name):
+        try:
+            metrics.storage_bytes_read.observe(os.path.getsize(file_name), op='load_codes')
+            with open(file_name, 'r') as file:
+                return json.load(file)
+        except json.JSONDecodeError as e:
+            logging.critical(f"{file_name} is corrupted: {e}")
+            raise CorruptFileError(f"{file_name} is corrupted ({e}); restore it from a backup before starting") from e
+    return {"codes": []}
+
+# Save codes to JSON file
+@timed_storage('save_codes')
+def save_codes(data, file_name=FILE_NAME):
+    encoded = json.dumps(data, indent=4).encode()
+    try:
+        atomic_write(file_name, encoded)
+        metrics.storage_bytes_written.observe(len(encoded), op='save_codes')
+    except IOError as e:
+        logging.error(f"Error saving file: {e}")
+
+# Binary stock snapshot:
+#   header: magic, journal seq, number of amounts
+#   per amount: amount, price, record count, text count, packed records,
+#               then (index, length, utf-8) for each code outside the format
+BIN_MAGIC = b'UCB1'
+BIN_HEADER = struct.Struct('<4sQI')
+BIN_GROUP = struct.Struct('<qdII')
+BIN_TEXT = struct.Struct('<IH')
+
+def stock_binary(stock, seq):
+    parts = [BIN_HEADER.pack(BIN_MAGIC, seq, len(stock))]
+    for amount, price, queue in stock:
+        records, texts = queue.to_bytes()
+        parts.append(BIN_GROUP.pack(amount, price, len(queue), len(texts)))
+        parts.append(records)
+        for index, code in texts.items():
+            encoded = code.encode('utf-8')
+            parts.append(BIN_TEXT.pack(index, len(encoded)) + encoded)
+    return b''.join(parts)
+
+# Returns ([(amount, price, CodeQueue), ...], seq), or None if there is no file.
+# The file is memory-mapped and the queues read their records straight from
+# the mapping, so loading costs the same however many codes are in stock.
+# Snapshots are replaced by renaming, never rewritten in place, so a mapping
+# stays valid for as long as a queue uses it.
+@timed_storage('load_stock_binary')
+def load_stock_binary(file_name=STOCK_BIN_FILE):
+    if not os.path.exists(file_name):
+        return None
+    with open(file_name, 'rb') as file:
+        # Windows cannot replace a file that is mapped, so read it there
+        if os.name == 'nt' or os.fstat(file.fileno()).st_size == 0:
+            data = memoryview(file.read())
+        else:
+            data = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+    metrics.storage_bytes_read.observe(BIN_HEADER.size, op='load_stock_binary')
+
+    try:
+        magic, seq, groups = BIN_HEADER.unpack_from(data, 0)
+        if magic != BIN_MAGIC:
+            raise ValueError("not a stock snapshot")
+        offset = BIN_HEADER.size
+        stock = []
+        for _ in range(groups):
+            amount, price, count, text_count = BIN_GROUP.unpack_from(data, offset)
+            offset += BIN_GROUP.size
+            records = data[offset:offset + count * RECORD_SIZE]
+            if len(records) != count * RECORD_SIZE:
+                raise ValueError("truncated")
+            offset += len(records)
+            texts = {}
+            for _ in range(text_count):
+                index, length = BIN_TEXT.unpack_from(data, offset)
+                offset += BIN_TEXT.size
+                texts[index] = bytes(data[offset:offset + length]).decode('utf-8')
+                offset += length
+            stock.append((amount, price, CodeQueue.from_bytes(records, texts)))
+    except (struct.error, ValueError) as e:
+        logging.critical(f"{file_name} is corrupted: {e}")
+        raise CorruptFileError(f"{file_name} is corrupted ({e}); restore it from a backup before starting") from e
+    return stock, seq
+
+# Stock from the codes.json layout
+def stock_from_codes(codes_data):
+    return [(group['amount'], group.get('price', 0),
+             CodeQueue(code['code'] for code in group['codes'] if not code['redeemed']))
+            for group in codes_data['codes']]
+
+
+# Exclusive advisory lock on a file, shared by every process using the same
+# data files. flock() does not exclude threads of one process, so a thread
+# lock is held as well. Re-entrant within a thread.
+class FileLock:
+    def __init__(self, file_name=LOCK_FILE):
+        self.file_name = file_name
+        self.thread_lock = threading.RLock()
+        self.depth = 0
+        self._file = None
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        if self.depth == 0 and fcntl is not None:
+            if self._file is None:
+                self._file = open(self.file_name, 'a')
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self.depth -= 1
+        if self.depth == 0 and fcntl is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+        self.thread_lock.release()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+# Group commit: wait() returns once every write made before it is on disk.
+# The first waiter fsyncs for everybody; whoever arrives during that fsync
+# waits for the next one, which covers them all.
+class GroupCommit:
+    def __init__(self, window=GROUP_COMMIT_WINDOW):
+        self.window = window
+        self.condition = threading.Condition()
+        self.written = 0
+        self.synced = 0
+        self.syncing = False
+
+    def wrote(self):
+        with self.condition:
+            self.written += 1
+
+    def wait(self, fsync):
+        with self.condition:
+            target = self.written
+            while self.synced < target:
+                if self.syncing:
+                    self.condition.wait()
+                    continue
+
+                self.syncing = True
+                self.condition.release()
+                synced = None
+                try:
+                    if self.window:
+                        time.sleep(self.window)
+                    with self.condition:
+                        batch = self.written
+                    fsync()
+                    synced = batch
+                finally:
+                    self.condition.acquire()
+                    self.syncing = False
+                    if synced is not None:
+                        self.synced = max(self.synced, synced)
+                    self.condition.notify_all()
+
+
+# Journal records and the length of the journal up to its last whole line.
+# Only an unterminated last line, a write torn by a crash, is left out; any
+# other unreadable line means records were lost, so it raises.
+def read_journal(file_name=JOURNAL_FILE):
+    records = []
+    end = 0
+    if not os.path.exists(file_name):
+        return records, end
+    with open(file_name, 'rb') as file:
+        for number, line in enumerate(file, 1):
+            if not line.endswith(b'\n'):
+                logging.warning(f"Ignoring torn last line of {file_name}")
+                break
+            records.append(parse_journal_line(line, file_name, number))
+            end += len(line)
+    return records, end
+
+def parse_journal_line(line, file_name, number=None):
+    try:
+        return json.loads(line)
+    except json.JSONDecodeError as e:
+        where = f"{file_name} line {number}" if number else file_name
+        raise CorruptFileError(f"{where} is corrupted ({e}); restore it from a backup before starting") from e
+
+
+# Every backend provides:
+#   load()               -> (stock, prices, sold, seq, replay)
+#                           stock is a list of (amount, price, CodeQueue)
+#                           prices is the price table, {amount: [(from, price)]},
+#                           or None if the store has none yet
+#                           sold is a dict: "summary" lists (amount, count, due,
+#                           latest price) of sold codes, "total_due" is the
+#                           stored total, and
+#                           "history" the sold codes themselves (used.json
+#                           layout) or None if they are left for load_sold(),
+#                           and "seq" the journal seq the history is at
+#                           replay yields (record, parts_to_skip) to apply on top
+#   load_sold()          -> (used_data, seq): the sold codes as of journal seq
+#   append(records, seq) persist a list of journal records as one unit, only if
+#                        the store is still at version `seq`; False on conflict
+#   changes(seq)         records other instances stored after `seq`, or None if
+#                        the caller has to load() again
+#   file_lock            held while writing, so work done under it (the sales
+#                        ledger) is ordered the same across instances
+#   sync()               return once appended records are durable
+#   needs_compaction()   whether compact() has work to do
+#   compact(inventory)   fold appended records into the base state
+#   close()
+
+# Snapshot JSON files plus an append-only journal. Each snapshot remembers the
+# journal sequence number it includes, so records already folded into it are
+# not applied twice.
+#
+# Several processes can share the files. Every read and write of the journal
+# happens under an advisory lock, and the journal's size and inode are its
+# version stamp: if it grew, another instance appended; if its inode changed,
+# another instance compacted it.
+class JsonStorage:
+    def __init__(self, file_name=FILE_NAME, removed_file_name=REMOVED_FILE_NAME,
+                 total_due_file=TOTAL_DUE_FILE, journal_file=JOURNAL_FILE,
+                 stock_bin_file=STOCK_BIN_FILE, snapshot_format=SNAPSHOT_FORMAT,
+                 compact_every=COMPACT_EVERY, lock_file=None, journal_sync=JOURNAL_SYNC,
+                 price_file=PRICE_FILE):
+        self.files = {'stock': file_name, 'sold': removed_file_name, 'due': total_due_file, 'prices': price_file}
+        self.stock_bin_file = stock_bin_file
+        self.snapshot_format = snapshot_format
+        self.journal_file = journal_file
+        self.compact_every = compact_every
+        self.file_lock = FileLock(lock_file or os.path.join(os.path.dirname(journal_file), LOCK_FILE))
+        self.snapshot_seq = {}
+        self.dirty = set()
+        self.journal_records = 0
+        self.journal_offset = 0
+        self.journal_sync = journal_sync
+        self.group_commit = GroupCommit()
+        self._journal = None
+        self._compact_lock = threading.Lock()
+
+    @timed_storage('json_load')
+    def load(self):
+        with self.file_lock:
+            # Use whichever stock snapshot is newer, so switching formats is
+            # safe. codes.json is only parsed if it was written after codes.bin.
+            binary = load_stock_binary(self.stock_bin_file)
+            if binary and not self._newer(self.files['stock'], self.stock_bin_file):
+                stock, stock_seq = binary
+            else:
+                codes_data = load_codes(self.files['stock'])
+                stock, stock_seq = stock_from_codes(codes_data), codes_data.get('seq', 0)
+                if binary and binary[1] >= stock_seq:
+                    stock, stock_seq = binary
+
+            price_data = load_codes(self.files['prices']) if os.path.exists(self.files['prices']) else None
+            prices = None
+            if price_data is not None:
+                prices = {int(amount): [tuple(entry) for entry in table]
+                          for amount, table in price_data.get('prices', {}).items()}
+
+            # total_due.json carries a summary of the sold codes, so used.json
+            # is only read when the codes themselves are needed. Snapshots
+            # from before the summary existed are counted from used.json.
+            due_data = load_codes(self.files['due']) if os.path.exists(self.files['due']) else {}
+            summary = due_data.get('dues')
+            if summary is None and 'sold' in due_data:
+                summary = [(amount, count, count * price, price) for amount, count, price in due_data['sold']]
+            history = None
+            if summary is None:
+                history, sold_seq = self.load_sold()
+            self.snapshot_seq = {
+                'stock': stock_seq,
+                'sold': sold_seq if summary is None else self._sold_seq(),
+                'due': sold_seq if summary is None else due_data.get('seq', 0),
+                'prices': price_data.get('seq', 0) if price_data is not None else 0,
+            }
+            seq = max(self.snapshot_seq.values())
+            if self._journal is not None:
+                self._journal.close()
+            self._journal = open(self.journal_file, 'ab', buffering=0)
+            records, end = read_journal(self.journal_file)
+            # Cut a torn last line, so the next record does not continue it
+            if os.fstat(self._journal.fileno()).st_size > end:
+                os.ftruncate(self._journal.fileno(), end)
+            self.journal_offset = end
+        if records:
+            seq = max(seq, records[-1]['seq'])
+            logging.info(f"Replaying {len(records)} journal records from {self.journal_file}")
+        self.journal_records = len(records)
+        self.dirty = set() if summary is not None and 'dues' in due_data else {'due'}
+        if price_data is None:
+            self.dirty.add('prices')
+
+        def replay():
+            for record in records:
+                skip = {part for part in OP_PARTS[record['op']] if record['seq'] <= self.snapshot_seq[part]}
+                self.dirty.update(set(OP_PARTS[record['op']]) - skip)
+                yield record, skip
+
+        sold = {"summary": [tuple(group) for group in summary] if summary is not None else None,
+                "total_due": due_data.get('total_due', 0), "history": history, "seq": self.snapshot_seq['sold']}
+        return stock, prices, sold, seq, replay()
+
+    # Journal records after `seq`, for the sales ledger to catch up from
+    def journal_since(self, seq):
+        with self.file_lock:
+            return [record for record in read_journal(self.journal_file)[0] if record['seq'] > seq]
+
+    @timed_storage('json_load_sold')
+    def load_sold(self):
+        used_data = load_codes(self.files['sold'])
+        if 'codes' not in used_data:
+            used_data['codes'] = []
+        return used_data, used_data.pop('seq', 0)
+
+    # Journal seq of used.json, read from the start or end of the file instead
+    # of parsing all of it
+    def _sold_seq(self):
+        file_name = self.files['sold']
+        if not os.path.exists(file_name):
+            return 0
+        with open(file_name, 'rb') as file:
+            head = file.read(64)
+            file.seek(max(0, os.fstat(file.fileno()).st_size - 64))
+            tail = file.read()
+        match = SEQ_HEAD.match(head) or SEQ_TAIL.search(tail)
+        if match:
+            return int(match.group(1))
+        return self.load_sold()[1]
+
+    @staticmethod
+    def _newer(file_name, other):
+        return os.path.exists(file_name) and os.path.getmtime(file_name) > os.path.getmtime(other)
+
+    # Whether another instance has compacted or appended to the journal since
+    # we last read or wrote it. Call with the file lock held.
+    def _replaced(self):
+        try:
+            return os.stat(self.journal_file).st_ino != os.fstat(self._journal.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def _grown(self):
+        return os.fstat(self._journal.fileno()).st_size != self.journal_offset
+
+    @timed_storage('json_changes')
+    def changes(self, seq):
+        with self.file_lock:
+            if self._replaced():
+                return None
+            if not self._grown():
+                return []
+            with open(self.journal_file, 'rb') as file:
+                file.seek(self.journal_offset)
+                data = file.read()
+
+        # Only whole lines; a writer holds the lock until its line is complete
+        data = data[:data.rfind(b'\n') + 1]
+        self.journal_offset += len(data)
+        metrics.storage_bytes_read.observe(len(data), op='json_changes')
+        records = [parse_journal_line(line, self.journal_file) for line in data.splitlines()]
+        for record in records:
+            self.dirty.update(OP_PARTS[record['op']])
+        self.journal_records += len(records)
+        return [record for record in records if record['seq'] > seq]
+
+    # Write the records in one go. If the disk is full or the write fails, cut
+    # the journal back to where it was, so no torn line is left behind, and
+    # raise: the change is not made.
+    @timed_storage('json_append')
+    def append(self, records, seq=None):
+        data = "".join(json.dumps(record) + "\n" for record in records).encode()
+        with self.file_lock:
+            if seq is not None and (self._replaced() or self._grown()):
+                return False
+            metrics.storage_bytes_written.observe(len(data), op='json_append')
+            try:
+                view = memoryview(data)
+                while view:
+                    view = view[self._journal.write(view):]
+            except OSError as e:
+                logging.error(f"Error writing journal: {e}")
+                os.ftruncate(self._journal.fileno(), self.journal_offset)
+                raise
+            self.journal_offset += len(data)
+            self.group_commit.wrote()
+        for record in records:
+            self.dirty.update(OP_PARTS[record['op']])
+        self.journal_records += len(records)
+        return True
+
+    @timed_storage('json_sync')
+    def sync(self):
+        if self.journal_sync == 'group':
+            self.group_commit.wait(self._fsync_journal)
+
+    def _fsync_journal(self):
+        # A duplicate descriptor stays valid even if compaction swaps the journal
+        with self.file_lock:
+            fd = os.dup(self._journal.fileno())
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def needs_compaction(self):
+        return self.journal_records >= self.compact_every
+
+    # Write new snapshots of the changed files and start an empty journal
+    @timed_storage('json_compact')
+    def compact(self, inventory):
+        with self._compact_lock:
+            # Sold codes are loaded on demand; read them before taking the
+            # state lock so orders are not held up by parsing used.json
+            if 'sold' in self.dirty and not inventory.history_loaded():
+                inventory.load_history(self.load_sold())
+
+            with inventory.lock:
+                if 'sold' in self.dirty:
+                    inventory.load_history()
+                if not self.dirty:
+                    return
+                seq = inventory.seq
+                journal = os.fstat(self._journal.fileno()).st_ino
+                pending = []
+                if 'stock' in self.dirty and self.snapshot_format == 'binary':
+                    pending.append(('stock', self.stock_bin_file, stock_binary(inventory.stock_groups(), seq)))
+                elif 'stock' in self.dirty:
+                    data = inventory.stock_data()
+                    data['seq'] = seq
+                    pending.append(('stock', self.files['stock'], json.dumps(data, indent=4).encode()))
+                if 'sold' in self.dirty:
+                    data = {'seq': seq, **inventory.used}
+                    pending.append(('sold', self.files['sold'], json.dumps(data, indent=4).encode()))
+                if 'due' in self.dirty:
+                    data = {'total_due': inventory.total_due, 'seq': seq, 'dues': inventory.sold_summary()}
+                    pending.append(('due', self.files['due'], json.dumps(data, indent=4).encode()))
+                if 'prices' in self.dirty:
+                    data = {'seq': seq, 'prices': inventory.price_table_data()}
+                    pending.append(('prices', self.files['prices'], json.dumps(data, indent=4).encode()))
+                self.dirty.clear()
+
+            # Snapshots are written and fsynced to temporary files outside the
+            # state lock so commands keep running, then renamed into place
+            metrics.storage_bytes_written.observe(sum(len(data) for _, _, data in pending), op='json_compact')
+            failed = False
+            temp_names = []
+            for part, file_name, data in pending:
+                try:
+                    temp_names.append(write_temp(file_name, data))
+                except IOError as e:
+                    logging.error(f"Error saving file: {e}")
+                    failed = True
+
+            with inventory.lock, self.file_lock:
+                # Another instance compacted first, whether or not we have
+                # loaded its snapshots since; they are at least as new as ours,
+                # so keep them. A sale the ledger failed to take meanwhile
+                # keeps the journal too.
+                if (failed or self._replaced() or os.fstat(self._journal.fileno()).st_ino != journal
+                        or not inventory.ledger.caught_up()):
+                    for temp_name in temp_names:
+                        if os.path.exists(temp_name):
+                            os.remove(temp_name)
+                    self.dirty.update(part for part, _, _ in pending)
+                    return
+                for (part, file_name, _), temp_name in zip(pending, temp_names):
+                    commit_temp(temp_name, file_name)
+                    self.snapshot_seq[part] = seq
+
+                # Keep only records written while the snapshots were being saved,
+                # including other instances' records we have not read yet
+                tail = [record for record in read_journal(self.journal_file)[0] if record['seq'] > seq]
+                data = bytearray()
+                offset = 0
+                applied = 0
+                for record in tail:
+                    data += (json.dumps(record) + "\n").encode()
+                    if record['seq'] <= inventory.seq:
+                        offset = len(data)
+                        applied += 1
+                try:
+                    atomic_write(self.journal_file, data)
+                except OSError as e:
+                    # The old journal is still complete; try again later
+                    logging.error(f"Error rewriting journal: {e}")
+                    return
+                self._journal.close()
+                self._journal = open(self.journal_file, 'ab', buffering=0)
+                self.journal_offset = offset
+                self.journal_records = applied
+                logging.info(f"Compacted journal into snapshots at seq {seq}")
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        self.file_lock.close()
+
+
+# SQLite database. Every list of records is applied in one transaction, so a
+# sale takes the codes, marks them sold and adds to the total due together.
+# The seq in the meta table is the version stamp: a transaction only commits
+# if no other instance has written since this one last loaded.
+#
+# Code status: 0 in stock, 1 taken, 2 sold and due, 3 settled by .clear
+class SqliteStorage:
+    def __init__(self, db_file=DB_FILE):
+        self.db_file = db_file
+        self.db = sqlite3.connect(db_file, check_same_thread=False)
+        self.file_lock = FileLock(os.path.join(os.path.dirname(db_file), LOCK_FILE))
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS codes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                code TEXT NOT NULL,
+                amount INTEGER NOT NULL,
+                status INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS codes_amount_status ON codes (amount, status, id);
+            CREATE INDEX IF NOT EXISTS codes_code ON codes (code);
+            CREATE TABLE IF NOT EXISTS groups (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                amount INTEGER NOT NULL UNIQUE,
+                price REAL NOT NULL DEFAULT 0,
+                used_price REAL
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value
+            );
+            CREATE TABLE IF NOT EXISTS prices (
+                amount INTEGER NOT NULL,
+                effective_from INTEGER NOT NULL,
+                price REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS journal (
+                seq INTEGER PRIMARY KEY,
+                record TEXT NOT NULL
+            );
+            INSERT OR IGNORE INTO meta VALUES ('total_due', 0), ('seq', 0);
+        ''')
+        # Price each code was sold at; NULL for codes sold before it was kept
+        if 'price' not in [column for _, column, *_ in self.db.execute("PRAGMA table_info(codes)")]:
+            self.db.execute("ALTER TABLE codes ADD COLUMN price REAL")
+        self.db.commit()
+
+    def _meta(self, key):
+        return self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()[0]
+
+    # Run several reads in one transaction, so they all see the same version
+    # even if another instance commits in between
+    @contextlib.contextmanager
+    def _snapshot(self):
+        self.db.execute("BEGIN")
+        try:
+            yield
+        finally:
+            self.db.rollback()
+
+    @timed_storage('sqlite_load')
+    def load(self):
+        with self._snapshot():
+            return self._load()
+
+    def _load(self):
+        stock = []
+        summary = []
+        for amount, price, used_price in self.db.execute("SELECT amount, price, used_price FROM groups ORDER BY id"):
+            codes = self.db.execute("SELECT code FROM codes WHERE amount = ? AND status = 0 ORDER BY id", (amount,))
+            stock.append((amount, price, CodeQueue(code for code, in codes)))
+            if used_price is not None:
+                count, due = self.db.execute("SELECT COUNT(*), COALESCE(SUM(COALESCE(price, ?)), 0) FROM codes "
+                                             "WHERE amount = ? AND status = 2", (used_price, amount)).fetchone()
+                summary.append((amount, count, due, used_price))
+        total_due = sum(due for _, _, due, _ in summary)
+
+        prices = {}
+        for amount, effective_from, price in self.db.execute("SELECT amount, effective_from, price FROM prices "
+                                                             "ORDER BY effective_from, rowid"):
+            prices.setdefault(amount, []).append((effective_from, price))
+
+        seq = self._meta('seq')
+        sold = {"summary": summary, "total_due": total_due, "history": None, "seq": seq}
+        return stock, prices or None, sold, seq, iter(())
+
+    @timed_storage('sqlite_load_sold')
+    def load_sold(self):
+        with self._snapshot():
+            return self._load_sold()
+
+    def _load_sold(self):
+        used_data = {"codes": []}
+        for amount, used_price in self.db.execute("SELECT amount, used_price FROM groups "
+                                                  "WHERE used_price IS NOT NULL ORDER BY id"):
+            sold = self.db.execute("SELECT code, COALESCE(price, ?) FROM codes WHERE amount = ? AND status = 2 "
+                                   "ORDER BY id", (used_price, amount))
+            used_data['codes'].append({"amount": amount,
+                                       "codes": [{"code": code, "redeemed": True, "price": price} for code, price in sold],
+                                       "price": used_price})
+        return used_data, self._meta('seq')
+
+    # The last COMPACT_EVERY records are kept in the journal table, so other
+    # instances can apply them instead of loading everything again
+    @timed_storage('sqlite_changes')
+    def changes(self, seq):
+        with self._snapshot():
+            rows = self.db.execute("SELECT seq, record FROM journal WHERE seq > ? ORDER BY seq", (seq,)).fetchall()
+            if not rows:
+                return [] if self._meta('seq') == seq else None
+        if rows[0][0] != seq + 1:
+            return None
+        return [json.loads(record) for _, record in rows]
+
+    # Records after `seq` still in the journal table, for the sales ledger to
+    # catch up from
+    def journal_since(self, seq):
+        rows = self.db.execute("SELECT record FROM journal WHERE seq > ? ORDER BY seq", (seq,)).fetchall()
+        return [json.loads(record) for record, in rows]
+
+    @timed_storage('sqlite_append')
+    def append(self, records, seq=None):
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            if seq is not None and self._meta('seq') != seq:
+                self.db.rollback()
+                return False
+            for record in records:
+                self._apply(record)
+            self.db.executemany("INSERT OR REPLACE INTO journal VALUES (?, ?)",
+                                [(record['seq'], json.dumps(record)) for record in records])
+            self.db.execute("DELETE FROM journal WHERE seq <= ?", (records[-1]['seq'] - COMPACT_EVERY,))
+            self.db.execute("UPDATE meta SET value = ? WHERE key = 'seq'", (records[-1]['seq'],))
+        except BaseException:
+            self.db.rollback()
+            raise
+        self.db.commit()
+        return True
+
+    def _apply(self, record):
+        op = record['op']
+        amount = record.get('amount')
+        db = self.db
+
+        if op == 'upload':
+            db.execute("INSERT OR IGNORE INTO groups (amount) VALUES (?)", (amount,))
+            db.executemany("INSERT INTO codes (code, amount) VALUES (?, ?)",
+                           [(code, amount) for code in record['codes']])
+
+        elif op == 'take':
+            for code in record['codes']:
+                db.execute("UPDATE codes SET status = 1 WHERE id = "
+                           "(SELECT id FROM codes WHERE amount = ? AND code = ? AND status = 0 LIMIT 1)",
+                           (amount, code))
+
+        elif op == 'sold':
+            db.execute("INSERT OR IGNORE INTO groups (amount) VALUES (?)", (amount,))
+            db.execute("UPDATE groups SET used_price = COALESCE(?, price, 0) WHERE amount = ?",
+                       (record.get('price'), amount))
+            price = db.execute("SELECT used_price FROM groups WHERE amount = ?", (amount,)).fetchone()[0]
+            for code in record['codes']:
+                updated = db.execute("UPDATE codes SET status = 2, price = ? WHERE id = "
+                                     "(SELECT id FROM codes WHERE amount = ? AND code = ? AND status = 1 LIMIT 1)",
+                                     (price, amount, code)).rowcount
+                if not updated:
+                    db.execute("INSERT INTO codes (code, amount, status, price) VALUES (?, ?, 2, ?)",
+                               (code, amount, price))
+
+        elif op == 'price':
+            # Sold codes keep the price they were sold at
+            db.execute("UPDATE groups SET price = ? WHERE amount = ?", (record['price'], amount))
+            db.execute("INSERT INTO prices VALUES (?, ?, ?)", (amount, record.get('ts', 0), record['price']))
+
+        elif op == 'due':
+            pass  # The total due is counted from sold codes
+
+        elif op == 'clear':
+            db.execute("UPDATE codes SET status = 3 WHERE status = 2")
+            db.execute("UPDATE groups SET used_price = NULL")
+
+    # Every transaction is durable when it commits
+    def sync(self):
+        pass
+
+    def needs_compaction(self):
+        return False
+
+    def compact(self, inventory):
+        pass
+
+    # Replace the database contents with an inventory's state
+    def import_inventory(self, inventory):
+        inventory.load_history()
+        with inventory.lock, self.db:
+            self.db.execute("DELETE FROM codes")
+            self.db.execute("DELETE FROM groups")
+            self.db.execute("DELETE FROM journal")
+            for group in inventory.stock_data()['codes']:
+                self.db.execute("INSERT INTO groups (amount, price) VALUES (?, ?)", (group['amount'], group['price']))
+                self.db.executemany("INSERT INTO codes (code, amount) VALUES (?, ?)",
+                                    [(code['code'], group['amount']) for code in group['codes']])
+            for group in inventory.used['codes']:
+                self.db.execute("INSERT OR IGNORE INTO groups (amount) VALUES (?)", (group['amount'],))
+                self.db.execute("UPDATE groups SET used_price = ? WHERE amount = ?",
+                                (group.get('price', 0), group['amount']))
+                self.db.executemany("INSERT INTO codes (code, amount, status, price) VALUES (?, ?, 2, ?)",
+                                    [(code['code'], group['amount'], code.get('price', group.get('price', 0)))
+                                     for code in group['codes']])
+            self.db.execute("DELETE FROM prices")
+            self.db.executemany("INSERT INTO prices VALUES (?, ?, ?)",
+                                [(int(amount), effective_from, price)
+                                 for amount, table in inventory.price_table_data().items()
+                                 for effective_from, price in table])
+            self.db.execute("UPDATE meta SET value = ? WHERE key = 'seq'", (inventory.seq,))
+
+    def close(self):
+        self.db.close()
+        self.file_lock.close()
+
+
+# Open the configured backend. With data_dir, its files live in that directory
+# instead of the working directory (one directory per guild shard).
+def open_storage(kind=None, data_dir=None):
+    kind = kind or STORAGE
+
+    def path(file_name):
+        return os.path.join(data_dir, os.path.basename(file_name)) if data_dir else file_name
+
+    if kind == 'sqlite':
+        return SqliteStorage(path(DB_FILE))
+    if kind == 'json':
+        return JsonStorage(path(FILE_NAME), path(REMOVED_FILE_NAME), path(TOTAL_DUE_FILE),
+                           path(JOURNAL_FILE), path(STOCK_BIN_FILE), price_file=path(PRICE_FILE))
+    raise ValueError(f"Unknown storage backend: {kind}")
+
+
+# One-shot migration of codes.json, used.json, total_due.json and the journal
+# into the SQLite database
+def migrate_json_to_sqlite(db_file=DB_FILE):
+    from inventory import Inventory
+
+    inventory = Inventory(JsonStorage())
+    database = SqliteStorage(db_file)
+    if database.db.execute("SELECT COUNT(*) FROM codes").fetchone()[0]:
+        logging.error(f"{db_file} already has codes, not migrating.")
+        database.close()
+        inventory.stop()
+        return False
+
+    database.import_inventory(inventory)
+    database.close()
+    inventory.stop()
+    logging.info(f"Migrated JSON files into {db_file}")
+    return True
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[1:] == ['migrate']:
+        migrate_json_to_sqlite()
+    else:
+        print("Usage: python storage.py migrate")
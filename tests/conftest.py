@@ -0,0 +1,35 @@
+import os
+import sys
+import pytest
+
+# The modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from inventory import Inventory
+from storage import open_storage
+from code_index import CodeIndex, SEEN_FILE
+from ledger import Ledger, LEDGER_DIR
+
+
+def make_code(number, prefix='ABCD'):
+    return f"{prefix}-E-S-{number:08d} {number % 10000:04d}-1111-2222-{number // 10000 % 10000:04d}"
+
+
+# Inventories on one data directory, as separate bot instances would open it
+@pytest.fixture
+def open_inventory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    opened = []
+
+    def open_inventory(kind='json', directory=tmp_path):
+        directory = str(directory)
+        os.makedirs(directory, exist_ok=True)
+        inventory = Inventory(open_storage(kind, directory), CodeIndex(os.path.join(directory, SEEN_FILE)),
+                              Ledger(os.path.join(directory, LEDGER_DIR)))
+        opened.append(inventory)
+        return inventory
+
+    yield open_inventory
+    for inventory in opened:
+        if not inventory._stopped.is_set():
+            inventory.stop()
@@ -0,0 +1,51 @@
+import pytest
+from engine import parse_order, process_basket
+from conftest import make_code
+
+
+@pytest.mark.parametrize('args, items', [
+    (['60'], [(60, 1)]),
+    (['60', '3'], [(60, 3)]),
+    (['60x3', '325x2'], [(60, 3), (325, 2)]),
+    (['60X3', '325'], [(60, 3), (325, 1)]),
+    (['60x'], [(60, 1)]),
+])
+def test_parse_order(args, items):
+    assert parse_order(args) == items
+
+
+@pytest.mark.parametrize('args', [[], ['sixty'], ['60xx3'], ['x3'], ['60x-1'], ['60x3', 'two']])
+def test_parse_order_rejects(args):
+    assert parse_order(args) is None
+
+
+@pytest.fixture
+def stocked(open_inventory):
+    inventory = open_inventory()
+    inventory.add_codes(60, [make_code(i) for i in range(5)])
+    inventory.add_codes(325, [make_code(i) for i in range(100, 102)])
+    inventory.set_price(60, 80)
+    inventory.set_price(325, 400)
+    return inventory
+
+
+def test_basket_is_sold_in_one_go(stocked):
+    lines, total_due = stocked.sell_many([(60, 2), (325, 1), (60, 1)])
+    assert lines == [(60, [make_code(0), make_code(1), make_code(2)], 80), (325, [make_code(100)], 400)]
+    assert total_due == 3 * 80 + 400
+    assert {amount: count for amount, count, _, _ in stocked.stock()} == {60: 2, 325: 1}
+
+
+def test_short_basket_sells_nothing(stocked):
+    assert stocked.sell_many([(60, 2), (325, 3), (660, 1)]) == (None, [325, 660])
+    assert {amount: count for amount, count, _, _ in stocked.stock()} == {60: 5, 325: 2}
+    assert stocked.total_due == 0
+    assert stocked.ledger.report(0, 2 ** 40) == {}
+
+
+def test_basket_reply(stocked):
+    reply, short = process_basket(stocked, [(60, 1), (325, 1)])
+    assert short == []
+    assert f"```{make_code(0)}```" in reply and f"```{make_code(100)}```" in reply
+    assert reply.endswith("Tᴏᴛᴀʟ Dᴜᴇ : 0+(80x1)+(400x1) = 480")
+    assert process_basket(stocked, [(325, 2)]) == (None, [325])
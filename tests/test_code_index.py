@@ -0,0 +1,53 @@
+import os
+import pytest
+from code_index import SEEN_FILE
+from conftest import make_code
+
+
+class FailingFile:
+    def __init__(self, file):
+        self.file = file
+
+    def write(self, data):
+        self.file.write(data[:5])
+        raise OSError(28, "No space left on device")
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+@pytest.mark.parametrize('kind', ['json', 'sqlite'])
+def test_failed_index_write_fails_the_upload(open_inventory, tmp_path, kind):
+    inventory = open_inventory(kind)
+    inventory.add_codes(60, [make_code(1)])
+    index = tmp_path / SEEN_FILE
+    before = index.read_bytes()
+
+    code = make_code(2)
+    inventory.seen._file = FailingFile(inventory.seen._file)
+    with pytest.raises(OSError):
+        inventory.add_codes(325, [code])
+    assert index.read_bytes() == before
+    assert code not in inventory.seen
+    assert [amount for amount, count, _, _ in inventory.stock() if count] == [60]
+
+    inventory.seen._file = inventory.seen._file.file
+    assert inventory.add_codes(325, [code]) == ([code], [])
+    inventory.stop()
+    # The code is known after a restart, whatever amount it is offered for
+    restarted = open_inventory(kind)
+    assert restarted.add_codes(60, [code]) == ([], [code])
+
+
+def test_index_rebuilt_from_held_codes(open_inventory, tmp_path):
+    inventory = open_inventory()
+    inventory.add_codes(60, [make_code(i) for i in range(3)])
+    inventory.sell_many([(60, 1)])
+    inventory.stop()
+    os.remove(tmp_path / SEEN_FILE)
+    restarted = open_inventory()
+    assert restarted.add_codes(325, [make_code(0), make_code(2), make_code(5)]) == \
+           ([make_code(5)], [make_code(0), make_code(2)])
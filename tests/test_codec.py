@@ -0,0 +1,70 @@
+import mmap
+from codec import CodeQueue, pack_code, unpack_code, RECORD_SIZE
+from storage import stock_binary, load_stock_binary
+from engine import CODE_PATTERN
+from conftest import make_code
+
+
+def test_pack_round_trip():
+    for number in (0, 1, 1709317, 99999999):
+        code = make_code(number, prefix='BdMb')
+        record = pack_code(code)
+        assert len(record) == RECORD_SIZE
+        assert unpack_code(record) == code
+
+
+def test_pack_rejects_other_formats():
+    assert pack_code("not a code") is None
+    assert pack_code(make_code(1) + " ") is None
+
+
+def test_queue_keeps_text_codes_in_order():
+    codes = [make_code(1), "free-form code", make_code(2), "ÜNICODE-1", make_code(3)]
+    queue = CodeQueue(codes)
+    assert len(queue) == 5
+    assert list(queue) == codes
+    assert queue.popleft() == codes[0]
+    assert queue.popleft() == codes[1]
+    queue.append("another text")
+    assert list(queue) == codes[2:] + ["another text"]
+
+
+def test_queue_from_bytes_round_trip():
+    codes = [make_code(i) for i in range(10)] + ["odd one"]
+    queue = CodeQueue(codes)
+    queue.popleft()
+    copy = CodeQueue.from_bytes(*queue.to_bytes())
+    assert list(copy) == codes[1:]
+
+
+def test_mapped_queue_is_copied_on_write(tmp_path):
+    codes = [make_code(i) for i in range(5)] + ["text code"]
+    records, texts = CodeQueue(codes).to_bytes()
+    path = tmp_path / "records"
+    path.write_bytes(records)
+    with open(path, 'rb') as file:
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    queue = CodeQueue.from_bytes(memoryview(mapped), texts)
+    assert queue.popleft() == codes[0]
+    queue.append(make_code(99))
+    assert list(queue) == codes[1:] + [make_code(99)]
+    # The file itself is untouched
+    assert path.read_bytes() == records
+
+
+def test_binary_snapshot_round_trip(tmp_path):
+    stock = [(60, 80.0, CodeQueue([make_code(1), "text", make_code(2)])),
+             (325, 0.0, CodeQueue())]
+    path = tmp_path / "codes.bin"
+    path.write_bytes(stock_binary(stock, 42))
+    loaded, seq = load_stock_binary(str(path))
+    assert seq == 42
+    assert [(amount, price, list(queue)) for amount, price, queue in loaded] == \
+           [(60, 80.0, [make_code(1), "text", make_code(2)]), (325, 0.0, [])]
+
+
+def test_non_ascii_digits_stay_text():
+    code = "ABCD-E-S-٠١٢٣٤٥٦٧ 1234-5678-9012-3456"
+    assert pack_code(code) is None
+    assert list(CodeQueue([code, make_code(1)])) == [code, make_code(1)]
+    assert CODE_PATTERN.findall(code) == []
@@ -0,0 +1,61 @@
+import pytest
+import export
+from conftest import make_code
+
+
+@pytest.fixture
+def inventory(open_inventory):
+    inventory = open_inventory()
+    inventory.add_codes(60, [make_code(i) for i in range(5)] + ["text code ÜC"])
+    inventory.add_codes(325, [make_code(i) for i in range(100, 103)])
+    inventory.set_price(60, 80)
+    inventory.set_price(325, 400)
+    inventory.sell_many([(60, 2)], user=7, channel=9)
+    return inventory
+
+
+def stock_of(inventory):
+    return {amount: list(queue) for amount, _, queue in inventory.stock_copy()}
+
+
+@pytest.mark.parametrize('name', ['stock.csv', 'stock.jsonl', 'stock.csv.gz', 'stock.jsonl.gz'])
+def test_stock_round_trip(inventory, open_inventory, tmp_path, name):
+    file_name = str(tmp_path / name)
+    assert export.export_file(inventory, 'stock', [], file_name, export.format_of(file_name)) == (7, None)
+
+    other = open_inventory(directory=tmp_path / "other")
+    assert export.import_rows(other, export.read_rows(file_name), batch=2) == \
+           "Imported 7 codes (duplicates: 0, skipped: 0)"
+    assert stock_of(other) == stock_of(inventory)
+    assert other.price_of(60) == 80 and other.price_of(325) == 400
+
+    # Importing again merges: everything is a duplicate
+    assert export.import_rows(other, export.read_rows(file_name)) == "Imported 0 codes (duplicates: 7, skipped: 0)"
+
+
+def test_sold_codes_are_not_imported_as_stock(inventory, tmp_path):
+    file_name = str(tmp_path / "sold.jsonl")
+    assert export.export_file(inventory, 'sold', [], file_name, 'jsonl') == (2, None)
+    rows = list(export.read_rows(file_name))
+    assert [(row['code'], row['price'], row['user'], row['channel']) for row in rows] == \
+           [(make_code(0), 80, 7, 9), (make_code(1), 80, 7, 9)]
+    assert export.import_rows(inventory, rows) == "Imported 0 codes (duplicates: 0, skipped: 2)"
+
+
+def test_sold_codes_are_duplicates(inventory, tmp_path):
+    rows = [{"amount": 325, "code": make_code(0), "price": ""}, {"amount": "x", "code": make_code(50)}]
+    assert export.import_rows(inventory, rows) == "Imported 0 codes (duplicates: 1, skipped: 1)"
+
+
+def test_export_errors(inventory, tmp_path):
+    assert export.export_file(inventory, 'sold', ['yesterday'], str(tmp_path / "x.csv")) == \
+           (None, "Invalid dates. Use: export sold <from> <to> with dates like 2026-10-01")
+    assert export.export_file(inventory, 'everything', [], str(tmp_path / "x.csv"))[0] is None
+
+
+def test_large_export_is_written_in_chunks(inventory, monkeypatch):
+    monkeypatch.setattr(export, 'EXPORT_CHUNK', 100)
+    chunks = list(export.format_rows(export.stock_rows(inventory), export.STOCK_FIELDS))
+    assert len(chunks) > 1
+    assert "".join(chunks).splitlines()[0] == "amount,code,price"
+    assert len("".join(chunks).splitlines()) == 8
@@ -0,0 +1,69 @@
+import threading
+import pytest
+from conftest import make_code
+
+BACKENDS = ['json', 'sqlite']
+
+
+@pytest.mark.parametrize('kind', BACKENDS)
+def test_two_instances_never_dispense_a_code_twice(open_inventory, kind):
+    a = open_inventory(kind)
+    b = open_inventory(kind)
+    codes = [make_code(i) for i in range(200)]
+    a.add_codes(60, codes[:100])
+    b.add_codes(60, codes[100:])
+
+    taken = {a: [], b: []}
+
+    def sell(inventory):
+        while True:
+            lines, _ = inventory.sell_many([(60, 3)])
+            if lines is None:
+                return
+            taken[inventory] += lines[0][1]
+
+    threads = [threading.Thread(target=sell, args=(inventory,)) for inventory in (a, b)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    dispensed = taken[a] + taken[b]
+    assert len(dispensed) == len(set(dispensed)) == 198
+    assert set(dispensed) <= set(codes)
+    assert taken[a] and taken[b]
+
+
+@pytest.mark.parametrize('kind', BACKENDS)
+def test_sales_show_up_in_the_other_instance(open_inventory, kind):
+    a = open_inventory(kind)
+    b = open_inventory(kind)
+    a.add_codes(60, [make_code(i) for i in range(5)])
+    lines, _ = b.sell_many([(60, 2)])
+    assert lines[0][1] == [make_code(0), make_code(1)]
+    assert a.stock()[0][1] == 3
+    assert a.sell_many([(60, 1)])[0][0][1] == [make_code(2)]
+
+
+@pytest.mark.parametrize('kind', BACKENDS)
+def test_duplicate_rejected_after_foreign_compaction(open_inventory, kind):
+    a = open_inventory(kind)
+    b = open_inventory(kind)
+    code = make_code(7)
+    a.add_codes(60, [code])
+    # b never read the upload before the journal it was in went away
+    a._compact()
+    new_codes, duplicates = b.add_codes(60, [code])
+    assert new_codes == []
+    assert duplicates == [code]
+    assert b.stock()[0][1] == 1
+
+
+@pytest.mark.parametrize('kind', BACKENDS)
+def test_duplicate_rejected_after_the_code_was_sold(open_inventory, kind):
+    a = open_inventory(kind)
+    code = make_code(8)
+    a.add_codes(60, [code])
+    a.sell_many([(60, 1)])
+    b = open_inventory(kind)
+    assert b.add_codes(60, [code]) == ([], [code])
@@ -0,0 +1,72 @@
+import time
+import pytest
+from redeem_code_bot import process_bot_command
+from ledger import Ledger
+from conftest import make_code
+
+
+def run(inventory, *commands):
+    return [process_bot_command(inventory, command, user=11, channel=22) for command in commands]
+
+
+def today():
+    return time.strftime('%Y-%m-%d')
+
+
+def test_lookup_report_and_clear(open_inventory):
+    inventory = open_inventory()
+    code, other = make_code(1), make_code(2)
+    run(inventory, f"up 60uc {code} {other}", "price 60 80", "baki 60 1")
+
+    reply = run(inventory, f"lookup {code}")[0]
+    assert "sold" in reply and "for 80.0 tk" in reply
+    assert "to user 11 in channel 22 (still due)" in reply
+    assert "is in stock" in run(inventory, f"lookup {other}")[0]
+    assert "never uploaded" in run(inventory, f"lookup {make_code(3)}")[0]
+    assert "60 🆄︎🅲︎ ➪ 1 pcs = 80.0 tk" in run(inventory, "report")[0]
+
+    assert run(inventory, "clear") == ["Cleared all dues ✅ ✅."]
+    assert "(settled)" in run(inventory, f"lookup {code}")[0]
+    assert run(inventory, "report")[0].startswith("No sales from")
+    # Settling does not remove sales from the ledger
+    assert "60 🆄︎🅲︎ ➪ 1 pcs" in run(inventory, f"report {today()}")[0]
+
+    run(inventory, "baki 60 1")
+    assert "(still due)" in run(inventory, f"lookup {other}")[0]
+    assert "60 🆄︎🅲︎ ➪ 1 pcs" in run(inventory, "report")[0]
+    assert "60 🆄︎🅲︎ ➪ 2 pcs = 160.0 tk" in run(inventory, f"report {today()} {today()}")[0]
+
+
+def test_report_rejects_bad_dates(open_inventory):
+    inventory = open_inventory()
+    assert run(inventory, "report yesterday")[0].startswith("Invalid dates")
+
+
+def fail_ledger_writes(monkeypatch):
+    def write(file_name, data, written):
+        raise OSError(28, "No space left on device")
+    monkeypatch.setattr(Ledger, '_write', staticmethod(write))
+
+
+def test_failed_sale_is_written_with_the_next_one(open_inventory, monkeypatch):
+    inventory = open_inventory()
+    inventory.add_codes(60, [make_code(i) for i in range(3)])
+    with monkeypatch.context() as patch:
+        fail_ledger_writes(patch)
+        inventory.sell_many([(60, 1)])
+    assert inventory.ledger.lookup(make_code(0)) == []
+    inventory.sell_many([(60, 1)])
+    assert [sale['code'] for sale in inventory.ledger.sales(0, time.time() + 1)] == [make_code(0), make_code(1)]
+
+
+@pytest.mark.parametrize('kind', ['json', 'sqlite'])
+def test_journal_kept_until_the_ledger_has_it(open_inventory, monkeypatch, kind):
+    inventory = open_inventory(kind)
+    inventory.add_codes(60, [make_code(i) for i in range(3)])
+    fail_ledger_writes(monkeypatch)
+    inventory.sell_many([(60, 1)])
+    inventory.stop()
+    monkeypatch.undo()
+    restarted = open_inventory(kind)
+    assert [sale['code'] for sale in restarted.ledger.lookup(make_code(0))] == [make_code(0)]
+    assert restarted.stock()[0][1] == 2
@@ -0,0 +1,99 @@
+import pytest
+import engine
+from orders import OrderQueue
+from redeem_code_bot import process_bot_command
+from conftest import make_code
+
+
+@pytest.fixture
+def inventory(open_inventory):
+    inventory = open_inventory()
+    inventory.add_codes(60, [make_code(0)])
+    inventory.sell_many([(60, 1)])
+    return inventory
+
+
+def place(inventory, orders, count, user):
+    return engine.place_order(inventory, orders, [(60, count)], user, user * 10)
+
+
+def upload(inventory, orders, first, count):
+    inventory.add_codes(60, [make_code(i) for i in range(first, first + count)])
+    return engine.fill_orders(inventory, orders, 60)
+
+
+def test_orders_are_filled_first_come_first_served(inventory):
+    orders = OrderQueue()
+    assert "#1 in the queue" in place(inventory, orders, 2, 1)[0]
+    assert "#2 in the queue" in place(inventory, orders, 1, 2)[0]
+    # Not enough for the first order: the second one waits behind it
+    assert upload(inventory, orders, 10, 1) == []
+    filled = upload(inventory, orders, 11, 2)
+    assert [(order.user, order.count) for order, _ in filled] == [(1, 2), (2, 1)]
+    assert f"```{make_code(10)}```" in filled[0][1] and f"```{make_code(12)}```" in filled[1][1]
+    assert orders.waiting() == 0
+
+
+def test_new_order_does_not_overtake_the_queue(inventory):
+    orders = OrderQueue()
+    place(inventory, orders, 3, 1)
+    inventory.add_codes(60, [make_code(10)])
+    # One code in stock, but an order is waiting for that amount
+    assert "#2 in the queue" in place(inventory, orders, 1, 2)[0]
+    reply, filled = place(inventory, orders, 1, 3)
+    assert "#3 in the queue" in reply and filled == []
+
+
+def test_queue_limits(inventory):
+    orders = OrderQueue(size=3, per_user=2)
+    place(inventory, orders, 1, 1)
+    place(inventory, orders, 1, 1)
+    assert "You already have 2 orders waiting for 60 UC." in place(inventory, orders, 1, 1)[0]
+    place(inventory, orders, 1, 2)
+    assert "The 60 UC queue is full (3 orders)" in place(inventory, orders, 1, 3)[0]
+    assert engine.place_order(inventory, OrderQueue(size=0), [(60, 1)], 1, 1) == \
+           ("❌ Not enough available 60 UC codes.", [])
+
+
+def test_baskets_are_not_queued(inventory):
+    orders = OrderQueue()
+    reply, _ = engine.place_order(inventory, orders, [(60, 1), (325, 1)], 1, 1)
+    assert reply.startswith("❌") and orders.waiting() == 0
+
+
+def test_cancel_leaves_an_order_being_filled(inventory):
+    orders = OrderQueue()
+    place(inventory, orders, 1, 1)
+    place(inventory, orders, 1, 1)
+    orders.queues[60][0].in_flight = True
+    assert orders.cancel(1) == 1
+    assert orders.positions(1) == [(60, 1, 1)]
+    assert engine.cancel_orders(orders, 1) == "Your order is being filled right now and can no longer be cancelled."
+    assert engine.cancel_orders(orders, 2) == "You have no orders waiting."
+
+
+def test_failed_fill_can_be_cancelled(inventory, monkeypatch):
+    orders = OrderQueue()
+    place(inventory, orders, 1, 1)
+    inventory.add_codes(60, [make_code(10)])
+    monkeypatch.setattr(engine, 'process_basket', lambda *args: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        orders.fill(inventory, 60)
+    assert orders.cancel(1) == 1
+
+
+def test_drain_for_shutdown(inventory):
+    orders = OrderQueue()
+    place(inventory, orders, 1, 1)
+    place(inventory, orders, 2, 2)
+    drained = orders.drain()
+    assert [(order.user, order.count) for order in drained] == [(1, 1), (2, 2)]
+    assert orders.waiting() == 0
+    message = engine.dropped_orders_message(drained)
+    assert "<@1> 60 🆄︎🅲︎ x 1" in message and "<@2> 60 🆄︎🅲︎ x 2" in message
+
+
+def test_queue_commands_without_a_queue(inventory):
+    assert process_bot_command(inventory, "baki 60 1", None, 1, 1) == "❌ Not enough available 60 UC codes."
+    assert process_bot_command(inventory, "queue", None, 1, 1) == "You have no orders waiting."
+    assert process_bot_command(inventory, "cancel", None, 1, 1) == "You have no orders waiting."
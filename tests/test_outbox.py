@@ -0,0 +1,58 @@
+import asyncio
+from outbox import Outbox, chunk_message, CODE_BLOCK, MESSAGE_LIMIT
+from conftest import make_code
+
+
+def test_short_text_is_one_message():
+    assert chunk_message("hello\nworld") == ["hello\nworld"]
+    assert chunk_message("") == []
+
+
+def test_chunks_fit_the_limit_and_keep_every_line():
+    lines = [f"line {i}: {make_code(i)}" for i in range(300)]
+    chunks = chunk_message("\n".join(lines))
+    assert len(chunks) > 1
+    assert all(len(chunk) <= MESSAGE_LIMIT for chunk in chunks)
+    assert [line for chunk in chunks for line in chunk.splitlines() if line] == lines
+
+
+def test_code_blocks_are_not_cut():
+    blocks = [f"```{make_code(i)}```" for i in range(100)]
+    text = "\n".join(f"✓ {i}\n{block}" for i, block in enumerate(blocks))
+    chunks = chunk_message(text, limit=200)
+    assert all(len(chunk) <= 200 for chunk in chunks)
+    assert [block for chunk in chunks for block in CODE_BLOCK.findall(chunk)] == blocks
+
+
+def test_long_code_block_is_fenced_in_every_chunk():
+    codes = [make_code(i) for i in range(20)]
+    chunks = chunk_message("```\n" + "\n".join(codes) + "\n```", limit=200)
+    assert len(chunks) > 1
+    assert all(len(chunk) <= 200 and chunk.startswith("```") and chunk.endswith("```") for chunk in chunks)
+    assert [line for chunk in chunks for line in chunk.strip('`').split()] == \
+           [part for code in codes for part in code.split()]
+
+
+def test_long_line_is_split():
+    chunks = chunk_message("x" * 450, limit=100)
+    assert [len(chunk) for chunk in chunks] == [100, 100, 100, 100, 50]
+
+
+class Channel:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, text):
+        self.sent.append(text)
+
+
+def test_outbox_coalesces_messages():
+    channel = Channel()
+
+    async def run():
+        async with Outbox(channel) as outbox:
+            for i in range(5):
+                outbox.add(f"message {i}")
+
+    asyncio.run(run())
+    assert channel.sent == ["\n".join(f"message {i}" for i in range(5))]
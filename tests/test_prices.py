@@ -0,0 +1,47 @@
+import types
+import pytest
+import inventory as inventory_module
+from redeem_code_bot import process_bot_command
+from conftest import make_code
+
+NOW = 1760000000
+
+
+@pytest.fixture
+def frozen_clock(monkeypatch):
+    monkeypatch.setattr(inventory_module, 'time', types.SimpleNamespace(time=lambda: NOW))
+
+
+@pytest.mark.parametrize('kind', ['json', 'sqlite'])
+def test_price_changes_in_one_second_keep_their_order(open_inventory, frozen_clock, kind):
+    inventory = open_inventory(kind)
+    inventory.add_codes(60, [make_code(i) for i in range(3)])
+    inventory.set_price(60, 100)
+    inventory.set_price(60, 80)
+    assert inventory.price_of(60) == 80
+    assert inventory.price_at(60) == 80
+    assert inventory.price_at(60, NOW) == 80
+    assert inventory.sell_many([(60, 1)])[0][0][2] == 80
+
+    inventory.stop()
+    restarted = open_inventory(kind)
+    assert restarted.price_at(60) == restarted.price_of(60) == 80
+    assert restarted.price_table_data()['60'][-2:] == [[NOW, 100], [NOW, 80]]
+
+
+def test_price_in_effect_at_a_time(open_inventory, monkeypatch):
+    inventory = open_inventory()
+    inventory.add_codes(60, [make_code(1)])
+    for ts, price in ((NOW, 100), (NOW + 60, 90), (NOW + 120, 80)):
+        monkeypatch.setattr(inventory_module, 'time', types.SimpleNamespace(time=lambda: ts))
+        inventory.set_price(60, price)
+    assert inventory.price_at(60, NOW + 59) == 100
+    assert inventory.price_at(60, NOW + 60) == 90
+    assert inventory.price_at(60) == 80
+
+
+def test_price_command_needs_stock(open_inventory):
+    inventory = open_inventory()
+    assert process_bot_command(inventory, "price 60 80") is None
+    process_bot_command(inventory, f"up 60uc {make_code(1)}")
+    assert process_bot_command(inventory, "price 60 80") == "✅ Price for 60 UC set to 80.0."
@@ -0,0 +1,50 @@
+import os
+import sold_index
+from sold_index import SOLD_INDEX_FILE
+from ledger import LEDGER_DIR
+from conftest import make_code
+
+
+def index_path(tmp_path):
+    return os.path.join(tmp_path, LEDGER_DIR, SOLD_INDEX_FILE)
+
+
+def sell_all(inventory, count):
+    inventory.add_codes(60, [make_code(i) for i in range(count)])
+    for _ in range(count):
+        inventory.sell_many([(60, 1)], user=1, channel=2)
+
+
+def test_index_grows_and_finds_every_code(open_inventory, tmp_path, monkeypatch):
+    monkeypatch.setattr(sold_index, 'INITIAL_SLOTS', 4)
+    inventory = open_inventory()
+    sell_all(inventory, 40)
+    slots = sold_index.INDEX_HEADER.unpack_from(open(index_path(tmp_path), 'rb').read())[1]
+    assert slots >= 80
+    for i in range(40):
+        sales = inventory.ledger.lookup(make_code(i))
+        assert [(sale['code'], sale['user']) for sale in sales] == [(make_code(i), 1)]
+    assert inventory.ledger.lookup(make_code(99)) == []
+
+
+def test_index_rebuilt_when_it_does_not_match_the_ledger(open_inventory, tmp_path, monkeypatch):
+    monkeypatch.setattr(sold_index, 'INITIAL_SLOTS', 8)
+    inventory = open_inventory()
+    sell_all(inventory, 10)
+    inventory.ledger.close()
+    path = index_path(tmp_path)
+    with open(path, 'r+b') as file:
+        file.write(b'JUNK')
+    inventory.ledger.update_index()
+    assert open(path, 'rb').read(4) == sold_index.INDEX_MAGIC
+    assert all(inventory.ledger.lookup(make_code(i)) for i in range(10))
+
+
+def test_index_rebuilt_when_missing(open_inventory, tmp_path):
+    inventory = open_inventory()
+    sell_all(inventory, 5)
+    inventory.ledger.close()
+    os.remove(index_path(tmp_path))
+    assert inventory.ledger.lookup(make_code(3)) == []
+    inventory.ledger.update_index()
+    assert [sale['code'] for sale in inventory.ledger.lookup(make_code(3))] == [make_code(3)]